@@ -7,6 +7,7 @@ import argparse
 from operator import itemgetter
 from config import Config, ConfigError
 from cloud import amazon, Cloud, DataError, GPGError, MetadataError, sftp
+from cloud.parallel import ParallelBackup
 from database import MetaDataDB
 import os
 import sys
@@ -56,8 +57,27 @@ def parse_args():
     parser.add_argument(
         '-e', '--encryption-method', type=str,
         help="encryption method for data stored in cloud provider: "
-             "gpg|symmetric|cryptoengine (default: gpg)",
+             "gpg|symmetric|multicore|cryptoengine (default: gpg)",
         default="gpg")
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        help="number of files backed up concurrently when backing up "
+             "directory, or metadata objects retrieved concurrently in sync "
+             "(default: 1)",
+        default=1)
+    parser.add_argument(
+        '--full-sync', help="retrieve all metadata from cloud in sync "
+                            "instead of only new and changed metadata",
+        action="store_true")
+    parser.add_argument(
+        '--rehash', help="calculate checksums of all files in backup "
+                         "instead of using cached checksums of unchanged "
+                         "files",
+        action="store_true")
+    parser.add_argument(
+        '--range', type=str,
+        help="restore only the given byte range START-END of the file, "
+             "for example 0-1023, or 1048576- for the rest of the file")
     parser.add_argument(
         '-v', '--verbose', help="show more verbose information",
         action="store_true")
@@ -66,7 +86,7 @@ def parse_args():
     parser.add_argument(
         'command', type=str, nargs='?',
         help="command to execute: list|backup|restore|remove|sync|"
-             "list-cloud-keys|list-cloud-data (default: list)",
+             "compact|list-cloud-keys|list-cloud-data (default: list)",
         default="list")
     parser.add_argument(
         'inputfile', type=str, nargs='?',
@@ -108,25 +128,41 @@ def show_files(metadata_list, verbose=False):
                    "{mtime:<21}{checksum:<12}{path}".format(**metadata))
 
 
+def replace_versions(cloud, metadata, old_metadata_list):
+    """
+    Delete the earlier versions of a stored file, so that only one version
+    of each path is kept. `old_metadata_list` is the metadata found for the
+    path before the file was stored. Return False if the file was already
+    stored and has not changed.
+    """
+    changed = True
+    for old_metadata in old_metadata_list:
+        if old_metadata["key"] != metadata["key"]:
+            cloud.delete(old_metadata)
+        elif (old_metadata["mode"], old_metadata["mtime"]) == \
+                (metadata["mode"], metadata["mtime"]):
+            changed = False
+    return changed
+
+
 def backup_file(cloud, input_file, output_file):
     """
-    Backup one file to cloud.
+    Backup one file to cloud. Return False if the file is already stored
+    and has not changed.
     """
-    if cloud.find_one(path=output_file):
-        return False
+    old_metadata_list = list(cloud.find(path=output_file))
 
     print "Backing up file:", input_file, "->", output_file
-    cloud.store_from_filename(input_file, output_file)
+    metadata = cloud.store_from_filename(input_file, output_file)
+
+    return replace_versions(cloud, metadata, old_metadata_list)
 
-    return True
 
-def backup_directory(cloud, input_file, output_file):
+def walk_directory(input_file, output_file):
     """
-    Backup directory to cloud.
+    Walk directory and yield tuples of local filename and cloud filename
+    for all files.
     """
-    if cloud.find_one(path=output_file):
-        return False
-
     for root, dirnames, filenames in os.walk(input_file):
         for filename in filenames:
             filename = root + "/" + filename
@@ -136,11 +172,60 @@ def backup_directory(cloud, input_file, output_file):
                 cloud_file = os.path.normpath(output_file + "/" + filename)
             else:
                 cloud_file = filename
-            if not backup_file(cloud, filename, cloud_file):
-                print "File already exists: {0}".format(cloud_file)
+            yield filename, cloud_file
+
+
+def backup_directory(cloud, input_file, output_file, jobs=1):
+    """
+    Backup directory to cloud. If more than one job is given, files are
+    backed up concurrently. Files that are already stored and have not
+    changed are skipped, changed files replace their earlier versions, and
+    only the stored files are shown.
+    """
+    if cloud.find_one(path=output_file):
+        return False
+
+    # Local filename and earlier versions of each file, by cloud filename.
+    files = dict()
+
+    def walk():
+        for filename, cloud_file in walk_directory(input_file, output_file):
+            files[cloud_file] = (filename, list(cloud.find(path=cloud_file)))
+            yield filename, cloud_file
+
+    if jobs > 1:
+        metadata_list = ParallelBackup(cloud, jobs).backup(walk())
+    else:
+        metadata_list = cloud.store_files(walk())
+    for metadata in metadata_list:
+        filename, old_metadata_list = files[metadata["path"]]
+        if replace_versions(cloud, metadata, old_metadata_list):
+            print "Backed up file:", filename, "->", metadata["path"]
 
     return True
 
+
+def parse_range(byte_range):
+    """
+    Parse byte range given as START-END or START-. Return tuple of offset
+    and length, where length is None if the range extends to the end of the
+    file.
+    """
+    try:
+        start, end = byte_range.split("-")
+        start = int(start)
+        if start < 0:
+            raise ValueError
+        if not end:
+            return start, None
+        end = int(end)
+        if end < start:
+            raise ValueError
+    except ValueError:
+        error_exit("Invalid byte range: '{0}'".format(byte_range))
+    return start, end - start + 1
+
+
 def main():
     """
     Main function for `GPGBackup` tool.
@@ -174,6 +259,7 @@ def main():
         error_exit("Unknown cloud provider: {0}".format(args.provider))
 
     cloud = Cloud(config, metadata_provider, provider, MetaDataDB(config))
+    cloud.rehash = args.rehash
 
     input_file = None
     output_file = None
@@ -226,13 +312,18 @@ def main():
             cloud.disconnect()
         elif args.command == "sync":
             cloud.connect()
-            cloud.sync()
+            cloud.sync(full=args.full_sync, jobs=args.jobs)
             cloud.disconnect()
             metadata_list = cloud.list()
             if len(metadata_list) == 0:
                 print "No files found."
                 sys.exit(0)
             show_files(metadata_list, args.verbose)
+        elif args.command == "compact":
+            cloud.connect()
+            cloud.compact_metadata()
+            cloud.clean_spool()
+            cloud.disconnect()
         elif args.command == "backup":
             if not input_file:
                 error_exit("Local filename not given.")
@@ -240,7 +331,8 @@ def main():
                 output_file = input_file
             if os.path.isdir(input_file):
                 cloud.connect()
-                if not backup_directory(cloud, input_file, output_file):
+                if not backup_directory(
+                        cloud, input_file, output_file, args.jobs):
                     print "File already exists: {0}".format(output_file)
                     exit_value = 1
                 cloud.disconnect()
@@ -271,25 +363,36 @@ def main():
                     continue
                 if not output_file:
                     output_file = input_file
-                print "Restoring file:", input_file, "->", output_file
-                cloud.retrieve_to_filename(metadata, output_file)
+                if args.range:
+                    offset, length = parse_range(args.range)
+                    print "Restoring bytes {0} of file:".format(args.range), \
+                        input_file, "->", output_file
+                    cloud.retrieve_range_to_filename(
+                        metadata, output_file, offset, length)
+                else:
+                    print "Restoring file:", input_file, "->", output_file
+                    cloud.retrieve_to_filename(metadata, output_file)
                 cloud.disconnect()
                 sys.exit(0)
 
+            if args.range:
+                cloud.disconnect()
+                error_exit("Byte range can only be restored from one file.")
+
             # Then, try to find all files, that have the same directory.
-            file_found = False
+            files = list()
             for metadata in cloud_list:
                 if not metadata["path"].startswith(input_file + "/"):
                     continue
-                file_found = True
                 if not output_file:
                     local_file = metadata["path"]
                 else:
                     local_file = output_file + "/" + metadata["path"]
                 print "Restoring file:", metadata["path"], "->", local_file
-                cloud.retrieve_to_filename(metadata, local_file)
+                files.append((metadata, local_file))
+            cloud.retrieve_files(files)
             cloud.disconnect()
-            if file_found:
+            if files:
                 sys.exit(0)
             error_exit("File not found: " + input_file)
         elif args.command == "remove":
@@ -299,26 +402,29 @@ def main():
             # Get the list of files.
             cloud_list = cloud.list()
 
-            # First, check whether we have an exact match.
+            # First, check whether we have an exact match. Versions left by
+            # an interrupted backup are removed too.
             cloud.connect()
-            for metadata in cloud_list:
-                if metadata["path"] != input_file:
-                    continue
+            versions = [metadata for metadata in cloud_list
+                        if metadata["path"] == input_file]
+            if versions:
                 print "Removing file:", input_file
-                cloud.delete(metadata)
+                for metadata in versions:
+                    cloud.delete(metadata)
                 cloud.disconnect()
                 sys.exit(0)
 
             # Then, try to find all files, that have the same directory.
-            file_found = False
+            removed = set()
             for metadata in cloud_list:
                 if not metadata["path"].startswith(input_file + "/"):
                     continue
-                file_found = True
-                print "Removing file:", metadata["path"]
+                if metadata["path"] not in removed:
+                    print "Removing file:", metadata["path"]
+                    removed.add(metadata["path"])
                 cloud.delete(metadata)
             cloud.disconnect()
-            if file_found:
+            if removed:
                 sys.exit(0)
             error_exit("File not found: " + input_file)
         else:
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""
+Benchmarks for `gpgcloud`.
+
+Measure the throughput of symmetric encryption and decryption of data in
+memory using the AES-CBC stream of `symmetric` encryption method, the
+seekable container in one process, and the seekable container on a process
+pool as used by `multicore` encryption method.
+
+Measure also the peak memory used by encryption and decryption of data in
+memory with streams and with preallocated buffers, and the throughput of
+content-defined chunking in one process and on a process pool.
+
+Chunking calculates the rolling hash in Python one byte at a time. In one
+process it should run at least 8 MB/s with an average chunk size of 1 MB,
+and on a process pool at least that times the number of CPUs. Lower
+throughput limits the backup speed of large files, which are chunked on a
+process pool when they are larger than one segment of 4 MB.
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import time
+from StringIO import StringIO
+
+from lib.chunking import chunk_stream
+from lib.encryption import decrypt, decrypt_buffer, decrypt_seekable, \
+    encrypt, encrypt_buffer, encrypt_seekable, encryption_pool, \
+    generate_random_password
+
+
+def measure(function, *args, **kwargs):
+    """
+    Run function and return elapsed time in seconds.
+    """
+    start = time.time()
+    function(*args, **kwargs)
+    return time.time() - start
+
+
+def benchmark_encryption(size, jobs, block_size):
+    """
+    Encrypt and decrypt `size` bytes of random data with each method and
+    show the throughput.
+    """
+    data = os.urandom(size)
+    password = generate_random_password()
+    pool = encryption_pool(jobs)
+    methods = [
+        ("symmetric (AES-CBC stream)", encrypt, decrypt, dict()),
+        ("seekable (1 process)", encrypt_seekable, decrypt_seekable,
+         dict()),
+        ("multicore ({0} processes)".format(jobs), encrypt_seekable,
+         decrypt_seekable, dict(pool=pool, window=2 * jobs)),
+    ]
+    print "{0:<32}{1:>16}{2:>16}".format(
+        "Method", "Encrypt MB/s", "Decrypt MB/s")
+    try:
+        for name, encrypt_function, decrypt_function, options in methods:
+            if encrypt_function is encrypt_seekable:
+                options["block_size"] = block_size
+            encrypted_fp = StringIO()
+            encrypt_time = measure(encrypt_function, StringIO(data),
+                                   encrypted_fp, password, **options)
+            options.pop("block_size", None)
+            decrypt_time = measure(decrypt_function,
+                                   StringIO(encrypted_fp.getvalue()),
+                                   StringIO(), password, **options)
+            print "{0:<32}{1:>16.1f}{2:>16.1f}".format(
+                name, size / encrypt_time / 2**20,
+                size / decrypt_time / 2**20)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _encrypt_stream(data, password):
+    encrypted_fp = StringIO()
+    encrypt(StringIO(data), encrypted_fp, password)
+    return encrypted_fp.getvalue()
+
+
+def _decrypt_stream(data, password):
+    plaintext_fp = StringIO()
+    decrypt(StringIO(data), plaintext_fp, password)
+    return plaintext_fp.getvalue()
+
+
+def _encrypt_buffer(data, password):
+    return encrypt_buffer(data, password)[2]
+
+
+def _decrypt_buffer(data, password):
+    return decrypt_buffer(data, password)[2]
+
+
+def _peak_memory(function, data, password, queue):
+    """
+    Run function in child process and put the increase of peak memory
+    usage in kilobytes to queue.
+    """
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    function(data, password)
+    queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline)
+
+
+def benchmark_memory(size):
+    """
+    Encrypt and decrypt `size` bytes of data with streams and buffers, and
+    show the peak memory used in addition to the input data.
+    """
+    password = generate_random_password()
+    data = os.urandom(size)
+    encrypted_data = _encrypt_stream(data, password)
+    methods = [
+        ("encrypt (stream)", _encrypt_stream, data),
+        ("encrypt (buffer)", _encrypt_buffer, data),
+        ("decrypt (stream)", _decrypt_stream, encrypted_data),
+        ("decrypt (buffer)", _decrypt_buffer, encrypted_data),
+    ]
+    print "{0:<32}{1:>16}{2:>16}".format(
+        "Method", "Peak MB", "x data size")
+    for name, function, input_data in methods:
+        # Each method is run in a new process, so that memory freed by
+        # earlier methods does not hide the peak memory usage. The input
+        # data is inherited from this process.
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_peak_memory, args=(function, input_data, password, queue))
+        process.start()
+        peak = queue.get() * 1024
+        process.join()
+        print "{0:<32}{1:>16.1f}{2:>16.2f}".format(
+            name, float(peak) / 2**20, float(peak) / size)
+
+
+def benchmark_chunking(size, average_size, jobs):
+    """
+    Split `size` bytes of random data into chunks of `average_size` bytes
+    on average in one process and on a pool of `jobs` processes, and show
+    the throughput.
+    """
+    data = os.urandom(size)
+    pool = encryption_pool(jobs)
+    methods = [
+        ("chunking", lambda: list(chunk_stream(StringIO(data), average_size))),
+        ("chunking, {0} processes".format(jobs),
+         lambda: list(chunk_stream(StringIO(data), average_size, pool=pool,
+                                   window=2 * jobs))),
+    ]
+    print "{0:<32}{1:>16}".format("Method", "MB/s")
+    for name, function in methods:
+        print "{0:<32}{1:>16.1f}".format(
+            name, size / measure(function) / 2**20)
+    pool.close()
+    pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the throughput and memory usage of symmetric "
+                    "encryption, or the throughput of chunking.")
+    parser.add_argument(
+        '-s', '--size', type=int,
+        help="size of data in megabytes (default: 64)", default=64)
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        help="number of processes used by multicore encryption and "
+             "chunking (default: number of CPUs)",
+        default=multiprocessing.cpu_count())
+    parser.add_argument(
+        '-b', '--block-size', type=int,
+        help="block size of seekable container in bytes (default: "
+             "1048576)",
+        default=2**20)
+    parser.add_argument(
+        '-m', '--memory', action="store_true",
+        help="measure peak memory usage instead of throughput")
+    parser.add_argument(
+        '-c', '--chunk-size', type=int,
+        help="measure throughput of content-defined chunking with given "
+             "average chunk size in bytes instead of encryption, at least "
+             "8 MB/s per process is expected with 1048576")
+    args = parser.parse_args()
+    if args.memory:
+        benchmark_memory(args.size * 2**20)
+    elif args.chunk_size:
+        benchmark_chunking(args.size * 2**20, args.chunk_size, args.jobs)
+    else:
+        benchmark_encryption(args.size * 2**20, args.jobs, args.block_size)
+
+
+if __name__ == "__main__":
+    main()
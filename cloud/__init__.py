@@ -4,20 +4,51 @@ from the cloud.
 """
 
 import base64
+import collections
 import errno
 import gnupg
+import hashlib
+import itertools
 import json
+import multiprocessing
+import multiprocessing.pool
 import os
+import shutil
 import tempfile
-import urllib
-import urllib2
+import threading
+import time
 from StringIO import StringIO
 
-from lib import checksum_data, checksum_file
-from lib.encryption import generate_random_password, encrypt, decrypt
+from cloud.engine import CryptoEngineClient
+from config import ConfigError
+from lib import checksum_data, checksum_file, checksums_data, \
+    checksums_file, random_string
+from lib.chunking import SEGMENT_SIZE, check_chunk_size, chunk_stream
+from lib.compression import SAMPLE_SIZE, CompressReader, DecompressWriter, \
+    check_method, compress, decompress, is_compressible
+from lib.encryption import BINARY_MAGIC, MAX_BLOCK_SIZE, SEEKABLE_MAGIC, \
+    ContainerError, decrypt, decrypt_buffer, decrypt_range, decrypt_seekable, \
+    encrypt, encrypt_buffer, encrypt_seekable, encryption_pool, \
+    generate_random_password, is_binary, is_seekable
+from lib.stream import Base64Reader, BufferReader, BufferWriter, \
+    ChecksumReader, ChecksumWriter, PeekReader, RangeWriter
 
 
 METADATA_VERSION = 1
+# Metadata segments pack many metadata records into one cloud object. They
+# are identified by their own metadata version. Segments are never
+# rewritten, so that many clients can store segments concurrently.
+SEGMENT_METADATA_VERSION = 2
+SEGMENT_PREFIX = "segment-"
+# Segment index of earlier versions, which is not a segment.
+SEGMENT_INDEX_KEY = SEGMENT_PREFIX + "index"
+# Sync version of metadata records synced from a segment.
+SEGMENT_SYNC_VERSION = "segment:"
+# Pack objects contain encrypted data of many small files.
+PACK_PREFIX = "pack-"
+# Fields of chunks in the chunk list of metadata.
+CHUNK_FIELDS = ("checksum", "size", "encryption_key", "encrypted_size",
+                "encrypted_checksum", "compression")
 gpg = gnupg.GPG(use_agent=True)
 
 
@@ -51,6 +82,53 @@ class DataError(MetadataError):
     pass
 
 
+class ProviderWriter(object):
+    """
+    Writable stream to a key in cloud provider. Data is written to a
+    temporary file, which is stored to cloud provider when the stream is
+    closed. Providers that can upload data while it is written return their
+    own writer from `Provider.open_writer()`.
+    """
+    def __init__(self, provider, key):
+        self.provider = provider
+        self.key = key
+        self.fp = tempfile.NamedTemporaryFile()
+
+    def write(self, data):
+        self.fp.write(data)
+
+    def close(self):
+        """
+        Store written data to cloud provider.
+        """
+        self.fp.flush()
+        self.provider.store_from_filename(self.key, self.fp.name)
+        self.fp.close()
+
+    def abort(self):
+        """
+        Discard written data.
+        """
+        self.fp.close()
+
+
+class ProviderReader(object):
+    """
+    Readable stream from a key in cloud provider. Data is first retrieved to
+    a temporary file. Providers that can read data while it is retrieved
+    return their own reader from `Provider.open_reader()`.
+    """
+    def __init__(self, provider, key):
+        self.fp = tempfile.NamedTemporaryFile()
+        provider.retrieve_to_filename(key, self.fp.name)
+
+    def read(self, size=-1):
+        return self.fp.read(size)
+
+    def close(self):
+        self.fp.close()
+
+
 class Provider(object):
     """
     Base class for cloud provider.
@@ -64,10 +142,10 @@ class Provider(object):
         self.config.check("gnupg", ["recipients", "signer"])
         self.bucket_name = bucket_name
         if encryption_method.lower() not in [
-            "gpg", "symmetric", "cryptoengine", ]:
+            "gpg", "symmetric", "multicore", "cryptoengine", ]:
             raise ValueError(
-                "Encryption method must be either 'gpg', 'symmetric' or "
-                "'cryptoengine'")
+                "Encryption method must be either 'gpg', 'symmetric', "
+                "'multicore' or 'cryptoengine'")
         self.encryption_method = encryption_method
         if self.encryption_method == "cryptoengine":
             self.config.check("cryptoengine", ["api_url"])
@@ -79,6 +157,15 @@ class Provider(object):
     def __str__(self):
         return self.__name__
 
+    def clone(self):
+        """
+        Create a new, unconnected provider instance for the same bucket.
+        Each thread that accesses the cloud concurrently must use its own
+        provider instance.
+        """
+        return self.__class__(
+            self.config, self.bucket_name, self.encryption_method)
+
     def connect(self):
         """
         Connect to cloud provider.
@@ -103,6 +190,21 @@ class Provider(object):
         """
         pass
 
+    def is_resumable(self, size):
+        """
+        Return True if an interrupted `store_from_filename()` of an
+        unchanged file of given size continues where it was interrupted.
+        """
+        return False
+
+    def open_writer(self, key):
+        """
+        Open writable stream to cloud provider. Data is stored when
+        `close()` is called for the stream and discarded when `abort()` is
+        called.
+        """
+        return ProviderWriter(self, key)
+
     def retrieve(self, key):
         """
         Retrieve data from cloud provider. Return data as string.
@@ -115,6 +217,21 @@ class Provider(object):
         """
         pass
 
+    def retrieve_range(self, key, offset, length):
+        """
+        Retrieve part of data from cloud provider. Return data as string.
+        """
+        data = self.retrieve(key)
+        if data is not None:
+            data = data[offset:offset + length]
+        return data
+
+    def open_reader(self, key):
+        """
+        Open readable stream from cloud provider.
+        """
+        return ProviderReader(self, key)
+
     def delete(self, key):
         """
         Delete data from cloud provider.
@@ -135,6 +252,121 @@ class Provider(object):
         return dict()
 
 
+class ThreadProviders(object):
+    """
+    Provider instances for concurrent threads. Each thread gets its own
+    connected clone of the given provider.
+    """
+    def __init__(self, provider):
+        self.provider = provider
+        self._local = threading.local()
+        self._providers = list()
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Return provider owned by the calling thread.
+        """
+        if not hasattr(self._local, "provider"):
+            provider = self.provider.clone()
+            with self._lock:
+                self._providers.append(provider)
+            provider.connect()
+            self._local.provider = provider
+        return self._local.provider
+
+    def disconnect(self):
+        """
+        Disconnect all providers created for threads.
+        """
+        with self._lock:
+            for provider in self._providers:
+                provider.disconnect()
+            self._providers = list()
+
+
+class RangeReader(object):
+    """
+    Readable stream from a key in cloud provider. Data is retrieved in
+    ranges of `range_size` bytes using `jobs` concurrent requests, each on
+    its own connection, and returned in order. At most `2 * jobs` ranges
+    are held in memory.
+    """
+    def __init__(self, provider, key, size, range_size, jobs):
+        if range_size < 1 or jobs < 1:
+            raise ValueError("Range size and number of jobs must be positive")
+        self.key = key
+        self.size = size
+        self.providers = ThreadProviders(provider)
+        self.pool = multiprocessing.pool.ThreadPool(jobs)
+        self.ranges = iter(
+            (offset, min(range_size, size - offset))
+            for offset in xrange(0, size, range_size))
+        self.pending = collections.deque()
+        self.data = ""
+        self.position = 0
+        for _ in range(2 * jobs):
+            self._submit()
+
+    def _retrieve_range(self, offset, length):
+        data = self.providers.get().retrieve_range(self.key, offset, length)
+        if data is None or len(data) != length:
+            raise IOError(
+                "Could not retrieve bytes {0}-{1} of {2}".format(
+                    offset, offset + length - 1, self.key))
+        return data
+
+    def _submit(self):
+        for offset, length in self.ranges:
+            self.pending.append(self.pool.apply_async(
+                self._retrieve_range, (offset, length)))
+            return
+
+    def read(self, size=-1):
+        blocks = list()
+        while size < 0 or size > 0:
+            if self.position == len(self.data):
+                if not self.pending:
+                    break
+                self.data = self.pending.popleft().get()
+                self.position = 0
+                self._submit()
+            end = len(self.data)
+            if size >= 0:
+                end = min(end, self.position + size)
+                size -= end - self.position
+            blocks.append(self.data[self.position:end])
+            self.position = end
+        return "".join(blocks)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.providers.disconnect()
+        self.pending.clear()
+        self.data = ""
+
+    def copy_to_filename(self, filename):
+        """
+        Write all data to given file and close the stream.
+        """
+        f = file(filename, "wb")
+        try:
+            shutil.copyfileobj(self, f, 2**20)
+        finally:
+            f.close()
+            self.close()
+
+
+def _segment_order(item):
+    """
+    Return sort key of a tuple of metadata segment key and segment.
+    Segments of earlier versions have no time or generation.
+    """
+    segment_key, segment = item
+    return segment.get("time", 0), segment.get("generation", 0), segment_key
+
+
 class Cloud(object):
     """
     Basic class for cloud access.
@@ -147,10 +379,133 @@ class Cloud(object):
         self.recipients = self.config.config.get(
             "gnupg", "recipients").split(",")
         self.signer = self.config.config.get("gnupg", "signer")
+        self.metadata_layout = "key"
+        self.segment_size = 1000
+        self.max_segments = 16
+        self.segment_grace_period = 3600
+        if self.config.config.has_option("metadata", "layout"):
+            self.metadata_layout = self.config.config.get(
+                "metadata", "layout")
+        if self.metadata_layout not in ["key", "segment", ]:
+            raise ValueError(
+                "Metadata layout must be either 'key' or 'segment'")
+        if self.config.config.has_option("metadata", "segment_size"):
+            self.segment_size = self.config.config.getint(
+                "metadata", "segment_size")
+        if self.config.config.has_option("metadata", "max_segments"):
+            self.max_segments = self.config.config.getint(
+                "metadata", "max_segments")
+        if self.config.config.has_option("metadata", "segment_grace_period"):
+            self.segment_grace_period = self.config.config.getint(
+                "metadata", "segment_grace_period")
+        self._pending_records = dict()
+        self._pending_deleted = set()
+        # Number of segments stored since the number of segments in cloud
+        # was checked.
+        self._flushed_segments = 0
+        self.pack_threshold = 0
+        self.pack_size = 8 * 2**20
+        if self.config.config.has_option("data", "pack_threshold"):
+            self.pack_threshold = self.config.config.getint(
+                "data", "pack_threshold")
+        if self.config.config.has_option("data", "pack_size"):
+            self.pack_size = self.config.config.getint("data", "pack_size")
+        self.chunk_size = 0
+        if self.config.config.has_option("data", "chunk_size"):
+            self.chunk_size = self.config.config.getint("data", "chunk_size")
+        if self.chunk_size:
+            try:
+                check_chunk_size(self.chunk_size)
+            except ValueError as e:
+                raise ConfigError(
+                    "Invalid chunk size: {0}: {1}".format(
+                        self.chunk_size, str(e)))
+        self.compression = None
+        self.compression_level = 6
+        if self.config.config.has_option("data", "compression"):
+            self.compression = self.config.config.get("data", "compression")
+            if self.compression == "none":
+                self.compression = None
+            elif self.compression != "auto":
+                check_method(self.compression)
+        if self.config.config.has_option("data", "compression_level"):
+            self.compression_level = self.config.config.getint(
+                "data", "compression_level")
+        self.data_format = "stream"
+        self.block_size = 2**20
+        if self.config.config.has_option("data", "format"):
+            self.data_format = self.config.config.get("data", "format")
+        if self.data_format not in ["stream", "seekable", ]:
+            raise ValueError(
+                "Data format must be either 'stream' or 'seekable'")
+        if self.config.config.has_option("data", "block_size"):
+            self.block_size = self.config.config.getint("data", "block_size")
+        if not 0 < self.block_size <= MAX_BLOCK_SIZE:
+            raise ValueError("Block size must be between 1 and {0}".format(
+                MAX_BLOCK_SIZE))
+        self.spool_directory = "~/.gpgcloud/spool"
+        if self.config.config.has_option("data", "spool_directory"):
+            self.spool_directory = self.config.config.get(
+                "data", "spool_directory")
+        self.spool_max_age = 7 * 24 * 3600
+        if self.config.config.has_option("data", "spool_max_age"):
+            self.spool_max_age = self.config.config.getint(
+                "data", "spool_max_age")
+        self.encryption_jobs = multiprocessing.cpu_count()
+        if self.config.config.has_option("data", "encryption_jobs"):
+            self.encryption_jobs = self.config.config.getint(
+                "data", "encryption_jobs")
+        self._pool = None
+        self.cryptoengine_connections = 4
+        self.cryptoengine_timeout = 60
+        self.cryptoengine_retries = 3
+        if self.config.config.has_option("cryptoengine", "connections"):
+            self.cryptoengine_connections = self.config.config.getint(
+                "cryptoengine", "connections")
+        if self.config.config.has_option("cryptoengine", "timeout"):
+            self.cryptoengine_timeout = self.config.config.getint(
+                "cryptoengine", "timeout")
+        if self.config.config.has_option("cryptoengine", "retries"):
+            self.cryptoengine_retries = self.config.config.getint(
+                "cryptoengine", "retries")
+        self.cryptoengine_max_failures = 3
+        self.cryptoengine_eject_time = 30
+        self.cryptoengine_slow_factor = 4.0
+        if self.config.config.has_option("cryptoengine", "max_failures"):
+            self.cryptoengine_max_failures = self.config.config.getint(
+                "cryptoengine", "max_failures")
+        if self.config.config.has_option("cryptoengine", "eject_time"):
+            self.cryptoengine_eject_time = self.config.config.getint(
+                "cryptoengine", "eject_time")
+        if self.config.config.has_option("cryptoengine", "slow_factor"):
+            self.cryptoengine_slow_factor = self.config.config.getfloat(
+                "cryptoengine", "slow_factor")
+        self.batch_threshold = 65536
+        self.batch_size = 32
+        if self.config.config.has_option("cryptoengine", "batch_threshold"):
+            self.batch_threshold = self.config.config.getint(
+                "cryptoengine", "batch_threshold")
+        if self.config.config.has_option("cryptoengine", "batch_size"):
+            self.batch_size = self.config.config.getint(
+                "cryptoengine", "batch_size")
+        # Small data waiting to be encrypted in one batch request before it
+        # is added to the current pack, and the entries of the batch by
+        # checksum. Data is only batched by `store_files()`, so that the
+        # metadata returned by the other store methods is complete.
+        self._batching = False
+        self._batch = list()
+        self._batched = dict()
+        self._cryptoengine = None
+        # Checksums of files are calculated again even if the files have
+        # not changed.
+        self.rehash = False
+        self._new_pack()
 
     def _create_metadata(self, key, filename=None, size=0, stat_info=None,
                          checksum=None, encryption_key=None,
-                         encrypted_size=0, encrypted_checksum=None):
+                         encrypted_size=0, encrypted_checksum=None,
+                         pack=None, pack_offset=0, chunks=None,
+                         compression=None):
         metadata = dict(
             metadata_version=METADATA_VERSION,
             provider=self.metadata_provider.__name__, key=key, name=None,
@@ -171,6 +526,13 @@ class Cloud(object):
             metadata["checksum"] = checksum
         if encrypted_checksum is not None:
             metadata["encrypted_checksum"] = encrypted_checksum
+        if pack is not None:
+            metadata["pack"] = pack
+            metadata["pack_offset"] = pack_offset
+        if chunks is not None:
+            metadata["chunks"] = chunks
+        if compression is not None:
+            metadata["compression"] = compression
         return metadata
 
     def connect(self):
@@ -183,34 +545,646 @@ class Cloud(object):
 
     def disconnect(self):
         """
-        Close cloud connection.
+        Close cloud connection. Pending pack and metadata records are
+        stored to cloud first.
         """
+        self.flush_data()
+        self.flush_metadata()
         self.metadata_provider.disconnect()
         self.provider.disconnect()
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if self._cryptoengine is not None:
+            self._cryptoengine.close()
+            self._cryptoengine = None
+
+    def _store_metadata(self, metadata, metadata_provider=None):
+        """
+        Store metadata to cloud. In segment layout the metadata record is
+        stored with other records in the next metadata segment.
+        """
+        if self.metadata_layout == "segment":
+            self._pending_records[metadata["key"]] = metadata
+            self._pending_deleted.discard(metadata["key"])
+            if len(self._pending_records) >= self.segment_size:
+                self.flush_metadata()
+            return
+        if metadata_provider is None:
+            metadata_provider = self.metadata_provider
+        metadata_provider.store(
+            metadata["key"], self._encrypt_metadata(metadata))
+
+    def _new_pack(self):
+        """
+        Start collecting encrypted data to a new pack object.
+        """
+        self._pack_key = PACK_PREFIX + random_string(32, "0123456789abcdef")
+        self._pack = StringIO()
+        self._packed = list()
+        self._packed_data = dict()
 
-    def sync(self):
+    def _is_packed(self, size):
         """
-        Sync metadata database from cloud.
+        Return True if data of given size is stored in a pack object.
         """
-        self.database.drop(provider=self.metadata_provider.__name__)
-        for key, encrypted_metadata in self.metadata_provider.list().items():
-            metadata = gpg.decrypt(encrypted_metadata)
-            if not metadata.ok:
-                raise GPGError(metadata)
-            if not metadata.data:
-                raise MetadataError(key, "No metadata")
-            try:
-                metadata = json.loads(metadata.data)
-            except ValueError as e:
-                raise MetadataError(key, "Invalid metadata: {0}".format(e))
-            if "metadata_version" not in metadata:
-                raise MetadataError(key, "No metadata version available")
-            if metadata["metadata_version"] != METADATA_VERSION:
-                raise MetadataError(
-                    key, "Wrong metadata version: {0} != {1}".format(
-                        metadata["metadata_version"], METADATA_VERSION))
+        return size < self.pack_threshold
+
+    def _add_to_pack(self, encrypted_data):
+        """
+        Add encrypted data to the current pack object. Return tuple of pack
+        key and offset of the data in the pack.
+        """
+        offset = self._pack.tell()
+        self._pack.write(encrypted_data)
+        return self._pack_key, offset
+
+    def _add_to_batch(self, data, metadata):
+        """
+        Add small data to the current batch. The metadata is completed and
+        committed when the batch is encrypted. Metadata of the same data
+        added again is completed with the same encrypted data.
+        """
+        entry = self._batched.get(metadata["checksum"])
+        if entry is not None:
+            entry[1].append(metadata)
+            return
+        entry = (data, [metadata])
+        self._batch.append(entry)
+        self._batched[metadata["checksum"]] = entry
+        if len(self._batch) >= self.batch_size:
+            self._flush_batch()
+
+    def _flush_batch(self):
+        """
+        Encrypt the current batch in one crypto engine request and add the
+        encrypted data to the current pack.
+        """
+        results = self._encrypt_data_batch([data for data, _ in self._batch])
+        batch = self._batch
+        self._batch = list()
+        self._batched = dict()
+        for (_, metadata_list), (encryption_key, encrypted_data,
+                                 encrypted_size, encrypted_checksum,
+                                 compression) in zip(batch, results):
+            pack, pack_offset = self._add_to_pack(encrypted_data)
+            for metadata in metadata_list:
+                metadata.update(
+                    encryption_key=encryption_key,
+                    encrypted_size=encrypted_size,
+                    encrypted_checksum=encrypted_checksum, pack=pack,
+                    pack_offset=pack_offset)
+                if compression is not None:
+                    metadata["compression"] = compression
+                self._commit_metadata(metadata)
+
+    def _find_data(self, checksum):
+        """
+        Return metadata of earlier stored data with given checksum, or None
+        if the data is not stored yet. Data waiting in the current pack is
+        also found.
+        """
+        metadata = self.database.find_one(
+            provider=self.metadata_provider.__name__, checksum=checksum)
+        if metadata:
+            return metadata
+        if checksum in self._packed_data:
+            return self._packed_data[checksum]
+        return self.database.find_chunk(
+            self.metadata_provider.__name__, checksum)
+
+    def _is_chunked(self, size):
+        """
+        Return True if data of given size is stored in chunks.
+        """
+        return self.chunk_size > 0 and size > self.chunk_size
+
+    def _metadata_chunks(self, metadata):
+        """
+        Return the chunk list of chunked data, or None if the data is not
+        stored in chunks.
+        """
+        if "chunks" in metadata:
+            return metadata["chunks"]
+        if not metadata.get("chunked"):
+            return None
+        return [dict((field, chunk.get(field)) for field in CHUNK_FIELDS)
+                for chunk in self.database.chunks(
+                    metadata["provider"], metadata["key"])]
+
+    def _find_chunk(self, checksum):
+        """
+        Return encryption details of earlier stored data object with given
+        checksum, or None if there is no such object.
+        """
+        chunk = self.database.find_chunk(
+            self.metadata_provider.__name__, checksum)
+        if chunk:
+            return chunk
+        for metadata in self.database.find(
+                provider=self.metadata_provider.__name__, checksum=checksum):
+            if not metadata.get("pack") and not metadata.get("chunked"):
+                return metadata
+        return None
+
+    def _store_chunk(self, data, checksum, provider):
+        """
+        Encrypt chunk and store it to cloud using its checksum as key.
+        Return encryption details of the chunk.
+        """
+        (encryption_key, encrypted_data, encrypted_size,
+         encrypted_checksum, compression) = self._encrypt_data(data)
+        provider.store(checksum, encrypted_data)
+        return dict(checksum=checksum, encryption_key=encryption_key,
+                    encrypted_size=encrypted_size,
+                    encrypted_checksum=encrypted_checksum,
+                    compression=compression)
+
+    def _chunk_stream(self, plaintext_fp, size):
+        """
+        Split data of given size to content-defined chunks. Chunk boundaries
+        of data larger than one segment are searched on the process pool.
+        """
+        pool = self._process_pool() if size > SEGMENT_SIZE else None
+        return chunk_stream(plaintext_fp, self.chunk_size, pool=pool,
+                            window=2 * self.encryption_jobs)
+
+    def _store_chunks(self, plaintext_fp, size):
+        """
+        Split data to content-defined chunks and store the chunks that are
+        not stored yet to cloud. Each chunk is encrypted separately and
+        stored using its checksum as key. Return the chunk list.
+        """
+        chunks = list()
+        stored = dict()
+        for data in self._chunk_stream(plaintext_fp, size):
+            checksum = checksum_data(data)
+            chunk = stored.get(checksum) or self._find_chunk(checksum)
+            if chunk is None:
+                chunk = self._store_chunk(data, checksum, self.provider)
+            chunk = dict((field, chunk.get(field)) for field in CHUNK_FIELDS
+                         if field != "size")
+            chunk["size"] = len(data)
+            stored[checksum] = chunk
+            chunks.append(chunk)
+        return chunks
+
+    def _retrieve_chunk(self, provider, chunk):
+        """
+        Retrieve one chunk from cloud and decrypt it. Return data as
+        string.
+        """
+        encrypted_data = provider.retrieve(chunk["checksum"])
+        encrypted_checksum = checksum_data(encrypted_data or "")
+        if encrypted_checksum != chunk["encrypted_checksum"]:
+            raise DataError(
+                chunk["checksum"],
+                "Wrong encrypted data checksum: {0} != {1}".format(
+                    encrypted_checksum, chunk["encrypted_checksum"]))
+        data, checksum = self._decrypt_data(
+            encrypted_data, chunk["encryption_key"], chunk.get("compression"))
+        if checksum != chunk["checksum"]:
+            raise DataError(
+                chunk["checksum"],
+                "Wrong data checksum: {0} != {1}".format(
+                    checksum, chunk["checksum"]))
+        return str(data)
+
+    def _retrieve_chunks(self, chunks, plaintext_fp, jobs=1, provider=None):
+        """
+        Retrieve chunks from cloud concurrently and write them to given
+        stream in order. Return checksum of the data.
+        """
+        if provider is None:
+            provider = self.provider
+        sha256 = hashlib.sha256()
+        if jobs > 1:
+            providers = ThreadProviders(provider)
+            pool = multiprocessing.pool.ThreadPool(jobs)
+            retrieve = lambda chunk: self._retrieve_chunk(
+                providers.get(), chunk)
+        try:
+            # Retrieve a few chunks at a time to limit memory usage.
+            window = 2 * jobs
+            for i in range(0, len(chunks), window):
+                if jobs > 1:
+                    results = pool.map(retrieve, chunks[i:i + window])
+                else:
+                    results = [self._retrieve_chunk(provider, chunk)
+                               for chunk in chunks[i:i + window]]
+                for data in results:
+                    sha256.update(data)
+                    plaintext_fp.write(data)
+        finally:
+            if jobs > 1:
+                pool.terminate()
+                pool.join()
+                providers.disconnect()
+        return sha256.hexdigest()
+
+    def _delete_unused_data(self, checksum):
+        """
+        Delete data object with given checksum from cloud if no file or
+        chunk refers to it anymore.
+        """
+        provider = self.metadata_provider.__name__
+        if not self.database.find_one(provider=provider, checksum=checksum) \
+                and not self.database.find_chunk(provider, checksum):
+            self.provider.delete(checksum)
+
+    def _commit_metadata(self, metadata):
+        """
+        Store metadata to cloud and update database. If the data is in the
+        current pack, metadata is stored after the pack has been stored.
+        """
+        if metadata.get("pack") == self._pack_key:
+            self._packed.append(metadata)
+            self._packed_data.setdefault(metadata["checksum"], metadata)
+            if self._pack.tell() >= self.pack_size:
+                self.flush_data()
+            return
+        self._store_metadata(metadata)
+        self.database.update(metadata)
+
+    def flush_data(self):
+        """
+        Encrypt the current batch, and store the current pack object to
+        cloud, and then the metadata of the files in it.
+        """
+        if self._batch:
+            self._flush_batch()
+        if not self._packed:
+            return
+        self.provider.store(self._pack_key, self._pack.getvalue())
+        packed = self._packed
+        self._new_pack()
+        for metadata in packed:
+            self._store_metadata(metadata)
             self.database.update(metadata)
 
+    def _retrieve_data(self, metadata, provider=None):
+        """
+        Retrieve encrypted data from cloud. Return data as string.
+        """
+        if provider is None:
+            provider = self.provider
+        if metadata.get("pack"):
+            return provider.retrieve_range(
+                metadata["pack"], metadata["pack_offset"],
+                metadata["encrypted_size"])
+        return provider.retrieve(metadata["checksum"])
+
+    def _open_data_reader(self, metadata, provider=None):
+        """
+        Open readable stream of encrypted data from cloud. Packed data is
+        small, so it is read with one ranged request.
+        """
+        if metadata.get("pack"):
+            return StringIO(self._retrieve_data(metadata, provider))
+        if provider is None:
+            provider = self.provider
+        return provider.open_reader(metadata["checksum"])
+
+    def _delete_metadata(self, metadata):
+        """
+        Delete metadata from cloud. Records stored in metadata segments are
+        deleted by storing a deletion record to the next segment.
+        """
+        key = metadata["key"]
+        provider = self.metadata_provider.__name__
+        version = self.database.sync_version(provider, key)
+        if self._pending_records.pop(key, None) is not None and not version:
+            return
+        if version and version.startswith(SEGMENT_SYNC_VERSION):
+            self._pending_deleted.add(key)
+            self.database.delete_sync_version(provider, key)
+            if len(self._pending_deleted) >= self.segment_size:
+                self.flush_metadata()
+        else:
+            self.metadata_provider.delete(key)
+
+    def _segment_keys(self, key_infos):
+        """
+        Return the keys of metadata segments in given key listing.
+        """
+        return [key for key in key_infos
+                if key.startswith(SEGMENT_PREFIX) and key != SEGMENT_INDEX_KEY]
+
+    def _retrieve_segment(self, segment_key):
+        """
+        Retrieve metadata segment from cloud. Return None if the segment has
+        been deleted after it was listed.
+        """
+        try:
+            encrypted_segment = self.metadata_provider.retrieve(segment_key)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            encrypted_segment = None
+        if not encrypted_segment:
+            return None
+        return self._decrypt_metadata(
+            segment_key, encrypted_segment, SEGMENT_METADATA_VERSION)
+
+    def _store_segment(self, records, deleted, segment_time=None,
+                       generation=0, replaces=()):
+        """
+        Store metadata records and deleted metadata keys to cloud as a new
+        metadata segment. Segments are applied in the order of their time
+        and generation. Compacted segments list the segments they replace.
+        Return the key of the segment.
+        """
+        segment_key = SEGMENT_PREFIX + random_string(32, "0123456789abcdef")
+        if segment_time is None:
+            segment_time = time.time()
+        segment = dict(metadata_version=SEGMENT_METADATA_VERSION,
+                       records=records, deleted=deleted, time=segment_time,
+                       generation=generation, replaces=list(replaces),
+                       stored_time=time.time())
+        self.metadata_provider.store(
+            segment_key, self._encrypt_metadata(segment))
+        return segment_key
+
+    def flush_metadata(self):
+        """
+        Store pending metadata records to cloud as a new metadata segment.
+        Segments are compacted when there are too many of them, which is
+        checked after every `max_segments` stored segments.
+        """
+        if not self._pending_records and not self._pending_deleted:
+            return
+        provider = self.metadata_provider.__name__
+        records = self._pending_records.values()
+        segment_key = self._store_segment(
+            records, list(self._pending_deleted))
+        for metadata in records:
+            self.database.update_sync_version(
+                provider, metadata["key"], SEGMENT_SYNC_VERSION + segment_key)
+        self._pending_records = dict()
+        self._pending_deleted = set()
+        self._flushed_segments += 1
+        if self._flushed_segments >= self.max_segments:
+            self._flushed_segments = 0
+            segment_keys = self._segment_keys(
+                self.metadata_provider.list_keys())
+            if len(segment_keys) > self.max_segments:
+                self._compact_segments(segment_keys)
+
+    def _compact_segments(self, segment_keys):
+        """
+        Merge given metadata segments into as few new segments as possible.
+        Deleted records are dropped. The new segments replace the merged
+        segments, and they are applied after them. Segments stored
+        concurrently by other clients are not replaced. Replaced segments
+        are deleted `segment_grace_period` seconds after they were
+        replaced, so that clients syncing at the same time can still
+        retrieve them.
+        """
+        segments = dict()
+        for segment_key in segment_keys:
+            segment = self._retrieve_segment(segment_key)
+            if segment is not None:
+                segments[segment_key] = segment
+        replaced = set()
+        expired = set()
+        oldest = time.time() - self.segment_grace_period
+        for segment in segments.values():
+            replaced.update(segment.get("replaces", []))
+            if segment.get("stored_time", 0) <= oldest:
+                expired.update(segment.get("replaces", []))
+        for segment_key in expired & set(segments):
+            self.metadata_provider.delete(segment_key)
+            del segments[segment_key]
+        merged = [(segment_key, segment)
+                  for segment_key, segment in segments.items()
+                  if segment_key not in replaced]
+        if len(merged) < 2:
+            return
+
+        records = dict()
+        for _, segment in sorted(merged, key=_segment_order):
+            for metadata in segment["records"]:
+                records[metadata["key"]] = metadata
+            for key in segment["deleted"]:
+                records.pop(key, None)
+        records = records.values()
+        segment_time = max(_segment_order(item)[0] for item in merged)
+        generation = max(_segment_order(item)[1] for item in merged) + 1
+        # At least one segment is stored, so that the replaced segments are
+        # known even if all records are deleted.
+        for i in range(0, len(records) or 1, self.segment_size):
+            self._store_segment(
+                records[i:i + self.segment_size], list(), segment_time,
+                generation, segments)
+        if self.segment_grace_period <= 0:
+            for segment_key in segments:
+                self.metadata_provider.delete(segment_key)
+
+    def compact_metadata(self):
+        """
+        Store pending metadata records and compact all metadata segments.
+        """
+        self.flush_metadata()
+        key_infos = self.metadata_provider.list_keys()
+        if SEGMENT_INDEX_KEY in key_infos:
+            self.metadata_provider.delete(SEGMENT_INDEX_KEY)
+        self._compact_segments(self._segment_keys(key_infos))
+
+    def _decrypt_metadata(self, key, encrypted_metadata,
+                          metadata_version=METADATA_VERSION):
+        """
+        Decrypt and verify metadata retrieved from cloud.
+        """
+        metadata = gpg.decrypt(encrypted_metadata)
+        if not metadata.ok:
+            raise GPGError(metadata)
+        if not metadata.data:
+            raise MetadataError(key, "No metadata")
+        try:
+            metadata = json.loads(metadata.data)
+        except ValueError as e:
+            raise MetadataError(key, "Invalid metadata: {0}".format(e))
+        if "metadata_version" not in metadata:
+            raise MetadataError(key, "No metadata version available")
+        if metadata["metadata_version"] != metadata_version:
+            raise MetadataError(
+                key, "Wrong metadata version: {0} != {1}".format(
+                    metadata["metadata_version"], metadata_version))
+        return metadata
+
+    def _metadata_version(self, key_info):
+        """
+        Return version of cloud metadata object from the key listing. The
+        version changes whenever the object is rewritten. Return None for
+        objects modified so recently that they may still be rewritten
+        without changing their listed size and modification time. They are
+        retrieved in every sync, and their version is not stored until it
+        is known.
+        """
+        if key_info.get("modified_recently"):
+            return None
+        return "{0}:{1}:{2}".format(
+            key_info.get("etag"), key_info["size"], key_info["last_modified"])
+
+    def sync(self, full=False, jobs=1, batch_size=1000, lock=None):
+        """
+        Sync metadata database from cloud. Only metadata objects that are
+        new or have changed since the previous sync are retrieved, and
+        metadata for objects removed from cloud is removed from database.
+        If `full` is set, database is dropped and all metadata is retrieved.
+
+        Up to `jobs` metadata objects are retrieved and decrypted
+        concurrently. Database is updated in transactions of `batch_size`
+        metadata entries.
+
+        Database and pending metadata records are accessed only while
+        holding `lock`, and metadata is listed and retrieved without
+        holding it, so that other threads can store data during the sync.
+        Only metadata found in database before the listing is removed.
+        """
+        provider = self.metadata_provider.__name__
+        if lock is None:
+            lock = threading.RLock()
+        with lock:
+            self.flush_metadata()
+            if full:
+                self.database.drop(provider=provider)
+            synced_versions = self.database.sync_versions(provider)
+            database_keys = [metadata["key"] for metadata in
+                             self.database.list(provider=provider)]
+        key_infos = self.metadata_provider.list_keys()
+        self._sync_segments(key_infos, synced_versions, batch_size, lock)
+
+        # Remove metadata that is no longer found in cloud.
+        with lock:
+            for key in database_keys:
+                if key not in key_infos and not synced_versions.get(
+                        key, "").startswith(SEGMENT_SYNC_VERSION):
+                    self.database.delete(key, provider=provider)
+            for key, version in synced_versions.items():
+                if key not in key_infos and not version.startswith(
+                        SEGMENT_SYNC_VERSION):
+                    self.database.delete_sync_version(provider, key)
+
+        changed = list()
+        for key, key_info in key_infos.items():
+            if key.startswith(SEGMENT_PREFIX):
+                continue
+            version = self._metadata_version(key_info)
+            if version is None or synced_versions.get(key) != version:
+                changed.append((key, version))
+
+        if jobs > 1:
+            providers = ThreadProviders(self.metadata_provider)
+            get_provider = providers.get
+        else:
+            get_provider = lambda: self.metadata_provider
+
+        def retrieve(item):
+            key, version = item
+            metadata = self._decrypt_metadata(
+                key, get_provider().retrieve(key))
+            return metadata, version
+
+        if jobs > 1:
+            pool = multiprocessing.pool.ThreadPool(jobs)
+            results = pool.imap_unordered(retrieve, changed)
+        else:
+            results = itertools.imap(retrieve, changed)
+        try:
+            synced = list()
+            for result in results:
+                synced.append(result)
+                if len(synced) >= batch_size:
+                    with lock:
+                        self.database.update_synced(provider, synced)
+                    synced = list()
+            with lock:
+                self.database.update_synced(provider, synced)
+        finally:
+            if jobs > 1:
+                pool.terminate()
+                pool.join()
+                providers.disconnect()
+
+    def _sync_segments(self, key_infos, synced_versions, batch_size, lock):
+        """
+        Sync metadata records stored in metadata segments. Only segments
+        that have not been synced before are retrieved, and they are applied
+        in segment order. A new compacted segment is ordered before segments
+        synced earlier, so then all segments are applied again. Database is
+        updated while holding `lock`.
+        """
+        provider = self.metadata_provider.__name__
+        segment_versions = dict(
+            (key, self._metadata_version(key_infos[key]))
+            for key in self._segment_keys(key_infos))
+        vanished = [key for key in synced_versions
+                    if key.startswith(SEGMENT_PREFIX) and
+                    key not in segment_versions]
+        new_keys = [key for key, version in segment_versions.items()
+                    if version is None or synced_versions.get(key) != version]
+        if not vanished and not new_keys:
+            return
+
+        segments = list()
+        for segment_key in new_keys:
+            segment = self._retrieve_segment(segment_key)
+            if segment is None:
+                # Replaced segment was deleted after it was listed.
+                del segment_versions[segment_key]
+                continue
+            segments.append((segment_key, segment))
+        resync = any(segment.get("replaces") for _, segment in segments)
+        if resync:
+            for segment_key in set(segment_versions) - set(new_keys):
+                segment = self._retrieve_segment(segment_key)
+                if segment is None:
+                    del segment_versions[segment_key]
+                    continue
+                segments.append((segment_key, segment))
+
+        records = dict()
+        deleted = set()
+        for segment_key, segment in sorted(segments, key=_segment_order):
+            for metadata in segment["records"]:
+                records[metadata["key"]] = (
+                    metadata, SEGMENT_SYNC_VERSION + segment_key)
+                deleted.discard(metadata["key"])
+            for key in segment["deleted"]:
+                records.pop(key, None)
+                deleted.add(key)
+
+        # Remove records of vanished segments that are not found in any
+        # new segment, and records deleted in new segments. When all
+        # segments are applied again, records not found in any segment are
+        # removed.
+        for segment_key in vanished:
+            for key, version in synced_versions.items():
+                if version == SEGMENT_SYNC_VERSION + segment_key:
+                    deleted.add(key)
+        if resync:
+            deleted.update(key for key, version in synced_versions.items()
+                           if version.startswith(SEGMENT_SYNC_VERSION))
+        with lock:
+            for segment_key in vanished:
+                self.database.delete_sync_version(provider, segment_key)
+            for key in deleted - set(records):
+                self.database.delete(key, provider=provider)
+                self.database.delete_sync_version(provider, key)
+
+        records = records.values()
+        for i in range(0, len(records), batch_size):
+            with lock:
+                self.database.update_synced(
+                    provider, records[i:i + batch_size])
+        with lock:
+            for segment_key, version in segment_versions.items():
+                if version is not None:
+                    self.database.update_sync_version(
+                        provider, segment_key, version)
+
     def list(self):
         """
         List metadata from database.
@@ -233,28 +1207,35 @@ class Cloud(object):
         """
         return self.database.find_one(**filter)
 
+    def _cryptoengine_client(self):
+        """
+        Return client for crypto engine API. Requests are balanced over all
+        configured servers. Connections of the client are kept open until
+        the cloud is disconnected.
+        """
+        if self._cryptoengine is None:
+            self._cryptoengine = CryptoEngineClient(
+                [api_url.strip() for api_url in self.config.config.get(
+                    "cryptoengine", "api_url").split(",")],
+                self.cryptoengine_connections, self.cryptoengine_timeout,
+                self.cryptoengine_retries,
+                max_failures=self.cryptoengine_max_failures,
+                eject_time=self.cryptoengine_eject_time,
+                slow_factor=self.cryptoengine_slow_factor)
+        return self._cryptoengine
+
     def _cryptoengine_encrypt(self, data, encryption_key):
         """
-        Encrypt data in crypto engine server.
+        Encrypt data in crypto engine server. Encrypted data is returned as
+        raw bytes.
         """
-        data = urllib.urlencode(
-            {'data': base64.encodestring(data), 'key': encryption_key, })
-        u = urllib2.urlopen(
-            self.config.config.get("cryptoengine", "api_url") + '/encrypt',
-            data)
-        return json.loads(u.read())
+        return self._cryptoengine_client().encrypt(data, encryption_key)
 
     def _cryptoengine_decrypt(self, data, encryption_key):
         """
         Decrypt data in crypto engine server.
         """
-        data = urllib.urlencode({'data': data, 'key': encryption_key, })
-        u = urllib2.urlopen(
-            self.config.config.get("cryptoengine", "api_url") + '/decrypt',
-            data)
-        result = json.loads(u.read())
-        result["data"] = base64.decodestring(result["data"])
-        return result
+        return self._cryptoengine_client().decrypt(data, encryption_key)
 
     def _encrypt_gpg(self, data):
         encryption_key = None
@@ -267,168 +1248,527 @@ class Cloud(object):
         return (encryption_key, encrypted_data.data, encrypted_size,
                 encrypted_checksum)
 
-    def _encrypt_file_gpg(self, plaintext_file, encrypted_file):
+    def _encrypt_file_gpg(self, plaintext_fp, encrypted_fp):
+        # GPG can only write its output to a file, copy it from there.
         encryption_key = None
+        encrypted_file = tempfile.NamedTemporaryFile()
         encrypted_data = gpg.encrypt_file(
-            file(plaintext_file), self.recipients, sign=self.signer,
-            output=encrypted_file)
+            plaintext_fp, self.recipients, sign=self.signer,
+            output=encrypted_file.name)
         if not encrypted_data.ok:
             raise GPGError(encrypted_data)
-        encrypted_stat_info = os.stat(encrypted_file)
-        encrypted_checksum = checksum_file(encrypted_file)
-        encrypted_size = encrypted_stat_info.st_size
-        return (encryption_key, encrypted_size, encrypted_checksum)
+        shutil.copyfileobj(file(encrypted_file.name), encrypted_fp, 2**20)
+        encrypted_file.close()
+        return encryption_key
 
     def _encrypt_symmetric(self, data):
         encryption_key = generate_random_password()
-        plaintext_fp = StringIO(data)
-        encrypted_fp = StringIO()
-        encrypt(plaintext_fp, encrypted_fp, encryption_key)
-        encrypted_fp.seek(0)
-        encrypted_data = encrypted_fp.read()
-        base64_data = base64.encodestring(encrypted_data)
-        base64_size = len(base64_data)
-        encrypted_checksum = checksum_data(base64_data)
-        return (encryption_key, base64_data, base64_size,
+        _, _, encrypted_data = encrypt_buffer(
+            data, encryption_key, header=BINARY_MAGIC)
+        encrypted_size = len(encrypted_data)
+        encrypted_checksum = checksum_data(encrypted_data)
+        return (encryption_key, encrypted_data, encrypted_size,
                 encrypted_checksum)
 
     def _encrypt_cryptoengine(self, data):
         encryption_key = generate_random_password()
         result = self._cryptoengine_encrypt(data, encryption_key)
-        base64_data = result["encrypted_data"]
-        base64_size = len(base64_data)
+        encrypted_data = result["encrypted_data"]
+        encrypted_size = len(encrypted_data)
         encrypted_checksum = result["encrypted_checksum"]
-        return (encryption_key, base64_data, base64_size,
+        return (encryption_key, encrypted_data, encrypted_size,
                 encrypted_checksum)
 
-    def _encrypt_file_symmetric(self, plaintext_file, encrypted_file):
+    def _process_pool(self):
+        """
+        Return process pool of `encryption_jobs` processes, or None if work
+        is done in the calling process. Worker processes of
+        `ParallelBackup` can not have their own pools.
+        """
+        if self.encryption_jobs < 2 or \
+                multiprocessing.current_process().daemon:
+            return None
+        if self._pool is None:
+            self._pool = encryption_pool(self.encryption_jobs)
+        return self._pool
+
+    def _encryption_pool(self):
+        """
+        Return process pool for encrypting and decrypting blocks with
+        multicore encryption method, or None if blocks are processed in the
+        calling process.
+        """
+        if self.provider.encryption_method != "multicore":
+            return None
+        return self._process_pool()
+
+    def _encrypt_seekable(self, data, compression):
+        encryption_key = generate_random_password()
+        encrypted_fp = BufferWriter()
+        _, encrypted_checksum = encrypt_seekable(
+            BufferReader(data), encrypted_fp, encryption_key,
+            self.block_size, compression, self.compression_level,
+            pool=self._encryption_pool(), window=2 * self.encryption_jobs)
+        encrypted_data = encrypted_fp.buffer
+        return (encryption_key, encrypted_data, len(encrypted_data),
+                encrypted_checksum)
+
+    def _encrypt_file_symmetric(self, plaintext_fp, encrypted_fp):
         encryption_key = generate_random_password()
-        plaintext_fp = file(plaintext_file)
-        encrypted_fp = tempfile.TemporaryFile()
+        encrypted_fp.write(BINARY_MAGIC)
         encrypt(plaintext_fp, encrypted_fp, encryption_key)
-        encrypted_fp.flush()
-        encrypted_fp.seek(0)
-        base64_fp = file(encrypted_file, "wb")
-        base64.encode(encrypted_fp, base64_fp)
-        base64_fp.close()
-        encrypted_fp.close()
-        plaintext_fp.close()
-        encrypted_stat_info = os.stat(encrypted_file)
-        encrypted_size = encrypted_stat_info.st_size
-        encrypted_checksum = checksum_file(encrypted_file)
-        return (encryption_key, encrypted_size, encrypted_checksum)
+        return encryption_key
 
-    def _encrypt_file_cryptoengine(self, plaintext_file, encrypted_file):
+    def _encrypt_file_seekable(self, plaintext_fp, encrypted_fp,
+                               compression):
         encryption_key = generate_random_password()
-        data = file(plaintext_file).read()
+        encrypt_seekable(plaintext_fp, encrypted_fp, encryption_key,
+                         self.block_size, compression, self.compression_level,
+                         pool=self._encryption_pool(),
+                         window=2 * self.encryption_jobs)
+        return encryption_key
+
+    def _encrypt_file_cryptoengine(self, plaintext_fp, encrypted_fp):
+        encryption_key = generate_random_password()
+        client = self._cryptoengine_client()
+        if client.streaming:
+            client.encrypt_file(plaintext_fp, encrypted_fp, encryption_key)
+            return encryption_key
+        data = plaintext_fp.read()
         result = self._cryptoengine_encrypt(data, encryption_key)
-        base64_data = result["encrypted_data"]
-        base64_size = len(base64_data)
-        encrypted_checksum = result["encrypted_checksum"]
-        encrypted_fp = file(encrypted_file, "wb")
-        encrypted_fp.write(base64_data)
-        encrypted_fp.close()
-        return (encryption_key, base64_size, encrypted_checksum)
+        encrypted_fp.write(result["encrypted_data"])
+        return encryption_key
+
+    def _encrypt_metadata(self, metadata):
+        """
+        Encrypt and sign metadata with GPG.
+        """
+        encrypted_metadata = gpg.encrypt(
+            json.dumps(metadata), self.recipients, sign=self.signer)
+        if not encrypted_metadata.ok:
+            raise GPGError(encrypted_metadata)
+        return encrypted_metadata.data
+
+    def _checksum_file(self, filename, cloud_filename):
+        """
+        Calculate the metadata key and the data checksum for given file.
+        """
+        return checksums_file(filename, cloud_filename)
+
+    def _cached_checksums(self, cloud_filename, stat_info):
+        """
+        Return the metadata key and the data checksum calculated earlier
+        for the file, or None if the file may have changed.
+        """
+        if self.rehash:
+            return None
+        return self.database.cached_checksums(cloud_filename, stat_info)
+
+    def _find_unchanged(self, key, stat_info):
+        """
+        Return metadata of the file if it is already stored to cloud with
+        the same data and attributes, otherwise None.
+        """
+        if self.rehash:
+            return None
+        metadata = self.database.find_one(
+            provider=self.metadata_provider.__name__, key=key)
+        if metadata and metadata["mode"] == stat_info.st_mode and \
+                metadata["mtime"] == stat_info.st_mtime:
+            return metadata
+        return None
+
+    def _select_compression(self, sample):
+        """
+        Return compression method for data starting with given sample, or
+        None if data is not compressed. GPG compresses data itself, so data
+        is compressed only with the other encryption methods.
+        """
+        if self.compression is None or \
+                self.provider.encryption_method == "gpg":
+            return None
+        if self.compression == "auto":
+            if is_compressible(sample):
+                return "zlib"
+            return None
+        return self.compression
+
+    def _is_seekable(self):
+        """
+        Return True if data is encrypted into seekable containers. They are
+        always used with multicore encryption, and optionally with symmetric
+        encryption.
+        """
+        if self.provider.encryption_method == "multicore":
+            return True
+        return self.data_format == "seekable" and \
+            self.provider.encryption_method == "symmetric"
+
+    def _encrypt_file(self, plaintext_file, encrypted_fp):
+        """
+        Compress and encrypt file using the encryption method of the data
+        provider and write the encrypted data to given stream. Return tuple
+        of encryption key, encrypted data size, encrypted data checksum and
+        compression method.
+        """
+        plaintext_fp = file(plaintext_file, "rb")
+        compression = self._select_compression(plaintext_fp.read(SAMPLE_SIZE))
+        plaintext_fp.seek(0)
+        if compression is not None and not self._is_seekable():
+            plaintext_fp = CompressReader(
+                plaintext_fp, compression, self.compression_level)
+        checksum_fp = ChecksumWriter(encrypted_fp)
+        try:
+            if self._is_seekable():
+                encryption_key = self._encrypt_file_seekable(
+                    plaintext_fp, checksum_fp, compression)
+                # Seekable container compresses each block separately.
+                compression = None
+            elif self.provider.encryption_method == "symmetric":
+                encryption_key = self._encrypt_file_symmetric(
+                    plaintext_fp, checksum_fp)
+            elif self.provider.encryption_method == "cryptoengine":
+                encryption_key = self._encrypt_file_cryptoengine(
+                    plaintext_fp, checksum_fp)
+            else:
+                encryption_key = self._encrypt_file_gpg(
+                    plaintext_fp, checksum_fp)
+        finally:
+            plaintext_fp.close()
+        return (encryption_key, checksum_fp.size, checksum_fp.hexdigest(),
+                compression)
+
+    def _spool_filename(self, checksum):
+        """
+        Return filename of the spooled encrypted data of given checksum.
+        """
+        return os.path.join(
+            os.path.expanduser(self.spool_directory), checksum)
+
+    def _spool_info(self, spool_filename):
+        """
+        Return size, modification time and inode of spooled encrypted data.
+        """
+        stat_info = os.stat(spool_filename)
+        return dict(size=stat_info.st_size, mtime=stat_info.st_mtime,
+                    inode=stat_info.st_ino)
+
+    def _encrypt_to_spool(self, filename, checksum):
+        """
+        Encrypt file to the spool directory, where the encrypted data and
+        its encryption details are kept until `_remove_spool()` is called.
+        If the file has already been encrypted by an interrupted backup,
+        the same encrypted file is used again, so that its upload can be
+        resumed. Spooled data is not read again, the upload journal checks
+        the parts already uploaded. Spooled data that has changed since it
+        was encrypted is removed and encrypted again. Return tuple of
+        encrypted filename and the results of `_encrypt_file()`.
+        """
+        spool_filename = self._spool_filename(checksum)
+        encryption_method = [self.provider.encryption_method,
+                             self._is_seekable()]
+        try:
+            info = json.load(file(spool_filename + ".json"))
+            if info["encryption_method"] == encryption_method and \
+                    info["spool"] == self._spool_info(spool_filename):
+                encryption_key = info["encryption_key"]
+                if encryption_key is not None:
+                    encryption_key = gpg.decrypt(encryption_key)
+                    if not encryption_key.ok:
+                        raise GPGError(encryption_key)
+                    encryption_key = encryption_key.data
+                return (spool_filename, encryption_key,
+                        info["encrypted_size"], info["encrypted_checksum"],
+                        info["compression"])
+        except (IOError, OSError, ValueError, KeyError, GPGError):
+            pass
+        self._remove_spool(checksum)
+        directory = os.path.dirname(spool_filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        encrypted_fp = tempfile.NamedTemporaryFile(
+            dir=directory, prefix=checksum + ".", delete=False)
+        os.fchmod(encrypted_fp.fileno(), 0600)
+        try:
+            (encryption_key, encrypted_size, encrypted_checksum,
+             compression) = self._encrypt_file(filename, encrypted_fp)
+            encrypted_fp.close()
+            os.rename(encrypted_fp.name, spool_filename)
+        except:
+            encrypted_fp.close()
+            os.remove(encrypted_fp.name)
+            raise
+        # Encryption key is stored encrypted with GPG like metadata.
+        encrypted_key = None
+        if encryption_key is not None:
+            encrypted_key = gpg.encrypt(
+                encryption_key, self.recipients, sign=self.signer)
+            if not encrypted_key.ok:
+                raise GPGError(encrypted_key)
+            encrypted_key = encrypted_key.data
+        info_fp = tempfile.NamedTemporaryFile(
+            dir=directory, prefix=checksum + ".", delete=False)
+        os.fchmod(info_fp.fileno(), 0600)
+        json.dump(dict(encryption_method=encryption_method,
+                       encryption_key=encrypted_key,
+                       encrypted_size=encrypted_size,
+                       encrypted_checksum=encrypted_checksum,
+                       compression=compression,
+                       spool=self._spool_info(spool_filename)), info_fp)
+        info_fp.close()
+        os.rename(info_fp.name, spool_filename + ".json")
+        return (spool_filename, encryption_key, encrypted_size,
+                encrypted_checksum, compression)
+
+    def _remove_spool(self, checksum):
+        """
+        Remove spooled encrypted data after it has been stored to cloud.
+        """
+        spool_filename = self._spool_filename(checksum)
+        for filename in (spool_filename + ".json", spool_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def clean_spool(self):
+        """
+        Remove spooled encrypted data and encryption keys left by backups
+        that were interrupted more than `spool_max_age` seconds ago.
+        """
+        directory = os.path.expanduser(self.spool_directory)
+        if not os.path.isdir(directory):
+            return
+        oldest = time.time() - self.spool_max_age
+        for filename in os.listdir(directory):
+            filename = os.path.join(directory, filename)
+            try:
+                if os.path.getmtime(filename) < oldest:
+                    os.remove(filename)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _store_spooled(self, filename, checksum, provider):
+        """
+        Encrypt file to the spool directory and store it to cloud with
+        resumable upload. If the upload is interrupted, the encrypted file
+        is kept, so that storing the same file again continues the upload.
+        Return the results of `_encrypt_file()`.
+        """
+        result = self._encrypt_to_spool(filename, checksum)
+        provider.store_from_filename(checksum, result[0])
+        self._remove_spool(checksum)
+        return result[1:]
+
+    def _encrypt_data(self, data):
+        """
+        Compress and encrypt data using the encryption method of the data
+        provider. Return tuple of encryption key, encrypted data, encrypted
+        data size, encrypted data checksum and compression method.
+        """
+        compression = self._select_compression(data[:SAMPLE_SIZE])
+        if self._is_seekable():
+            # Seekable container compresses each block separately.
+            return self._encrypt_seekable(data, compression) + (None, )
+        if compression is not None:
+            data = compress(data, compression, self.compression_level)
+        if self.provider.encryption_method == "symmetric":
+            result = self._encrypt_symmetric(data)
+        elif self.provider.encryption_method == "cryptoengine":
+            result = self._encrypt_cryptoengine(data)
+        else:
+            result = self._encrypt_gpg(data)
+        return result + (compression, )
+
+    def _is_batched(self, size):
+        """
+        Return True if data of given size is encrypted in batches with
+        other small data.
+        """
+        return self.provider.encryption_method == "cryptoengine" and \
+            size < self.batch_threshold
+
+    def _encrypt_data_batch(self, data_list):
+        """
+        Compress and encrypt list of small data items in one crypto engine
+        batch request. Return list of tuples like `_encrypt_data()`.
+        """
+        items = list()
+        compressions = list()
+        for data in data_list:
+            compression = self._select_compression(data[:SAMPLE_SIZE])
+            if compression is not None:
+                data = compress(data, compression, self.compression_level)
+            items.append((data, generate_random_password()))
+            compressions.append(compression)
+        results = self._cryptoengine_client().encrypt_batch(items)
+        return [(encryption_key, result["encrypted_data"],
+                 len(result["encrypted_data"]), result["encrypted_checksum"],
+                 compression)
+                for (_, encryption_key), result, compression in zip(
+                    items, results, compressions)]
+
+    def _store_batched(self, data, key, cloud_filename, size, stat_info,
+                       checksum):
+        """
+        Add small data to the current batch. Return its metadata, which is
+        completed when the batch is encrypted, at the latest before
+        `store_files()` returns.
+        """
+        metadata = self._create_metadata(
+            key, filename=cloud_filename, size=size, stat_info=stat_info,
+            checksum=checksum)
+        self._add_to_batch(data, metadata)
+        return metadata
 
     def store(self, data, cloud_filename, stat_info=None):
         """
-        Encrypt data and store it to cloud.
+        Encrypt data and store it to cloud. Return complete metadata of the
+        data, even if the data itself is stored later in a pack object.
         """
-        key = checksum_data(data + cloud_filename)
-        checksum = checksum_data(data)
+        key, checksum = checksums_data(data, cloud_filename)
         size = len(data)
 
         # Do we have the data already stored into cloud?
-        old_metadata = self.database.find_one(
-            provider=self.metadata_provider.__name__, checksum=checksum)
+        old_metadata = self._find_data(checksum)
+        pack, pack_offset, chunks, compression = None, 0, None, None
+        encrypted_data = None
         if old_metadata:
-            encrypted_data = None
             encryption_key = old_metadata["encryption_key"]
             encrypted_checksum = old_metadata["encrypted_checksum"]
             encrypted_size = old_metadata["encrypted_size"]
+            pack = old_metadata.get("pack")
+            pack_offset = old_metadata.get("pack_offset")
+            chunks = self._metadata_chunks(old_metadata)
+            compression = old_metadata.get("compression")
+        elif self._is_chunked(size):
+            # Large data is stored in content-defined chunks.
+            chunks = self._store_chunks(StringIO(data), size)
+            encryption_key, encrypted_checksum = None, None
+            encrypted_size = sum(chunk["encrypted_size"] for chunk in chunks)
         else:
             # Create encrypted data.
-            if self.provider.encryption_method == "symmetric":
-                (encryption_key, encrypted_data, encrypted_size,
-                 encrypted_checksum) = self._encrypt_symmetric(data)
-            elif self.provider.encryption_method == "cryptoengine":
-                (encryption_key, encrypted_data, encrypted_size,
-                 encrypted_checksum) = self._encrypt_cryptoengine(data)
-            else:
-                (encryption_key, encrypted_data, encrypted_size,
-                 encrypted_checksum) = self._encrypt_gpg(data)
+            (encryption_key, encrypted_data, encrypted_size,
+             encrypted_checksum, compression) = self._encrypt_data(data)
+            if self._is_packed(size):
+                pack, pack_offset = self._add_to_pack(encrypted_data)
 
         # Create encrypted metadata.
         metadata = self._create_metadata(
             key, filename=cloud_filename, size=size, stat_info=stat_info,
             checksum=checksum, encryption_key=encryption_key,
             encrypted_size=encrypted_size,
-            encrypted_checksum=encrypted_checksum)
-        encrypted_metadata = gpg.encrypt(
-            json.dumps(metadata), self.recipients, sign=self.signer)
-        if not encrypted_metadata.ok:
-            raise GPGError(encrypted_metadata)
+            encrypted_checksum=encrypted_checksum, pack=pack,
+            pack_offset=pack_offset, chunks=chunks, compression=compression)
 
         # Store metadata and data to cloud and update database.
-        self.metadata_provider.store(key, encrypted_metadata.data)
-        if not old_metadata:
+        if encrypted_data is not None and pack is None:
             self.provider.store(checksum, encrypted_data)
-        self.database.update(metadata)
+        self._commit_metadata(metadata)
         return metadata
 
     def store_from_filename(self, filename, cloud_filename=None):
         """
-        Encrypt file data and store it to cloud.
+        Encrypt file data and store it to cloud. Return complete metadata of
+        the file, even if the data itself is stored later in a pack object.
         """
         if cloud_filename is None:
             cloud_filename = filename
 
         stat_info = os.stat(filename)
-        key = checksum_file(filename, extra_data=cloud_filename)
-        checksum = checksum_file(filename)
+        cached = self._cached_checksums(cloud_filename, stat_info)
+        if cached:
+            key, checksum = cached
+        else:
+            key, checksum = self._checksum_file(filename, cloud_filename)
+            self.database.update_cached_checksums(
+                cloud_filename, stat_info, key, checksum)
         size = stat_info.st_size
 
+        # Skip files that are already stored and have not changed.
+        unchanged_metadata = self._find_unchanged(key, stat_info)
+        if unchanged_metadata:
+            return unchanged_metadata
+
         # Do we have the data already stored into cloud?
-        old_metadata = self.database.find_one(
-            provider=self.metadata_provider.__name__, checksum=checksum)
+        old_metadata = self._find_data(checksum)
+        pack, pack_offset, chunks, compression = None, 0, None, None
         if old_metadata:
-            encrypted_file = None
             encryption_key = old_metadata["encryption_key"]
             encrypted_checksum = old_metadata["encrypted_checksum"]
             encrypted_size = old_metadata["encrypted_size"]
+            pack = old_metadata.get("pack")
+            pack_offset = old_metadata.get("pack_offset")
+            chunks = self._metadata_chunks(old_metadata)
+            compression = old_metadata.get("compression")
+        elif self._is_chunked(size):
+            # Large files are stored in content-defined chunks, and only
+            # the chunks that are not stored yet are uploaded.
+            chunks = self._store_chunks(file(filename, "rb"), size)
+            encryption_key, encrypted_checksum = None, None
+            encrypted_size = sum(chunk["encrypted_size"] for chunk in chunks)
+        elif self._batching and self._is_packed(size) and \
+                self._is_batched(size):
+            # Small files are encrypted in batches before they are packed.
+            return self._store_batched(
+                file(filename, "rb").read(), key, cloud_filename, size,
+                stat_info, checksum)
+        elif self._is_packed(size):
+            # Small files are collected into pack objects.
+            encrypted_fp = StringIO()
+            (encryption_key, encrypted_size, encrypted_checksum,
+             compression) = self._encrypt_file(filename, encrypted_fp)
+            pack, pack_offset = self._add_to_pack(encrypted_fp.getvalue())
+        elif self.provider.is_resumable(size):
+            # Large files are encrypted to local spool first, so that an
+            # interrupted upload can be resumed with the same encrypted data.
+            (encryption_key, encrypted_size, encrypted_checksum,
+             compression) = self._store_spooled(
+                filename, checksum, self.provider)
         else:
-            # Create encrypted data file.
-            encrypted_file = tempfile.NamedTemporaryFile()
-            if self.provider.encryption_method == "symmetric":
-                (encryption_key, encrypted_size, encrypted_checksum) =\
-                    self._encrypt_file_symmetric(filename, encrypted_file.name)
-            elif self.provider.encryption_method == "cryptoengine":
-                (encryption_key, encrypted_size, encrypted_checksum) =\
-                    self._encrypt_file_cryptoengine(
-                        filename, encrypted_file.name)
-            else:
-                (encryption_key, encrypted_size, encrypted_checksum) =\
-                    self._encrypt_file_gpg(filename, encrypted_file.name)
+            # Encrypt data and store it to cloud while it is encrypted.
+            encrypted_fp = self.provider.open_writer(checksum)
+            try:
+                (encryption_key, encrypted_size, encrypted_checksum,
+                 compression) = self._encrypt_file(filename, encrypted_fp)
+            except:
+                encrypted_fp.abort()
+                raise
+            encrypted_fp.close()
 
         # Create encrypted metadata.
         metadata = self._create_metadata(
             key, filename=cloud_filename, size=size, stat_info=stat_info,
             checksum=checksum, encryption_key=encryption_key,
             encrypted_size=encrypted_size,
-            encrypted_checksum=encrypted_checksum)
-        encrypted_metadata = gpg.encrypt(
-            json.dumps(metadata), self.recipients, sign=self.signer)
-        if not encrypted_metadata.ok:
-            raise GPGError(encrypted_metadata)
+            encrypted_checksum=encrypted_checksum, pack=pack,
+            pack_offset=pack_offset, chunks=chunks, compression=compression)
 
-        # Store metadata and data to cloud and update database.
-        self.metadata_provider.store(key, encrypted_metadata.data)
-        if not old_metadata:
-            self.provider.store_from_filename(checksum, encrypted_file.name)
-        self.database.update(metadata)
+        # Store metadata to cloud and update database.
+        self._commit_metadata(metadata)
 
         return metadata
 
+    def store_files(self, files):
+        """
+        Encrypt many files and store them to cloud. `files` is an iterable of
+        tuples of local filename and cloud filename, or None to use the
+        local filename. With crypto engine encryption, small files are
+        encrypted in batches of `batch_size` files with one request each.
+        Other files are stored like with `store_from_filename()`. Return
+        list of metadata of the files, which is complete when this returns.
+        """
+        metadata_list = list()
+        self._batching = True
+        try:
+            for filename, cloud_filename in files:
+                metadata_list.append(
+                    self.store_from_filename(filename, cloud_filename))
+            if self._batch:
+                self._flush_batch()
+        finally:
+            self._batching = False
+        return metadata_list
+
     def _decrypt_gpg(self, encrypted_data):
         data = gpg.decrypt(encrypted_data)
         if not data.ok:
@@ -436,20 +1776,28 @@ class Cloud(object):
         checksum = checksum_data(data.data)
         return data.data, checksum
 
-    def _decrypt_file_gpg(self, encrypted_file, plaintext_file):
-        data = gpg.decrypt_file(
-            file(encrypted_file), output=plaintext_file)
+    def _decrypt_file_gpg(self, encrypted_fp, plaintext_file):
+        data = gpg.decrypt_file(encrypted_fp, output=plaintext_file)
         if not data.ok:
             raise GPGError(data)
         checksum = checksum_file(plaintext_file)
         return checksum
 
     def _decrypt_symmetric(self, encrypted_data, encryption_key):
-        encrypted_fp = StringIO(base64.decodestring(encrypted_data))
-        plaintext_fp = StringIO()
-        _, checksum = decrypt(encrypted_fp, plaintext_fp, encryption_key)
-        plaintext_fp.seek(0)
-        data = plaintext_fp.read()
+        if is_seekable(encrypted_data):
+            plaintext_fp = BufferWriter()
+            _, checksum = decrypt_seekable(
+                BufferReader(encrypted_data), plaintext_fp, encryption_key,
+                pool=self._encryption_pool(),
+                window=2 * self.encryption_jobs)
+            return plaintext_fp.buffer, checksum
+        elif is_binary(encrypted_data):
+            _, checksum, data = decrypt_buffer(
+                encrypted_data, encryption_key, offset=len(BINARY_MAGIC))
+        else:
+            # Data stored before the binary format is BASE64 encoded.
+            _, checksum, data = decrypt_buffer(
+                base64.decodestring(encrypted_data), encryption_key)
         return data, checksum
 
     def _decrypt_cryptoengine(self, encrypted_data, encryption_key):
@@ -458,37 +1806,118 @@ class Cloud(object):
         checksum = result["checksum"]
         return data, checksum
 
-    def _decrypt_file_symmetric(self, encrypted_file, plaintext_file,
+    def _decrypt_file_symmetric(self, encrypted_fp, plaintext_fp,
                                 encryption_key):
-        base64_fp = file(encrypted_file)
-        encrypted_fp = tempfile.TemporaryFile()
-        base64.decode(base64_fp, encrypted_fp)
-        encrypted_fp.flush()
-        encrypted_fp.seek(0)
-        plaintext_fp = file(plaintext_file, "wb")
-        _, checksum = decrypt(encrypted_fp, plaintext_fp, encryption_key)
-        plaintext_fp.close()
-        encrypted_fp.close()
-        base64_fp.close()
-        return checksum
+        encrypted_fp = PeekReader(encrypted_fp)
+        header = encrypted_fp.peek(len(SEEKABLE_MAGIC))
+        if is_seekable(header):
+            decrypt_seekable(encrypted_fp, plaintext_fp, encryption_key,
+                             pool=self._encryption_pool(),
+                             window=2 * self.encryption_jobs)
+        elif is_binary(header):
+            encrypted_fp.read(len(BINARY_MAGIC))
+            decrypt(encrypted_fp, plaintext_fp, encryption_key)
+        else:
+            # Data stored before the binary format is BASE64 encoded.
+            decrypt(Base64Reader(encrypted_fp), plaintext_fp, encryption_key)
 
-    def _decrypt_file_cryptoengine(self, encrypted_file, plaintext_file,
+    def _decrypt_file_cryptoengine(self, encrypted_fp, plaintext_fp,
                                    encryption_key):
-        encrypted_data = file(encrypted_file).read()
+        client = self._cryptoengine_client()
+        if client.streaming:
+            client.decrypt_file(encrypted_fp, plaintext_fp, encryption_key)
+            return
+        encrypted_data = encrypted_fp.read()
         result = self._cryptoengine_decrypt(encrypted_data, encryption_key)
-        data = result["data"]
-        checksum = result["checksum"]
+        plaintext_fp.write(result["data"])
+
+    def _decrypt_file(self, encrypted_fp, plaintext_file, encryption_key,
+                      compression=None):
+        """
+        Decrypt and decompress data read from given stream using the
+        encryption method of the data provider and write it to given file.
+        Return checksum of the decrypted data.
+        """
+        if self.provider.encryption_method == "gpg":
+            # Data encrypted with GPG is never compressed.
+            return self._decrypt_file_gpg(encrypted_fp, plaintext_file)
         plaintext_fp = file(plaintext_file, "wb")
-        plaintext_fp.write(data)
-        plaintext_fp.close()
-        return checksum
+        try:
+            return self._decrypt_stream(
+                encrypted_fp, plaintext_fp, encryption_key, compression)
+        finally:
+            plaintext_fp.close()
+
+    def _decrypt_stream(self, encrypted_fp, plaintext_fp, encryption_key,
+                        compression=None):
+        """
+        Decrypt and decompress data read from given stream like
+        `_decrypt_file()`, but write it to given stream. Return checksum of
+        the decrypted data.
+        """
+        if self.provider.encryption_method == "gpg":
+            # GPG writes decrypted data to a file.
+            temp_fp = tempfile.NamedTemporaryFile(
+                prefix="gpgcloud-", delete=False)
+            temp_fp.close()
+            try:
+                checksum = self._decrypt_file_gpg(encrypted_fp, temp_fp.name)
+                with file(temp_fp.name, "rb") as decrypted_fp:
+                    shutil.copyfileobj(decrypted_fp, plaintext_fp)
+            finally:
+                os.remove(temp_fp.name)
+            return checksum
+        checksum_fp = ChecksumWriter(plaintext_fp)
+        output_fp = checksum_fp
+        if compression is not None:
+            output_fp = DecompressWriter(checksum_fp, compression)
+        if self.provider.encryption_method in ["symmetric", "multicore", ]:
+            self._decrypt_file_symmetric(
+                encrypted_fp, output_fp, encryption_key)
+        else:
+            self._decrypt_file_cryptoengine(
+                encrypted_fp, output_fp, encryption_key)
+        if compression is not None:
+            output_fp.flush()
+        return checksum_fp.hexdigest()
+
+    def _decrypt_data(self, encrypted_data, encryption_key,
+                      compression=None):
+        """
+        Decrypt and decompress data using the encryption method of the data
+        provider. Return tuple of data and data checksum. Data decrypted
+        with symmetric encryption is returned as bytearray.
+        """
+        if self.provider.encryption_method in ["symmetric", "multicore", ]:
+            data, checksum = self._decrypt_symmetric(
+                encrypted_data, encryption_key)
+        elif self.provider.encryption_method == "cryptoengine":
+            data, checksum = self._decrypt_cryptoengine(
+                encrypted_data, encryption_key)
+        else:
+            data, checksum = self._decrypt_gpg(encrypted_data)
+        if compression is not None:
+            data = decompress(data, compression)
+            checksum = checksum_data(data)
+        return data, checksum
 
     def retrieve(self, metadata):
         """
         Retrieve data from cloud and decrypt it.
         """
+        chunks = self._metadata_chunks(metadata)
+        if chunks is not None:
+            plaintext_fp = StringIO()
+            checksum = self._retrieve_chunks(chunks, plaintext_fp)
+            if checksum != metadata['checksum']:
+                raise DataError(
+                    metadata["checksum"],
+                    "Wrong data checksum: {0} != {1}".format(
+                        checksum, metadata["checksum"]))
+            return plaintext_fp.getvalue()
+
         # Get data from cloud.
-        encrypted_data = self.provider.retrieve(metadata["checksum"])
+        encrypted_data = self._retrieve_data(metadata)
         encrypted_checksum = checksum_data(encrypted_data)
         if encrypted_checksum != metadata['encrypted_checksum']:
             raise DataError(
@@ -496,78 +1925,280 @@ class Cloud(object):
                 "Wrong encrypted data checksum: {0} != {1}".format(
                     encrypted_checksum, metadata["encrypted_checksum"]))
 
-        # Decrypt data.
-        if self.provider.encryption_method == "symmetric":
-            data, checksum = self._decrypt_symmetric(
-                encrypted_data, metadata["encryption_key"])
-        elif self.provider.encryption_method == "cryptoengine":
-            data, checksum = self._decrypt_cryptoengine(
-                encrypted_data, metadata["encryption_key"])
-        else:
-            data, checksum = self._decrypt_gpg(encrypted_data)
+        # Decrypt data. Encrypted data is released before the decrypted
+        # data is converted to string, so that at most two copies of the
+        # data are in memory at a time.
+        data, checksum = self._decrypt_data(
+            encrypted_data, metadata["encryption_key"],
+            metadata.get("compression"))
+        del encrypted_data
         if checksum != metadata['checksum']:
             raise DataError(
                 metadata["checksum"],
                 "Wrong data checksum: {0} != {1}".format(
                     checksum, metadata["checksum"]))
-        return data
+        return str(data)
 
-    def retrieve_to_filename(self, metadata, filename=None):
+    def _retrieve_data_range(self, record, offset, length):
         """
-        Retrieve data from cloud and decrypt it.
+        Retrieve part of data object of file or chunk from cloud and
+        decrypt it. Only the blocks containing the range are retrieved.
+        Return None if the data is not stored in seekable container.
         """
-        if filename is None:
-            filename = metadata["path"]
+        if self.provider.encryption_method not in [
+                "symmetric", "multicore", ] or record.get("compression"):
+            return None
+        key, base_offset = record["checksum"], 0
+        if record.get("pack"):
+            key, base_offset = record["pack"], record["pack_offset"]
+        try:
+            data = decrypt_range(
+                lambda range_offset, range_length:
+                self.provider.retrieve_range(
+                    key, base_offset + range_offset, range_length),
+                record["encrypted_size"], record["encryption_key"], offset,
+                length)
+        except ContainerError as e:
+            raise DataError(record["checksum"], str(e))
+        if data is not None and len(data) != length:
+            raise DataError(
+                record["checksum"],
+                "Wrong data size: {0} != {1}".format(len(data), length))
+        return data
 
-        directory_name = os.path.dirname(filename)
-        if directory_name:
-            try:
-                os.makedirs(directory_name)
-            except OSError as e:
-                if e.errno != errno.EEXIST:
-                    raise
+    def retrieve_range(self, metadata, offset, length):
+        """
+        Retrieve `length` bytes of file data starting at `offset` from cloud
+        and decrypt them. Of data stored in seekable containers only the
+        blocks containing the range are retrieved, and of chunked data only
+        the chunks containing the range. Other data is retrieved whole.
+        """
+        end = min(offset + length, metadata["size"])
+        if offset >= end:
+            return ""
+        chunks = self._metadata_chunks(metadata)
+        if chunks is None:
+            data = self._retrieve_data_range(metadata, offset, end - offset)
+            if data is None:
+                data = self.retrieve(metadata)[offset:end]
+            return data
+        blocks = list()
+        chunk_offset = 0
+        for chunk in chunks:
+            chunk_end = chunk_offset + chunk["size"]
+            if chunk_offset < end and chunk_end > offset:
+                start = max(offset, chunk_offset) - chunk_offset
+                stop = min(end, chunk_end) - chunk_offset
+                data = self._retrieve_data_range(chunk, start, stop - start)
+                if data is None:
+                    data = self._retrieve_chunk(
+                        self.provider, chunk)[start:stop]
+                blocks.append(data)
+            chunk_offset = chunk_end
+        return "".join(blocks)
+
+    def _retrieve_data_to_filename(self, metadata, filename, provider=None):
+        """
+        Decrypt data to given file while it is retrieved from cloud. Return
+        checksum of the data.
+        """
+        encrypted_fp = ChecksumReader(
+            self._open_data_reader(metadata, provider))
+        try:
+            checksum = self._decrypt_file(
+                encrypted_fp, filename, metadata["encryption_key"],
+                metadata.get("compression"))
+        finally:
+            encrypted_fp.close()
+        self._check_encrypted_checksum(metadata, encrypted_fp.hexdigest())
+        return checksum
 
-        # Get data from cloud and store it to a temporary file.
-        encrypted_file = tempfile.NamedTemporaryFile()
-        self.provider.retrieve_to_filename(
-            metadata["checksum"], encrypted_file.name)
-        encrypted_checksum = checksum_file(encrypted_file.name)
+    def _check_encrypted_checksum(self, metadata, encrypted_checksum):
         if encrypted_checksum != metadata['encrypted_checksum']:
             raise DataError(
                 metadata["checksum"],
                 "Wrong encrypted data checksum: {0} != {1}".format(
                     encrypted_checksum, metadata["encrypted_checksum"]))
 
-        # Decrypt the data in temporary file and store it to given filename.
-        if self.provider.encryption_method == "symmetric":
-            checksum = self._decrypt_file_symmetric(
-                encrypted_file.name, filename, metadata["encryption_key"])
-        elif self.provider.encryption_method == "cryptoengine":
-            checksum = self._decrypt_file_cryptoengine(
-                encrypted_file.name, filename, metadata["encryption_key"])
-        else:
-            checksum = self._decrypt_file_gpg(
-                encrypted_file.name, filename)
+    def _retrieve_data_range_once(self, metadata, plaintext_fp, offset,
+                                  length):
+        """
+        Retrieve data that is not stored in seekable container and decrypt
+        it while it is retrieved, writing only the given range to given
+        stream. The whole data is decrypted once, so that its checksums can
+        be verified.
+        """
+        encrypted_fp = ChecksumReader(self._open_data_reader(metadata))
+        try:
+            checksum = self._decrypt_stream(
+                encrypted_fp, RangeWriter(plaintext_fp, offset, length),
+                metadata["encryption_key"], metadata.get("compression"))
+        finally:
+            encrypted_fp.close()
+        self._check_encrypted_checksum(metadata, encrypted_fp.hexdigest())
         if checksum != metadata['checksum']:
             raise DataError(
                 metadata["checksum"],
                 "Wrong data checksum: {0} != {1}".format(
                     checksum, metadata["checksum"]))
 
-        # Set file attributes.
-        os.chmod(filename, metadata["mode"])
-        os.utime(filename, (metadata["atime"], metadata["mtime"]))
+    def retrieve_range_to_filename(self, metadata, filename, offset,
+                                   length=None, block_size=64 * 2**20):
+        """
+        Retrieve `length` bytes of file data starting at `offset` from cloud,
+        decrypt them and write them to given file. The whole rest of the
+        file is retrieved if `length` is None. Data stored in seekable
+        containers or in chunks is retrieved with `retrieve_range()` in
+        parts of `block_size` bytes. Other data is retrieved and decrypted
+        only once.
+        """
+        end = metadata["size"]
+        if length is not None:
+            end = min(end, offset + length)
+        plaintext_fp = file(filename, "wb")
+        try:
+            if offset < end and self._metadata_chunks(metadata) is None:
+                data = self._retrieve_data_range(
+                    metadata, offset, min(block_size, end - offset))
+                if data is None:
+                    return self._retrieve_data_range_once(
+                        metadata, plaintext_fp, offset, end - offset)
+                plaintext_fp.write(data)
+                offset += len(data)
+            while offset < end:
+                data = self.retrieve_range(
+                    metadata, offset, min(block_size, end - offset))
+                plaintext_fp.write(data)
+                offset += len(data)
+        finally:
+            plaintext_fp.close()
+
+    def retrieve_to_filename(self, metadata, filename=None, jobs=4,
+                             provider=None):
+        """
+        Retrieve data from cloud and decrypt it. Chunked data is retrieved
+        using `jobs` concurrent requests. Data is retrieved with `provider`
+        if it is given instead of the data provider of the cloud.
+        """
+        def retrieve(plaintext_file):
+            chunks = self._metadata_chunks(metadata)
+            if chunks is None:
+                return self._retrieve_data_to_filename(
+                    metadata, plaintext_file, provider)
+            chunks_fp = file(plaintext_file, "wb")
+            try:
+                return self._retrieve_chunks(
+                    chunks, chunks_fp, jobs, provider)
+            finally:
+                chunks_fp.close()
 
-        encrypted_file.close()
+        self._restore_file(metadata, filename, retrieve)
+
+    def _restore_file(self, metadata, filename, retrieve):
+        """
+        Restore file from cloud. `retrieve` is called with the name of a
+        temporary file, to which it writes the data of the file, and it
+        returns the checksum of the data.
+        """
+        if filename is None:
+            filename = metadata["path"]
+
+        directory_name = os.path.dirname(filename)
+        if directory_name:
+            try:
+                os.makedirs(directory_name)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # Data is written to a temporary file next to the given file, which
+        # is replaced only after the checksums have been verified.
+        plaintext_fp = tempfile.NamedTemporaryFile(
+            dir=directory_name or os.curdir,
+            prefix="." + os.path.basename(filename) + ".", delete=False)
+        plaintext_fp.close()
+        try:
+            checksum = retrieve(plaintext_fp.name)
+            if checksum != metadata['checksum']:
+                raise DataError(
+                    metadata["checksum"],
+                    "Wrong data checksum: {0} != {1}".format(
+                        checksum, metadata["checksum"]))
+
+            # Set file attributes.
+            os.chmod(plaintext_fp.name, metadata["mode"])
+            os.utime(plaintext_fp.name,
+                     (metadata["atime"], metadata["mtime"]))
+            os.rename(plaintext_fp.name, filename)
+        except:
+            if os.path.exists(plaintext_fp.name):
+                os.remove(plaintext_fp.name)
+            raise
+
+    def _retrieve_batch(self, batch):
+        """
+        Retrieve data of files in batch and decrypt it in one crypto engine
+        batch request. Write the data to the files.
+        """
+        items = list()
+        for metadata, _ in batch:
+            encrypted_data = self._retrieve_data(metadata)
+            self._check_encrypted_checksum(
+                metadata, checksum_data(encrypted_data))
+            items.append((encrypted_data, metadata["encryption_key"]))
+        results = self._cryptoengine_client().decrypt_batch(items)
+        for (metadata, filename), result in zip(batch, results):
+            data = result["data"]
+            if metadata.get("compression") is not None:
+                data = decompress(data, metadata["compression"])
+
+            def write(plaintext_file):
+                with file(plaintext_file, "wb") as plaintext_fp:
+                    plaintext_fp.write(data)
+                return checksum_data(data)
+
+            self._restore_file(metadata, filename, write)
+
+    def retrieve_files(self, files, jobs=4):
+        """
+        Retrieve many files from cloud and decrypt them. `files` is an
+        iterable of tuples of metadata and local filename, or None to use
+        the path in metadata. With crypto engine encryption, small files
+        are decrypted in batches of `batch_size` files with one request
+        each. Other files are retrieved like with `retrieve_to_filename()`.
+        """
+        batch = list()
+        for metadata, filename in files:
+            if self._is_batched(metadata["encrypted_size"]) and \
+                    self._metadata_chunks(metadata) is None:
+                batch.append((metadata, filename))
+                if len(batch) >= self.batch_size:
+                    self._retrieve_batch(batch)
+                    batch = list()
+            else:
+                self.retrieve_to_filename(metadata, filename, jobs)
+        if batch:
+            self._retrieve_batch(batch)
 
     def delete(self, metadata):
         """
         Delete data from cloud.
         """
-        self.metadata_provider.delete(metadata["key"])
+        # Store the current pack first, so that all files sharing the data
+        # are found from database.
+        self.flush_data()
+        chunks = self._metadata_chunks(metadata)
+        self._delete_metadata(metadata)
         self.database.delete(metadata["key"])
-        if not self.database.find_one(
-                provider=self.metadata_provider.__name__,
-                checksum=metadata["checksum"]):
+        if metadata.get("pack"):
+            # Pack object is removed when no file in it is left.
+            if not self.database.find_one(
+                    provider=self.metadata_provider.__name__,
+                    pack=metadata["pack"]):
+                self.provider.delete(metadata["pack"])
+        elif chunks is not None:
+            for checksum in set(chunk["checksum"] for chunk in chunks):
+                self._delete_unused_data(checksum)
+        else:
             # Metadata is removed, remove the data.
-            self.provider.delete(metadata["checksum"])
+            self._delete_unused_data(metadata["checksum"])
@@ -4,19 +4,176 @@ Handle connection to Amazon S3 cloud provider.
 
 import boto
 import boto.exception
+import boto.s3.connection
 import boto.s3.key
+import boto.s3.multipart
+import boto.utils
+import collections
+import hashlib
+import json
+import multiprocessing.pool
+import os
+import threading
+from StringIO import StringIO
 
-from cloud import Provider
+from cloud import Provider, RangeReader, ThreadProviders
+from lib.stream import BufferReader
 
 
 class S3Error(Exception):
     pass
 
 
+class UploadJournal(object):
+    """
+    Local journal of a multipart upload. The journal records the upload
+    ID and the parts already uploaded, so that an interrupted upload of
+    the same file can be resumed.
+    """
+    def __init__(self, directory, bucket_name, key):
+        self.filename = os.path.join(
+            os.path.expanduser(directory),
+            hashlib.sha256(bucket_name + "/" + key).hexdigest() + ".json")
+        self.lock = threading.Lock()
+        self.state = None
+
+    def load(self):
+        """
+        Load journal. Return journal state or None if there is no journal.
+        """
+        try:
+            self.state = json.load(file(self.filename))
+        except (IOError, ValueError):
+            self.state = None
+        return self.state
+
+    def save(self):
+        """
+        Save journal. The old journal is replaced atomically.
+        """
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self.lock:
+            temp_filename = self.filename + ".tmp"
+            f = file(temp_filename, "w")
+            json.dump(self.state, f)
+            f.close()
+            os.rename(temp_filename, self.filename)
+
+    def add_part(self, part_number, etag):
+        """
+        Record uploaded part.
+        """
+        with self.lock:
+            self.state["parts"][str(part_number)] = etag
+        self.save()
+
+    def remove(self):
+        """
+        Remove journal after the upload is complete.
+        """
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+class S3Writer(object):
+    """
+    Writable stream to Amazon S3 key. Data is uploaded in parts while it is
+    written, with up to `upload_jobs` parts uploaded concurrently. Data
+    smaller than one part is uploaded with a single request.
+    """
+    def __init__(self, provider, key):
+        self.provider = provider
+        self.key = key
+        self.part_size = provider.part_size
+        self.buffer = StringIO()
+        self.multipart = None
+        self.part_number = 0
+        self.pending = collections.deque()
+        self.providers = None
+        self.pool = None
+
+    def _upload_part(self):
+        if self.multipart is None:
+            self.multipart = self.provider.bucket.initiate_multipart_upload(
+                self.key)
+            self.providers = ThreadProviders(self.provider)
+            self.pool = multiprocessing.pool.ThreadPool(
+                self.provider.upload_jobs)
+        # Wait for the oldest part, so that at most upload_jobs parts are
+        # held in memory.
+        while len(self.pending) >= self.provider.upload_jobs:
+            self.pending.popleft().get()
+        self.part_number += 1
+        self.buffer.seek(0)
+        self.pending.append(self.pool.apply_async(
+            self.provider._upload_part,
+            (self.providers, self.key, self.multipart.id, self.buffer,
+             self.part_number)))
+        self.buffer = StringIO()
+
+    def _close_pool(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.providers.disconnect()
+            self.pool = None
+
+    def write(self, data):
+        self.buffer.write(data)
+        if self.buffer.tell() >= self.part_size:
+            self._upload_part()
+
+    def close(self):
+        """
+        Upload the remaining data, wait for all parts and complete the
+        upload. The upload is cancelled if any part fails.
+        """
+        if self.multipart is None:
+            k = boto.s3.key.Key(self.provider.bucket)
+            k.key = self.key
+            k.set_contents_from_string(self.buffer.getvalue())
+            self.buffer = None
+            return
+        try:
+            if self.buffer.tell():
+                self._upload_part()
+            while self.pending:
+                self.pending.popleft().get()
+            self._close_pool()
+            self.multipart.complete_upload()
+        except:
+            self.abort()
+            raise
+        self.buffer = None
+
+    def abort(self):
+        """
+        Cancel the upload.
+        """
+        self._close_pool()
+        if self.multipart is not None:
+            self.multipart.cancel_upload()
+        self.buffer = None
+
+
 class S3(Provider):
     """
     Class for Amazon S3 cloud provider.
     """
+    # Size of the parts in multipart uploads. Amazon S3 requires at least
+    # 5 MB for all but the last part.
+    part_size = 8 * 2**20
+    # Number of parts uploaded concurrently.
+    upload_jobs = 4
+    # Directory of the journals of unfinished multipart uploads.
+    journal_directory = "~/.gpgcloud/uploads"
+    # Objects larger than one range are downloaded in ranges using
+    # concurrent requests.
+    range_size = 8 * 2**20
+    download_jobs = 4
+
     def _create_bucket(self, bucket_name):
         """
         Create bucket, if it does not exist.
@@ -37,6 +194,35 @@ class S3(Provider):
         self.access_key = self.config.config.get("amazon-s3", "access_key")
         self.secret_access_key = self.config.config.get(
             "amazon-s3", "secret_access_key")
+        # Optional S3 compatible service used instead of Amazon S3.
+        self.connection_options = dict()
+        if self.config.config.has_option("amazon-s3", "host"):
+            self.connection_options = dict(
+                host=self.config.config.get("amazon-s3", "host"),
+                calling_format=boto.s3.connection.OrdinaryCallingFormat())
+            if self.config.config.has_option("amazon-s3", "port"):
+                self.connection_options["port"] = self.config.config.getint(
+                    "amazon-s3", "port")
+            if self.config.config.has_option("amazon-s3", "is_secure"):
+                self.connection_options["is_secure"] = \
+                    self.config.config.getboolean("amazon-s3", "is_secure")
+        if self.config.config.has_option("amazon-s3", "part_size"):
+            self.part_size = self.config.config.getint(
+                "amazon-s3", "part_size")
+            if self.part_size < 5 * 2**20:
+                raise ValueError("Part size must be at least 5 MB")
+        if self.config.config.has_option("amazon-s3", "upload_jobs"):
+            self.upload_jobs = self.config.config.getint(
+                "amazon-s3", "upload_jobs")
+        if self.config.config.has_option("amazon-s3", "journal_directory"):
+            self.journal_directory = self.config.config.get(
+                "amazon-s3", "journal_directory")
+        if self.config.config.has_option("amazon-s3", "range_size"):
+            self.range_size = self.config.config.getint(
+                "amazon-s3", "range_size")
+        if self.config.config.has_option("amazon-s3", "download_jobs"):
+            self.download_jobs = self.config.config.getint(
+                "amazon-s3", "download_jobs")
         self.connection = None
 
     @property
@@ -53,7 +239,8 @@ class S3(Provider):
         if self.connection is not None:
             return self
         self.connection = boto.connect_s3(
-            self.access_key, self.secret_access_key)
+            self.access_key, self.secret_access_key,
+            **self.connection_options)
         self.bucket = self._create_bucket(
             self.access_key + '-' + self.bucket_name)
         return self
@@ -66,39 +253,175 @@ class S3(Provider):
 
     def store(self, key, data):
         """
-        Store data to Amazon S3 cloud from data buffer.
+        Store data to Amazon S3 cloud from data buffer. Data can be a
+        string or a bytearray, and it is read without copying it.
         """
         assert(self.connection is not None)
         k = boto.s3.key.Key(self.bucket)
         k.key = key
-        k.set_contents_from_string(data)
+        k.set_contents_from_file(BufferReader(data))
 
     def store_from_filename(self, key, filename):
         """
-        Store data to Amazon S3 cloud from file.
+        Store data to Amazon S3 cloud from file. Files larger than one part
+        are uploaded using resumable multipart upload.
         """
         assert(self.connection is not None)
+        if os.path.getsize(filename) > self.part_size:
+            return self._multipart_upload(key, filename)
         k = boto.s3.key.Key(self.bucket)
         k.key = key
         k.set_contents_from_filename(filename)
 
+    def is_resumable(self, size):
+        """
+        Files larger than one part are uploaded with resumable multipart
+        upload.
+        """
+        return size > self.part_size
+
+    def _find_multipart_upload(self, key, upload_id):
+        """
+        Return unfinished multipart upload with given ID, or None.
+        """
+        for multipart in self.bucket.list_multipart_uploads():
+            if multipart.key_name == key and multipart.id == upload_id:
+                return multipart
+        return None
+
+    def _upload_part(self, providers, key, upload_id, fp, part_number,
+                     size=None):
+        """
+        Upload one part of multipart upload from the current position of
+        given file. This is run in a worker thread using its own
+        connection. Return ETag of the part.
+        """
+        multipart = boto.s3.multipart.MultiPartUpload(providers.get().bucket)
+        multipart.key_name = key
+        multipart.id = upload_id
+        k = multipart.upload_part_from_file(fp, part_number, size=size)
+        return k.etag
+
+    def _multipart_upload(self, key, filename):
+        """
+        Upload file in parts concurrently. Uploaded parts are recorded in a
+        local journal. If the upload is interrupted, uploading the same
+        unchanged file to the same key again uploads only the missing parts.
+        """
+        stat_info = os.stat(filename)
+        file_info = dict(size=stat_info.st_size, mtime=stat_info.st_mtime,
+                         inode=stat_info.st_ino, part_size=self.part_size)
+        journal = UploadJournal(self.journal_directory, self.bucket.name, key)
+        state = journal.load()
+        multipart = None
+        if state is not None:
+            multipart = self._find_multipart_upload(key, state["upload_id"])
+            if multipart is not None and state["file"] != file_info:
+                # The file has changed, the parts can not be used.
+                multipart.cancel_upload()
+                multipart = None
+        if multipart is None:
+            multipart = self.bucket.initiate_multipart_upload(key)
+            journal.state = dict(upload_id=multipart.id, file=file_info,
+                                 parts=dict())
+            journal.save()
+        uploaded = dict((part.part_number, part.etag) for part in multipart)
+
+        parts = list()
+        for part_number, offset in enumerate(
+                range(0, stat_info.st_size, self.part_size), 1):
+            etag = journal.state["parts"].get(str(part_number))
+            if etag is None or uploaded.get(part_number) != etag:
+                parts.append((part_number, offset, min(
+                    self.part_size, stat_info.st_size - offset)))
+
+        def upload(part):
+            part_number, offset, size = part
+            f = file(filename, "rb")
+            try:
+                f.seek(offset)
+                etag = self._upload_part(providers, key, multipart.id, f,
+                                         part_number, size)
+            finally:
+                f.close()
+            journal.add_part(part_number, etag)
+
+        providers = ThreadProviders(self)
+        pool = multiprocessing.pool.ThreadPool(self.upload_jobs)
+        try:
+            pool.map(upload, parts)
+        finally:
+            pool.terminate()
+            pool.join()
+            providers.disconnect()
+        multipart.complete_upload()
+        journal.remove()
+
+    def open_writer(self, key):
+        """
+        Open writable stream to Amazon S3 cloud.
+        """
+        assert(self.connection is not None)
+        return S3Writer(self, key)
+
     def retrieve(self, key):
         """
         Retrieve data from Amazon S3 cloud. Return data as string.
         """
         assert(self.connection is not None)
-        data = None
-        k = self.bucket.get_key(key)
-        if k: data = k.get_contents_as_string()
-        return data
+        # Request the data directly, without looking up the key first.
+        k = boto.s3.key.Key(self.bucket, key)
+        try:
+            return k.get_contents_as_string()
+        except boto.exception.S3ResponseError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def retrieve_range(self, key, offset, length):
+        """
+        Retrieve part of data from Amazon S3 cloud. Return data as string.
+        """
+        assert(self.connection is not None)
+        # Request the range directly, without looking up the key first.
+        k = boto.s3.key.Key(self.bucket, key)
+        try:
+            return k.get_contents_as_string(headers={
+                "Range": "bytes={0}-{1}".format(offset, offset + length - 1)})
+        except boto.exception.S3ResponseError as e:
+            if e.status == 404:
+                return None
+            raise
 
     def retrieve_to_filename(self, key, filename):
         """
-        Retrieve data from Amazon S3 cloud. Write data to file.
+        Retrieve data from Amazon S3 cloud. Write data to file. Large
+        objects are retrieved in ranges using concurrent requests.
         """
         assert(self.connection is not None)
         k = self.bucket.get_key(key)
-        if k: k.get_contents_to_filename(filename)
+        if not k:
+            return
+        if k.size > self.range_size:
+            RangeReader(self, key, k.size, self.range_size,
+                        self.download_jobs).copy_to_filename(filename)
+        else:
+            k.get_contents_to_filename(filename)
+
+    def open_reader(self, key):
+        """
+        Open readable stream from Amazon S3 cloud. Large objects are
+        retrieved in ranges using concurrent requests.
+        """
+        assert(self.connection is not None)
+        k = self.bucket.get_key(key)
+        if not k:
+            raise S3Error("Key not found: {0}".format(key))
+        if k.size > self.range_size:
+            return RangeReader(
+                self, key, k.size, self.range_size, self.download_jobs)
+        k.open_read()
+        return k
 
     def delete(self, key):
         """
@@ -108,25 +431,60 @@ class S3(Provider):
         k = self.bucket.get_key(key)
         if k: k.delete()
 
-    def list(self):
+    def _list(self, prefix="", marker=""):
+        """
+        Iterate over keys in bucket in the order of their names, starting
+        after `marker`. Keys are listed in pages of up to 1000 keys.
+        """
+        return self.bucket.list(prefix=prefix, marker=marker)
+
+    def _key_info(self, key):
+        """
+        Return key information from the key listing. Last modification
+        time is given in the same format as when the key is looked up
+        alone.
+        """
+        key_info = dict(key.__dict__)
+        key_info["last_modified"] = boto.utils.parse_ts(
+            key.last_modified).strftime("%a, %d %b %Y %H:%M:%S GMT")
+        return key_info
+
+    def _retrieve_listed(self, providers, name):
+        """
+        Retrieve data of listed key in worker thread. Return tuple of key
+        name and data, or None if the key has been deleted since it was
+        listed.
+        """
+        data = providers.get().retrieve(name)
+        if data is None:
+            return None
+        return name, data
+
+    def list(self, prefix="", marker=""):
         """
         List data in Amazon S3 cloud. Return dictionary of keys with
-        data.
+        data. Only keys starting with `prefix` and following `marker` are
+        listed. Data is retrieved using `download_jobs` concurrent requests.
         """
         assert(self.connection is not None)
-        keys = dict()
-        for key in self.bucket.list():
-            k = self.bucket.get_key(key.name)
-            if k: keys[key.name] = k.get_contents_as_string()
-        return keys
+        names = (key.name for key in self._list(prefix, marker))
+        providers = ThreadProviders(self)
+        pool = multiprocessing.pool.ThreadPool(self.download_jobs)
+        try:
+            return dict(item for item in pool.imap_unordered(
+                lambda name: self._retrieve_listed(providers, name), names)
+                if item is not None)
+        finally:
+            pool.terminate()
+            pool.join()
+            providers.disconnect()
 
-    def list_keys(self):
+    def list_keys(self, prefix="", marker=""):
         """
-        List data keys in Amazon S3 cloud.
+        List data keys in Amazon S3 cloud. Only keys starting with
+        `prefix` and following `marker` are listed. Key information is
+        taken from the key listing without requesting each key.
         """
         assert(self.connection is not None)
-        keys = dict()
-        for key in self.bucket.list():
-            k = self.bucket.lookup(key.name)
-            if k: keys[key.name] = k.__dict__
-        return keys
+        return dict((key.name, self._key_info(key))
+                    for key in self._list(prefix, marker))
@@ -0,0 +1,330 @@
+"""
+Run cloud operations concurrently without blocking the caller.
+
+Each operation of `AsyncCloud` returns immediately with an `AsyncResult`,
+whose `get()` waits for the operation and returns its result or raises its
+exception. Data is encrypted and transferred on a pool of I/O threads, each
+with its own provider connections, so many transfers can be in flight at
+the same time.
+
+The metadata database, the current pack object and metadata segments are
+shared by all operations, so they are only accessed while holding a lock.
+Data is encrypted and uploaded without holding it, also when it is packed
+or stored in chunks, and syncs hold it only while updating the database.
+Deletions hold the lock, and they wait until no store or sync is in
+progress, so that data being stored is never deleted as unused and synced
+metadata of deleted data is never added back to the database.
+
+Providers themselves are blocking, so concurrency comes from the I/O
+threads and not from non-blocking requests.
+"""
+
+import multiprocessing.pool
+import os
+import threading
+from StringIO import StringIO
+
+from cloud import CHUNK_FIELDS, ThreadProviders
+from lib import checksum_data, checksums_data
+
+
+class AsyncCloud(object):
+    """
+    Run operations of given cloud on `jobs` I/O threads.
+    """
+    def __init__(self, cloud, jobs=16):
+        if jobs < 1:
+            raise ValueError("Number of jobs must be at least 1")
+        self.cloud = cloud
+        self.jobs = jobs
+        self._lock = threading.RLock()
+        # Deletions wait until the number of stores and syncs in progress is
+        # zero.
+        self._stores_done = threading.Condition(self._lock)
+        self._stores = 0
+        self._deletes = 0
+        # Stores of the same data or chunk must not run concurrently, as
+        # each would encrypt it with a different key.
+        self._data_locks = [threading.Lock() for _ in range(64)]
+        self._chunk_locks = [threading.Lock() for _ in range(64)]
+        # Chunks stored by files whose metadata may not be in the database
+        # yet, by checksum.
+        self._stored_chunks = dict()
+        # Process pool and crypto engine client are created on first use,
+        # which must not happen concurrently.
+        cloud._encryption_pool()
+        if cloud.chunk_size:
+            cloud._process_pool()
+        if cloud.provider.encryption_method == "cryptoengine":
+            cloud._cryptoengine_client()
+        self._providers = ThreadProviders(cloud.provider)
+        self._metadata_providers = ThreadProviders(cloud.metadata_provider)
+        self._pool = multiprocessing.pool.ThreadPool(jobs)
+
+    def _submit(self, function, args, callback=None):
+        return self._pool.apply_async(function, args, callback=callback)
+
+    def _striped_lock(self, locks, checksum):
+        return locks[int(checksum[:8], 16) % len(locks)]
+
+    def _begin_store(self):
+        with self._lock:
+            while self._deletes:
+                self._stores_done.wait()
+            self._stores += 1
+
+    def _end_store(self):
+        with self._lock:
+            self._stores -= 1
+            self._stores_done.notify_all()
+
+    def _old_encryption(self, checksum):
+        """
+        Return encryption details of earlier stored data with given
+        checksum as keyword arguments of `Cloud._create_metadata()`, or
+        None if the data is not stored yet.
+        """
+        with self._lock:
+            old_metadata = self.cloud._find_data(checksum)
+            if not old_metadata:
+                return None
+            return dict(
+                encryption_key=old_metadata["encryption_key"],
+                encrypted_size=old_metadata["encrypted_size"],
+                encrypted_checksum=old_metadata["encrypted_checksum"],
+                pack=old_metadata.get("pack"),
+                pack_offset=old_metadata.get("pack_offset"),
+                chunks=self.cloud._metadata_chunks(old_metadata),
+                compression=old_metadata.get("compression"))
+
+    def _store_chunked(self, plaintext_fp, size):
+        """
+        Store data in chunks like `Cloud._store_chunks()`, but encrypt and
+        upload the chunks without holding the lock. Return encryption
+        details as keyword arguments of `Cloud._create_metadata()`.
+        """
+        chunks = list()
+        for data in self.cloud._chunk_stream(plaintext_fp, size):
+            checksum = checksum_data(data)
+            with self._striped_lock(self._chunk_locks, checksum):
+                with self._lock:
+                    chunk = self._stored_chunks.get(checksum) or \
+                        self.cloud._find_chunk(checksum)
+                if chunk is None:
+                    chunk = self.cloud._store_chunk(
+                        data, checksum, self._providers.get())
+                    with self._lock:
+                        self._stored_chunks[checksum] = chunk
+            chunk = dict((field, chunk.get(field)) for field in CHUNK_FIELDS
+                         if field != "size")
+            chunk["size"] = len(data)
+            chunks.append(chunk)
+        return dict(encryption_key=None, encrypted_checksum=None,
+                    encrypted_size=sum(chunk["encrypted_size"]
+                                       for chunk in chunks),
+                    chunks=chunks)
+
+    def _add_to_pack(self, encrypted_data):
+        with self._lock:
+            return self.cloud._add_to_pack(encrypted_data)
+
+    def _commit_metadata(self, metadata):
+        """
+        Store metadata to cloud and update database. Metadata stored in its
+        own key is uploaded without holding the lock. Metadata of data in
+        the current pack is committed with the pack, which is stored while
+        holding the lock when it is full.
+        """
+        with self._lock:
+            if self.cloud.metadata_layout == "segment" or (
+                    metadata.get("pack") and
+                    metadata["pack"] == self.cloud._pack_key):
+                return self.cloud._commit_metadata(metadata)
+        self._metadata_providers.get().store(
+            metadata["key"], self.cloud._encrypt_metadata(metadata))
+        with self._lock:
+            self.cloud.database.update(metadata)
+
+    def _store_data(self, data, checksum):
+        """
+        Encrypt data and store it to cloud. Return its encryption details
+        as keyword arguments of `Cloud._create_metadata()`.
+        """
+        if self.cloud._is_chunked(len(data)):
+            return self._store_chunked(StringIO(data), len(data))
+        (encryption_key, encrypted_data, encrypted_size, encrypted_checksum,
+         compression) = self.cloud._encrypt_data(data)
+        pack, pack_offset = None, 0
+        if self.cloud._is_packed(len(data)):
+            pack, pack_offset = self._add_to_pack(encrypted_data)
+        else:
+            self._providers.get().store(checksum, encrypted_data)
+        return dict(encryption_key=encryption_key,
+                    encrypted_size=encrypted_size,
+                    encrypted_checksum=encrypted_checksum,
+                    compression=compression, pack=pack,
+                    pack_offset=pack_offset)
+
+    def _store(self, data, cloud_filename, stat_info):
+        key, checksum = checksums_data(data, cloud_filename)
+        self._begin_store()
+        try:
+            with self._striped_lock(self._data_locks, checksum):
+                encryption = self._old_encryption(checksum) or \
+                    self._store_data(data, checksum)
+                metadata = self.cloud._create_metadata(
+                    key, filename=cloud_filename, size=len(data),
+                    stat_info=stat_info, checksum=checksum, **encryption)
+                self._commit_metadata(metadata)
+        finally:
+            self._end_store()
+        return metadata
+
+    def _store_file(self, filename, checksum, size):
+        """
+        Encrypt file and store it to cloud. Return its encryption details
+        as keyword arguments of `Cloud._create_metadata()`.
+        """
+        if self.cloud._is_chunked(size):
+            plaintext_fp = file(filename, "rb")
+            try:
+                return self._store_chunked(plaintext_fp, size)
+            finally:
+                plaintext_fp.close()
+        if self.cloud._is_packed(size):
+            encrypted_fp = StringIO()
+            (encryption_key, encrypted_size, encrypted_checksum,
+             compression) = self.cloud._encrypt_file(filename, encrypted_fp)
+            pack, pack_offset = self._add_to_pack(encrypted_fp.getvalue())
+        elif self.cloud.provider.is_resumable(size):
+            pack, pack_offset = None, 0
+            (encryption_key, encrypted_size, encrypted_checksum,
+             compression) = self.cloud._store_spooled(
+                filename, checksum, self._providers.get())
+        else:
+            pack, pack_offset = None, 0
+            encrypted_fp = self._providers.get().open_writer(checksum)
+            try:
+                (encryption_key, encrypted_size, encrypted_checksum,
+                 compression) = self.cloud._encrypt_file(
+                    filename, encrypted_fp)
+            except:
+                encrypted_fp.abort()
+                raise
+            encrypted_fp.close()
+        return dict(encryption_key=encryption_key,
+                    encrypted_size=encrypted_size,
+                    encrypted_checksum=encrypted_checksum,
+                    compression=compression, pack=pack,
+                    pack_offset=pack_offset)
+
+    def _store_from_filename(self, filename, cloud_filename):
+        stat_info = os.stat(filename)
+        with self._lock:
+            cached = self.cloud._cached_checksums(cloud_filename, stat_info)
+        if cached:
+            key, checksum = cached
+        else:
+            key, checksum = self.cloud._checksum_file(filename, cloud_filename)
+            with self._lock:
+                self.cloud.database.update_cached_checksums(
+                    cloud_filename, stat_info, key, checksum)
+
+        self._begin_store()
+        try:
+            with self._striped_lock(self._data_locks, checksum):
+                with self._lock:
+                    unchanged_metadata = self.cloud._find_unchanged(
+                        key, stat_info)
+                if unchanged_metadata:
+                    return unchanged_metadata
+                encryption = self._old_encryption(checksum) or \
+                    self._store_file(filename, checksum, stat_info.st_size)
+                metadata = self.cloud._create_metadata(
+                    key, filename=cloud_filename, size=stat_info.st_size,
+                    stat_info=stat_info, checksum=checksum, **encryption)
+                self._commit_metadata(metadata)
+        finally:
+            self._end_store()
+        return metadata
+
+    def _retrieve_to_filename(self, metadata, filename):
+        with self._lock:
+            chunks = self.cloud._metadata_chunks(metadata)
+        if chunks is not None:
+            metadata = dict(metadata, chunks=chunks)
+        self.cloud.retrieve_to_filename(
+            metadata, filename, jobs=1, provider=self._providers.get())
+
+    def _sync(self, full):
+        self._begin_store()
+        try:
+            self.cloud.sync(full, self.jobs, lock=self._lock)
+        finally:
+            self._end_store()
+
+    def _delete(self, metadata):
+        """
+        Delete data from cloud after the stores in progress have finished,
+        so that data they share is not deleted as unused.
+        """
+        with self._lock:
+            self._deletes += 1
+            try:
+                while self._stores:
+                    self._stores_done.wait()
+                # All stored chunks are now found from database.
+                self._stored_chunks.clear()
+                self.cloud.delete(metadata)
+            finally:
+                self._deletes -= 1
+                self._stores_done.notify_all()
+
+    def store(self, data, cloud_filename, stat_info=None, callback=None):
+        """
+        Encrypt data and store it to cloud. The result is the metadata of
+        the stored data.
+        """
+        return self._submit(self._store, (data, cloud_filename, stat_info),
+                            callback)
+
+    def store_from_filename(self, filename, cloud_filename=None,
+                            callback=None):
+        """
+        Encrypt file data and store it to cloud. The result is the metadata
+        of the stored file.
+        """
+        if cloud_filename is None:
+            cloud_filename = filename
+        return self._submit(self._store_from_filename,
+                            (filename, cloud_filename), callback)
+
+    def retrieve_to_filename(self, metadata, filename=None, callback=None):
+        """
+        Retrieve data from cloud and decrypt it to given file.
+        """
+        return self._submit(self._retrieve_to_filename, (metadata, filename),
+                            callback)
+
+    def delete(self, metadata, callback=None):
+        """
+        Delete data from cloud.
+        """
+        return self._submit(self._delete, (metadata, ), callback)
+
+    def sync(self, full=False, callback=None):
+        """
+        Sync metadata database from cloud. Metadata objects are retrieved
+        using `jobs` concurrent requests without blocking stores.
+        """
+        return self._submit(self._sync, (full, ), callback)
+
+    def close(self):
+        """
+        Wait for all submitted operations to finish and close the provider
+        connections of the I/O threads. The cloud itself stays connected.
+        """
+        self._pool.close()
+        self._pool.join()
+        self._providers.disconnect()
+        self._metadata_providers.disconnect()
@@ -0,0 +1,576 @@
+"""
+Client for the crypto engine API.
+
+Requests are sent over persistent HTTP connections. Connections are kept
+open between requests and shared by all threads using the client, so that
+a new TCP and TLS connection is not needed for every encrypted file.
+Requests can be spread over many servers, and servers that fail or are
+much slower than the others are taken out of use until they are healthy.
+
+With API version 2 data is streamed to and from the server as raw bytes
+using chunked transfer encoding, so files of any size can be encrypted
+without reading them into memory. Many small data items can be encrypted
+or decrypted in one batch request.
+"""
+
+import base64
+import httplib
+import json
+import os
+import Queue
+import random
+import socket
+import threading
+import time
+import urllib
+import urlparse
+
+from lib import checksum_data
+from lib.batch import read_records, write_record
+from lib.encryption import is_binary, is_seekable
+from lib.stream import BufferReader, BufferWriter, ChecksumReader, \
+    ChecksumWriter
+
+
+# Responses with these statuses are retried, the request may succeed later.
+RETRY_STATUSES = (500, 502, 503, 504, )
+
+
+class CryptoEngineError(Exception):
+    """
+    Exception raised if crypto engine request fails.
+    """
+    def __init__(self, message, status=None):
+        self.message = message
+        self.status = status
+
+    def __str__(self):
+        return self.message
+
+
+class _Endpoint(object):
+    """
+    Pool of at most `connections` persistent connections to one crypto
+    engine server, and the health of the server.
+    """
+    def __init__(self, api_url, connections, timeout):
+        url = urlparse.urlsplit(api_url)
+        if url.scheme not in ["http", "https", ]:
+            raise ValueError(
+                "Crypto engine URL must be http or https: {0}".format(
+                    api_url))
+        self.api_url = api_url
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path.rstrip("/")
+        self.connections = connections
+        self.timeout = timeout
+        # Number of requests sent and not yet finished.
+        self.outstanding = 0
+        # Number of consecutive failed requests.
+        self.failures = 0
+        # Ejected endpoint is not used until it passes a health check after
+        # `ejected_until`.
+        self.ejected = False
+        self.ejected_until = 0
+        self.ejections = 0
+        self.checking = False
+        # Moving average of request times.
+        self.latency = None
+        self.samples = 0
+        self._reset()
+
+    def _reset(self):
+        """
+        Forget all connections. Connections are not shared between
+        processes, so a forked process opens its own connections.
+        """
+        self._pid = os.getpid()
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.connections)
+
+    def connect(self, timeout=None):
+        if self.scheme == "https":
+            return httplib.HTTPSConnection(
+                self.host, self.port, timeout=timeout or self.timeout)
+        return httplib.HTTPConnection(
+            self.host, self.port, timeout=timeout or self.timeout)
+
+    def acquire(self, reuse=True):
+        """
+        Wait for a free connection slot. Return tuple of connection and
+        flag telling whether the connection has been used before. If
+        `reuse` is false, an idle connection is closed and a new one is
+        opened in its place.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+        self._slots.acquire()
+        try:
+            connection = self._idle.get_nowait()
+        except Queue.Empty:
+            return self.connect(), False
+        if reuse:
+            return connection, True
+        connection.close()
+        return self.connect(), False
+
+    def release(self, connection, keep):
+        """
+        Return connection to the pool, or close it if it can not be used
+        for more requests.
+        """
+        if keep:
+            self._idle.put(connection)
+        else:
+            connection.close()
+        self._slots.release()
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        if self._pid != os.getpid():
+            return self._reset()
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+
+class CryptoEngineClient(object):
+    """
+    Send requests to one or more crypto engine servers. Each server has a
+    pool of at most `connections` persistent connections, and at most
+    `connections` requests are sent to it concurrently.
+
+    Each request is sent to the healthy server with the least outstanding
+    requests. A server is ejected after `max_failures` consecutive failed
+    requests, or if its average request time grows to `slow_factor` times
+    that of the fastest server. Ejected server is health checked again
+    after `eject_time` seconds, doubled after each failed health check.
+    Failed requests are retried `retries` times, on other servers when
+    possible and with exponential backoff otherwise.
+    """
+    def __init__(self, api_urls, connections=4, timeout=60, retries=3,
+                 retry_delay=0.5, max_failures=3, eject_time=30,
+                 slow_factor=4):
+        if isinstance(api_urls, basestring):
+            api_urls = [api_urls]
+        if not api_urls:
+            raise ValueError("No crypto engine URL")
+        if connections < 1:
+            raise ValueError("Number of connections must be at least 1")
+        self.endpoints = [_Endpoint(api_url, connections, timeout)
+                          for api_url in api_urls]
+        # API version 2 streams raw data.
+        versions = set(endpoint.path.endswith("/v2")
+                       for endpoint in self.endpoints)
+        if len(versions) != 1:
+            raise ValueError("Crypto engine URLs must use the same API "
+                             "version")
+        self.streaming = versions.pop()
+        self.connections = connections
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.slow_factor = slow_factor
+        self._lock = threading.Lock()
+
+    def _eject(self, endpoint):
+        """
+        Stop using endpoint until it passes a health check. Must be called
+        with the lock held.
+        """
+        endpoint.ejected = True
+        endpoint.ejected_until = time.time() + min(
+            self.eject_time * 2**endpoint.ejections, 3600)
+        endpoint.ejections += 1
+        endpoint.latency = None
+        endpoint.samples = 0
+
+    def _health_check(self, endpoint):
+        """
+        Check health of ejected endpoint, and take it into use again if it
+        is healthy. This is run in a background thread.
+        """
+        healthy = False
+        connection = endpoint.connect(min(self.timeout, 5))
+        try:
+            connection.request("GET", endpoint.path + "/health")
+            response = connection.getresponse()
+            response.read()
+            healthy = 200 <= response.status < 300
+        except (socket.error, httplib.HTTPException):
+            pass
+        finally:
+            connection.close()
+        with self._lock:
+            endpoint.checking = False
+            if healthy:
+                endpoint.ejected = False
+                endpoint.ejections = 0
+                endpoint.failures = 0
+            else:
+                self._eject(endpoint)
+
+    def _select(self, tried):
+        """
+        Return endpoint for next request. Endpoints in `tried` are used
+        only if there are no other healthy endpoints. If all endpoints are
+        ejected, the one whose ejection ends first is used. Ejected
+        endpoints are health checked in background threads, so that a
+        server that does not respond does not delay the request.
+        """
+        now = time.time()
+        for endpoint in self.endpoints:
+            with self._lock:
+                check = endpoint.ejected and not endpoint.checking and \
+                    endpoint.ejected_until <= now
+                if check:
+                    endpoint.checking = True
+            if check:
+                thread = threading.Thread(target=self._health_check,
+                                          args=(endpoint, ))
+                thread.daemon = True
+                thread.start()
+        with self._lock:
+            healthy = [endpoint for endpoint in self.endpoints
+                       if not endpoint.ejected]
+            if not healthy:
+                healthy = [min(self.endpoints,
+                               key=lambda endpoint: endpoint.ejected_until)]
+            untried = [endpoint for endpoint in healthy
+                       if endpoint not in tried]
+            endpoint = min(untried or healthy, key=lambda endpoint: (
+                endpoint.outstanding, random.random()))
+            endpoint.outstanding += 1
+        return endpoint
+
+    def _finish(self, endpoint, failed, elapsed=None):
+        """
+        Record result of request sent to endpoint. Eject the endpoint if it
+        fails or is much slower than the other endpoints.
+        """
+        with self._lock:
+            endpoint.outstanding -= 1
+            if failed:
+                endpoint.failures += 1
+                if endpoint.failures >= self.max_failures and \
+                        not endpoint.ejected:
+                    self._eject(endpoint)
+                return
+            endpoint.failures = 0
+            if elapsed is None:
+                return
+            if endpoint.latency is None:
+                endpoint.latency = elapsed
+            else:
+                endpoint.latency = 0.8 * endpoint.latency + 0.2 * elapsed
+            endpoint.samples += 1
+            others = [other.latency for other in self.endpoints
+                      if other is not endpoint and not other.ejected and
+                      other.samples >= 5]
+            if endpoint.samples >= 5 and others and \
+                    endpoint.latency > self.slow_factor * min(others):
+                self._eject(endpoint)
+
+    def _request(self, name, send, receive, retries, reuse=True):
+        """
+        Send request with `send(connection, url)` and return the result of
+        `receive(response)` for successful response. Failed requests are
+        retried at most `retries` times. Errors raised by `receive()` are
+        not retried, as it may already have written part of the response.
+
+        A request on an idle connection that the server has closed is sent
+        again on a new connection. Requests that can not be sent again must
+        be sent on a new connection, so `reuse` must be false for them.
+        """
+        attempt = 0
+        tried = list()
+        while True:
+            endpoint = self._select(tried)
+            tried.append(endpoint)
+            url = endpoint.path + "/" + name
+            start = time.time()
+            connection, reused = endpoint.acquire(reuse)
+            try:
+                send(connection, url)
+                response = connection.getresponse()
+                if not 200 <= response.status < 300:
+                    response.read()
+            except (socket.error, httplib.HTTPException) as e:
+                endpoint.release(connection, False)
+                if reused:
+                    # The server has closed an idle connection, this is
+                    # not counted as a failed attempt.
+                    self._finish(endpoint, False)
+                    tried.remove(endpoint)
+                    continue
+                self._finish(endpoint, True)
+                error = CryptoEngineError(
+                    "Crypto engine request {0} failed: {1}".format(
+                        endpoint.api_url + "/" + name,
+                        str(e) or e.__class__.__name__))
+            except:
+                endpoint.release(connection, False)
+                self._finish(endpoint, False)
+                raise
+            else:
+                if 200 <= response.status < 300:
+                    try:
+                        result = receive(response)
+                    except (socket.error, httplib.HTTPException) as e:
+                        endpoint.release(connection, False)
+                        self._finish(endpoint, True)
+                        raise CryptoEngineError(
+                            "Crypto engine request {0} failed: {1}".format(
+                                endpoint.api_url + "/" + name,
+                                str(e) or e.__class__.__name__))
+                    except:
+                        endpoint.release(connection, False)
+                        self._finish(endpoint, False)
+                        raise
+                    endpoint.release(connection, not response.will_close)
+                    self._finish(endpoint, False, time.time() - start)
+                    return result
+                endpoint.release(connection, not response.will_close)
+                failed = response.status in RETRY_STATUSES
+                self._finish(endpoint, failed)
+                error = CryptoEngineError(
+                    "Crypto engine request {0} failed: {1} {2}".format(
+                        endpoint.api_url + "/" + name, response.status,
+                        response.reason),
+                    response.status)
+                if not failed:
+                    raise error
+            if attempt >= retries:
+                raise error
+            with self._lock:
+                untried = [endpoint for endpoint in self.endpoints
+                           if not endpoint.ejected and endpoint not in tried]
+            if not untried:
+                # Other servers are retried immediately, the same servers
+                # after a delay.
+                time.sleep(self.retry_delay * 2**attempt)
+            attempt += 1
+
+    def request(self, name, params):
+        """
+        Send POST request with given form parameters to API resource and
+        return the decoded JSON response.
+        """
+        body = urllib.urlencode(params)
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Connection": "keep-alive",
+        }
+
+        def send(connection, url):
+            connection.request("POST", url, body, headers)
+
+        return self._request(name, send, lambda response: json.loads(
+            response.read()), self.retries)
+
+    def stream(self, name, in_fp, out_fp, headers, block_size=2**16):
+        """
+        Stream data read from `in_fp` to API resource with chunked transfer
+        encoding, and write response body to `out_fp`. Return tuple of
+        checksums of sent data and received data, and response headers.
+        Once data has been read from `in_fp`, the request is retried only if
+        `in_fp` can be rewound. Otherwise the data is sent on a new
+        connection, as an idle connection may have been closed by the
+        server.
+        """
+        headers = dict(headers, **{
+            "Content-Type": "application/octet-stream",
+            "Transfer-Encoding": "chunked",
+            "Connection": "keep-alive",
+        })
+        try:
+            start = in_fp.tell()
+        except (AttributeError, IOError):
+            start = None
+        sent = list()
+
+        def send(connection, url):
+            if connection.sock is None:
+                # Data is not read before the connection is open, so
+                # requests to unreachable servers can always be retried.
+                connection.connect()
+            if sent:
+                if start is None:
+                    raise CryptoEngineError(
+                        "Crypto engine request {0} failed: stream can not "
+                        "be sent again".format(name))
+                in_fp.seek(start)
+            sent[:] = [ChecksumReader(in_fp)]
+            connection.putrequest("POST", url, skip_accept_encoding=True)
+            for header, value in headers.items():
+                connection.putheader(header, value)
+            connection.endheaders()
+            while True:
+                data = sent[0].read(block_size)
+                if not data:
+                    break
+                connection.send("{0:x}\r\n{1}\r\n".format(len(data), data))
+            connection.send("0\r\n\r\n")
+
+        def receive(response):
+            received_fp = ChecksumWriter(out_fp)
+            while True:
+                data = response.read(block_size)
+                if not data:
+                    break
+                received_fp.write(data)
+            return response.getheaders(), received_fp.hexdigest()
+
+        response_headers, received = self._request(
+            name, send, receive, self.retries, reuse=start is not None)
+        return sent[0].hexdigest(), received, dict(response_headers)
+
+    def _check_stream(self, name, checksums, sent_header, received_header):
+        """
+        Check stream checksums against response headers. Return tuple of
+        checksums of sent and received data.
+        """
+        sent, received, headers = checksums
+        if headers.get(sent_header) != sent or \
+                headers.get(received_header) != received:
+            raise CryptoEngineError(
+                "Crypto engine request {0} failed: wrong checksum".format(
+                    name))
+        return sent, received
+
+    def encrypt(self, data, encryption_key):
+        """
+        Encrypt data in crypto engine server. Encrypted data is returned as
+        raw bytes.
+        """
+        if self.streaming:
+            encrypted_fp = BufferWriter()
+            checksum, encrypted_checksum = self.encrypt_file(
+                BufferReader(data), encrypted_fp, encryption_key)
+            return {"checksum": checksum,
+                    "encrypted_data": encrypted_fp.buffer,
+                    "encrypted_checksum": encrypted_checksum, }
+        result = self.request(
+            "encrypt",
+            {'data': base64.encodestring(data), 'key': encryption_key,
+             'format': "binary", })
+        result["encrypted_data"] = base64.decodestring(
+            result["encrypted_data"])
+        return result
+
+    def decrypt(self, data, encryption_key):
+        """
+        Decrypt data in crypto engine server. Raw binary data and seekable
+        containers are BASE64 encoded for the request, older data is stored
+        BASE64 encoded.
+        """
+        if self.streaming:
+            plaintext_fp = BufferWriter()
+            encrypted_checksum, checksum = self.decrypt_file(
+                BufferReader(data), plaintext_fp, encryption_key)
+            return {"encrypted_checksum": encrypted_checksum,
+                    "data": plaintext_fp.buffer, "checksum": checksum, }
+        if is_binary(data) or is_seekable(data):
+            data = base64.encodestring(data)
+        result = self.request(
+            "decrypt", {'data': data, 'key': encryption_key, })
+        result["data"] = base64.decodestring(result["data"])
+        return result
+
+    def _batch(self, name, items):
+        """
+        Send items of data and encryption key to batch API resource. Return
+        list of tuples of checksums of sent data and received data, and
+        received data. The checksums are checked against the data.
+        """
+        name = "batch/" + name
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "Connection": "keep-alive",
+        }
+        body_fp = BufferWriter()
+        for data, encryption_key in items:
+            write_record(body_fp, encryption_key, data)
+
+        def send(connection, url):
+            connection.request("POST", url, body_fp.buffer, headers)
+
+        def receive(response):
+            try:
+                return list(read_records(response))
+            except ValueError as e:
+                raise httplib.IncompleteRead(str(e))
+
+        results = self._request(name, send, receive, self.retries)
+        error = CryptoEngineError(
+            "Crypto engine request {0} failed: wrong checksum".format(name))
+        if len(results) != len(items):
+            raise error
+        for (data, _), (sent, received, result_data) in zip(items, results):
+            if sent != checksum_data(data) or \
+                    received != checksum_data(result_data):
+                raise error
+        return results
+
+    def encrypt_batch(self, items):
+        """
+        Encrypt list of tuples of data and encryption key in one request.
+        Return list of results like `encrypt()`. API version 1 has no batch
+        resource, so items are encrypted one at a time with it.
+        """
+        if not self.streaming:
+            return [self.encrypt(data, encryption_key)
+                    for data, encryption_key in items]
+        return [{"checksum": checksum, "encrypted_data": encrypted_data,
+                 "encrypted_checksum": encrypted_checksum, }
+                for checksum, encrypted_checksum, encrypted_data
+                in self._batch("encrypt", items)]
+
+    def decrypt_batch(self, items):
+        """
+        Decrypt list of tuples of encrypted data and encryption key in one
+        request. Return list of results like `decrypt()`.
+        """
+        if not self.streaming:
+            return [self.decrypt(data, encryption_key)
+                    for data, encryption_key in items]
+        return [{"encrypted_checksum": encrypted_checksum, "data": data,
+                 "checksum": checksum, }
+                for encrypted_checksum, checksum, data
+                in self._batch("decrypt", items)]
+
+    def encrypt_file(self, plaintext_fp, encrypted_fp, encryption_key):
+        """
+        Encrypt data read from stream in crypto engine server using API
+        version 2. Encrypted data is written to given stream in binary
+        format. Return tuple of checksums of data and encrypted data.
+        """
+        return self._check_stream("encrypt", self.stream(
+            "encrypt", plaintext_fp, encrypted_fp,
+            {"X-Encryption-Key": encryption_key}),
+            "x-checksum", "x-encrypted-checksum")
+
+    def decrypt_file(self, encrypted_fp, plaintext_fp, encryption_key):
+        """
+        Decrypt data read from stream in crypto engine server using API
+        version 2. Return tuple of checksums of encrypted data and data.
+        """
+        return self._check_stream("decrypt", self.stream(
+            "decrypt", encrypted_fp, plaintext_fp,
+            {"X-Encryption-Key": encryption_key}),
+            "x-encrypted-checksum", "x-checksum")
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        for endpoint in self.endpoints:
+            endpoint.close()
@@ -0,0 +1,594 @@
+"""
+Back up many files to the cloud concurrently.
+
+Checksums are calculated and data is encrypted on a pool of worker
+processes, and encrypted data and metadata are uploaded on a pool of I/O
+threads. With crypto engine encryption small files are collected into
+batches, and each batch is encrypted in one request on an I/O thread.
+Large files are split into chunks on the worker processes, and the chunks
+that are not stored yet are encrypted and uploaded on the I/O threads.
+Chunk boundaries of files larger than one segment are searched in each
+segment concurrently.
+The local metadata database is only accessed from the calling thread, so
+it stays consistent regardless of the number of workers.
+"""
+
+import multiprocessing
+import multiprocessing.pool
+import os
+import Queue
+import signal
+import tempfile
+
+from Crypto import Random
+
+from cloud import CHUNK_FIELDS, DataError, ThreadProviders
+from lib import checksum_data
+from lib.chunking import chunk_stream, segment_candidates, segment_count
+
+
+# Cloud instance used by the worker processes. It is inherited from the
+# parent process when the worker pool is created.
+_worker_cloud = None
+
+
+def _init_worker(cloud):
+    """
+    Initialize worker process. Random number generator must be
+    re-initialized after fork. Interrupts are handled by the calling
+    process, which terminates the workers.
+    """
+    global _worker_cloud
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Random.atfork()
+    _worker_cloud = cloud
+
+
+def _run(function, *args):
+    """
+    Run function and return tuple of error message and result. Exceptions
+    can not be reliably passed between processes, so only the error message
+    is returned.
+    """
+    try:
+        return None, function(*args)
+    except Exception as e:
+        return "{0}: {1}".format(e.__class__.__name__, str(e)), None
+
+
+def _checksum_worker(filename, cloud_filename):
+    """
+    Calculate metadata key and data checksum for file in worker process.
+    """
+    stat_info = os.stat(filename)
+    key, checksum = _worker_cloud._checksum_file(filename, cloud_filename)
+    return stat_info, key, checksum
+
+
+def _encrypt_worker(filename, checksum, size):
+    """
+    Encrypt file to a temporary file in worker process. The temporary file
+    is removed after it has been uploaded to cloud. Files whose upload can
+    be resumed are encrypted to the spool directory instead, and kept there
+    until they have been uploaded.
+    """
+    if _worker_cloud.provider.is_resumable(size):
+        return _worker_cloud._encrypt_to_spool(filename, checksum)
+    encrypted_fp = tempfile.NamedTemporaryFile(
+        prefix="gpgcloud-", delete=False)
+    try:
+        result = _worker_cloud._encrypt_file(filename, encrypted_fp)
+        encrypted_fp.close()
+    except:
+        encrypted_fp.close()
+        os.remove(encrypted_fp.name)
+        raise
+    return (encrypted_fp.name, ) + result
+
+
+def _candidates_worker(filename, index):
+    """
+    Search chunk boundary candidates in one segment of file in worker
+    process.
+    """
+    return segment_candidates(filename, index, _worker_cloud.chunk_size)
+
+
+def _chunk_worker(filename, candidates):
+    """
+    Split file into content-defined chunks in worker process, using chunk
+    boundary candidates of its segments if given. Return list of tuples of
+    offset, size and checksum of the chunks.
+    """
+    chunks = list()
+    offset = 0
+    plaintext_fp = file(filename, "rb")
+    try:
+        for data in chunk_stream(plaintext_fp, _worker_cloud.chunk_size,
+                                 candidates=candidates):
+            chunks.append((offset, len(data), checksum_data(data)))
+            offset += len(data)
+    finally:
+        plaintext_fp.close()
+    return chunks
+
+
+def _checksum(filename, cloud_filename):
+    return _run(_checksum_worker, filename, cloud_filename)
+
+
+def _encrypt(filename, checksum, size):
+    return _run(_encrypt_worker, filename, checksum, size)
+
+
+def _candidates(filename, index):
+    return _run(_candidates_worker, filename, index)
+
+
+def _chunk(filename, candidates=None):
+    return _run(_chunk_worker, filename, candidates)
+
+
+class _Job(object):
+    """
+    State of one file being backed up.
+    """
+    def __init__(self, filename, cloud_filename):
+        self.filename = filename
+        self.cloud_filename = cloud_filename
+        self.stat_info = None
+        self.cached = False
+        self.key = None
+        self.checksum = None
+        self.encryption = None
+        self.metadata = None
+        # Chunk list of chunked file, and the number of its chunks that are
+        # still being uploaded.
+        self.chunks = None
+        self.missing = 0
+        self.failed = False
+        # Chunk boundary candidates of the segments of large chunked file.
+        self.candidates = None
+
+
+class ParallelBackup(object):
+    """
+    Back up files to cloud using worker processes for checksum calculation
+    and encryption, and worker threads for uploading.
+    """
+    # Seconds to wait for finished tasks before checking that no task has
+    # been lost.
+    poll_interval = 1.0
+
+    def __init__(self, cloud, jobs=None):
+        self.cloud = cloud
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        if jobs < 1:
+            raise ValueError("Number of jobs must be at least 1")
+        self.jobs = jobs
+
+    def _upload_data(self, checksum, encrypted_filename):
+        """
+        Upload encrypted data file in I/O thread. Spooled data is kept if
+        the upload fails, so that it can be resumed by the next backup.
+        """
+        if encrypted_filename == self.cloud._spool_filename(checksum):
+            self._providers.get().store_from_filename(
+                checksum, encrypted_filename)
+            self.cloud._remove_spool(checksum)
+            return
+        try:
+            self._providers.get().store_from_filename(
+                checksum, encrypted_filename)
+        finally:
+            os.remove(encrypted_filename)
+
+    def _upload_chunk(self, filename, offset, size, checksum):
+        """
+        Read chunk of file, and encrypt and upload it in I/O thread. Return
+        encryption details of the chunk.
+        """
+        plaintext_fp = file(filename, "rb")
+        try:
+            plaintext_fp.seek(offset)
+            data = plaintext_fp.read(size)
+        finally:
+            plaintext_fp.close()
+        if checksum_data(data) != checksum:
+            raise DataError(
+                filename, "File changed during backup: {0}".format(filename))
+        return self.cloud._store_chunk(data, checksum, self._providers.get())
+
+    def _add_chunk(self, job, index, chunk, size):
+        """
+        Add stored chunk to the chunk list of the file. When all chunks are
+        stored, the metadata of the file and of the files waiting for the
+        same data is submitted.
+        """
+        chunk = dict((field, chunk.get(field)) for field in CHUNK_FIELDS
+                     if field != "size")
+        chunk["size"] = size
+        job.chunks[index] = chunk
+        job.missing -= 1
+        if not job.missing:
+            self._chunks_done(job)
+
+    def _chunks_done(self, job):
+        """
+        Submit the metadata of chunked file and of the files waiting for the
+        same data, when all chunks of the file are stored.
+        """
+        if job.failed:
+            return
+        encryption = (None, sum(chunk["encrypted_size"]
+                                for chunk in job.chunks), None, None, None, 0,
+                      job.chunks)
+        self._stored[job.checksum] = encryption
+        for waiting_job in self._in_flight.pop(job.checksum):
+            self._submit_metadata(waiting_job, *encryption)
+
+    def _submit_chunking(self, job):
+        """
+        Submit file to be split into chunks. Chunk boundary candidates of
+        each segment of a file larger than one segment are searched first on
+        separate worker processes, and the number of the segments still
+        being searched is kept in `job.missing`.
+        """
+        segments = segment_count(job.stat_info.st_size)
+        if segments < 2:
+            return self._submit(self._cpu_pool, "chunks", job, _chunk,
+                                (job.filename, ))
+        job.candidates = [None] * segments
+        job.missing = segments
+        for index in range(segments):
+            self._submit(self._cpu_pool, "candidates", (job, index),
+                         _candidates, (job.filename, index))
+
+    def _fail_chunked(self, job, error):
+        """
+        Record failed chunked file and the files waiting for the same data.
+        """
+        if job.failed:
+            return
+        job.failed = True
+        for waiting_job in self._in_flight.pop(job.checksum):
+            self._fail(waiting_job, error)
+
+    def _encrypt_batch(self, filenames):
+        """
+        Encrypt batch of small files in I/O thread. Return list of results
+        like `_encrypt_worker()`.
+        """
+        results = self.cloud._encrypt_data_batch(
+            [file(filename, "rb").read() for filename in filenames])
+        encrypted = list()
+        try:
+            for result in results:
+                encrypted_fp = tempfile.NamedTemporaryFile(
+                    prefix="gpgcloud-", delete=False)
+                encrypted.append(encrypted_fp.name)
+                encrypted_fp.write(result[1])
+                encrypted_fp.close()
+        except:
+            for encrypted_filename in encrypted:
+                os.remove(encrypted_filename)
+            raise
+        return [(encrypted_filename, result[0]) + result[2:]
+                for encrypted_filename, result in zip(encrypted, results)]
+
+    def _submit_batch(self):
+        """
+        Submit collected batch of small files to be encrypted.
+        """
+        batch, self._batch = self._batch, list()
+        self._submit(self._io_pool, "batch", batch, _run,
+                     (self._encrypt_batch, [job.filename for job in batch]))
+
+    def _pack_data(self, encrypted_filename):
+        """
+        Add encrypted data file to the current pack object in the calling
+        thread. Return tuple of pack key and offset.
+        """
+        try:
+            return self.cloud._add_to_pack(
+                file(encrypted_filename, "rb").read())
+        finally:
+            os.remove(encrypted_filename)
+
+    def _cached_checksums(self, job):
+        """
+        Return tuple of stat information, metadata key and data checksum
+        of unchanged file from the checksum cache, or None.
+        """
+        stat_info = os.stat(job.filename)
+        cached = self.cloud._cached_checksums(job.cloud_filename, stat_info)
+        if cached:
+            return (stat_info, ) + cached
+        return None
+
+    def _upload_metadata(self, metadata):
+        """
+        Encrypt and upload metadata in I/O thread.
+        """
+        self._metadata_providers.get().store(
+            metadata["key"], self.cloud._encrypt_metadata(metadata))
+
+    def _submit(self, pool, stage, job, function, args):
+        """
+        Submit function to pool. The result is passed to the event queue.
+        """
+        self._pending += 1
+        task = pool.apply_async(
+            function, args,
+            callback=lambda result: self._events.put((stage, job, result)))
+        self._tasks.append((task, stage, job))
+
+    def _check_tasks(self):
+        """
+        Check that submitted tasks have not been lost. Tasks that failed
+        without a result, for example because their result could not be
+        passed back from the worker process, are passed to the event queue
+        as failed. Raise `DataError` if a worker process has died, as the
+        task it was running never finishes.
+        """
+        workers = set(worker.pid for worker in self._cpu_pool._pool)
+        if workers != self._workers:
+            raise DataError(
+                None, "Backup worker process died, some files were not "
+                "stored")
+        tasks = list()
+        for task, stage, job in self._tasks:
+            if not task.ready():
+                tasks.append((task, stage, job))
+            elif not task.successful():
+                self._events.put((stage, job, _run(task.get)))
+        self._tasks = tasks
+
+    def _next_event(self):
+        """
+        Wait for the next finished task. Waiting is interrupted regularly,
+        so that lost tasks are detected and the backup can be interrupted.
+        """
+        if len(self._tasks) > 2 * self._pending:
+            # Forget finished tasks.
+            self._check_tasks()
+        while True:
+            try:
+                return self._events.get(timeout=self.poll_interval)
+            except Queue.Empty:
+                self._check_tasks()
+
+    def _submit_metadata(self, job, encryption_key, encrypted_size,
+                         encrypted_checksum, compression=None, pack=None,
+                         pack_offset=0, chunks=None):
+        """
+        Create metadata for stored data and submit it to be uploaded.
+        """
+        job.metadata = self.cloud._create_metadata(
+            job.key, filename=job.cloud_filename,
+            size=job.stat_info.st_size, stat_info=job.stat_info,
+            checksum=job.checksum, encryption_key=encryption_key,
+            encrypted_size=encrypted_size,
+            encrypted_checksum=encrypted_checksum, pack=pack,
+            pack_offset=pack_offset, chunks=chunks, compression=compression)
+        if pack is not None:
+            # Pack objects are collected and stored in the calling thread.
+            error, _ = _run(self.cloud._commit_metadata, job.metadata)
+            if error:
+                return self._fail(job, error)
+            self.metadata.append(job.metadata)
+            return
+        if self.cloud.metadata_layout == "segment":
+            # Metadata segments are collected in the calling thread.
+            self._pending += 1
+            return self._handle("metadata", job, _run(
+                self.cloud._store_metadata, job.metadata))
+        self._submit(self._io_pool, "metadata", job, _run,
+                     (self._upload_metadata, job.metadata))
+
+    def _fail(self, job, error):
+        """
+        Record failed file.
+        """
+        self.errors.append((job.cloud_filename, error))
+
+    def _handle(self, stage, job, result):
+        """
+        Handle one finished task. This is always run in the calling thread.
+        """
+        self._pending -= 1
+        error, result = result
+
+        if stage == "checksum":
+            if error:
+                return self._fail(job, error)
+            job.stat_info, job.key, job.checksum = result
+            if not job.cached:
+                self.cloud.database.update_cached_checksums(
+                    job.cloud_filename, job.stat_info, job.key, job.checksum)
+            unchanged_metadata = self.cloud._find_unchanged(
+                job.key, job.stat_info)
+            if unchanged_metadata:
+                self.metadata.append(unchanged_metadata)
+                return
+            old_metadata = self.cloud._find_data(job.checksum)
+            if old_metadata:
+                self._submit_metadata(
+                    job, old_metadata["encryption_key"],
+                    old_metadata["encrypted_size"],
+                    old_metadata["encrypted_checksum"],
+                    old_metadata.get("compression"), old_metadata.get("pack"),
+                    old_metadata.get("pack_offset"),
+                    self.cloud._metadata_chunks(old_metadata))
+            elif job.checksum in self._stored:
+                # The same data has been stored, but its metadata may not be
+                # in the database yet.
+                self._submit_metadata(job, *self._stored[job.checksum])
+            elif job.checksum in self._in_flight:
+                # The same data is already being encrypted or uploaded,
+                # wait for it to finish.
+                self._in_flight[job.checksum].append(job)
+            else:
+                self._in_flight[job.checksum] = [job]
+                if self.cloud._is_chunked(job.stat_info.st_size):
+                    self._submit_chunking(job)
+                elif self.cloud._is_batched(job.stat_info.st_size):
+                    self._batch.append(job)
+                    if len(self._batch) >= self.cloud.batch_size:
+                        self._submit_batch()
+                else:
+                    self._submit(self._cpu_pool, "encrypt", job, _encrypt,
+                                 (job.filename, job.checksum,
+                                  job.stat_info.st_size))
+        elif stage == "candidates":
+            # Job of a searched segment is the file and segment index.
+            job, index = job
+            if error:
+                return self._fail_chunked(job, error)
+            job.candidates[index] = result
+            job.missing -= 1
+            if not job.missing and not job.failed:
+                self._submit(self._cpu_pool, "chunks", job, _chunk,
+                             (job.filename, job.candidates))
+        elif stage == "chunks":
+            if error:
+                return self._fail_chunked(job, error)
+            # Chunks are deduplicated against the database in the calling
+            # thread, and only new chunks are uploaded.
+            job.chunks = [None] * len(result)
+            job.missing = len(result)
+            for index, (offset, size, checksum) in enumerate(result):
+                chunk = self._stored_chunks.get(checksum) or \
+                    self.cloud._find_chunk(checksum)
+                if chunk is not None:
+                    self._add_chunk(job, index, chunk, size)
+                elif checksum in self._chunks_in_flight:
+                    self._chunks_in_flight[checksum].append(
+                        (job, index, size))
+                else:
+                    self._chunks_in_flight[checksum] = [(job, index, size)]
+                    self._submit(self._io_pool, "chunk", checksum, _run,
+                                 (self._upload_chunk, job.filename, offset,
+                                  size, checksum))
+            if not result:
+                self._chunks_done(job)
+        elif stage == "chunk":
+            # Job of an uploaded chunk is its checksum.
+            for waiting_job, index, size in self._chunks_in_flight.pop(job):
+                if error:
+                    self._fail_chunked(waiting_job, error)
+                else:
+                    self._add_chunk(waiting_job, index, result, size)
+            if not error:
+                self._stored_chunks[job] = result
+        elif stage == "batch":
+            # Handle each file of the batch as if it was encrypted alone.
+            for batch_job, batch_result in zip(
+                    job, result or [None] * len(job)):
+                self._pending += 1
+                self._handle("encrypt", batch_job, (error, batch_result))
+        elif stage == "encrypt":
+            if error:
+                for waiting_job in self._in_flight.pop(job.checksum):
+                    self._fail(waiting_job, error)
+                return
+            job.encryption = result[1:]
+            if self.cloud._is_packed(job.stat_info.st_size):
+                error, pack = _run(self._pack_data, result[0])
+                if not error:
+                    self._stored[job.checksum] = job.encryption + pack
+                for waiting_job in self._in_flight.pop(job.checksum):
+                    if error:
+                        self._fail(waiting_job, error)
+                    else:
+                        self._submit_metadata(
+                            waiting_job, *(job.encryption + pack))
+                return
+            self._submit(self._io_pool, "data", job, _run,
+                         (self._upload_data, job.checksum, result[0]))
+        elif stage == "data":
+            if not error:
+                self._stored[job.checksum] = job.encryption
+            for waiting_job in self._in_flight.pop(job.checksum):
+                if error:
+                    self._fail(waiting_job, error)
+                else:
+                    self._submit_metadata(waiting_job, *job.encryption)
+        elif stage == "metadata":
+            if error:
+                return self._fail(job, error)
+            self.cloud.database.update(job.metadata)
+            self.metadata.append(job.metadata)
+
+    def backup(self, files):
+        """
+        Back up files to cloud. `files` is an iterable of tuples of local
+        filename and cloud filename. Return list of metadata of the stored
+        files. If some files could not be stored, all other files are still
+        stored and `DataError` is raised for the first failed file.
+        """
+        self.metadata = list()
+        self.errors = list()
+        self._events = Queue.Queue()
+        self._pending = 0
+        # Submitted tasks with their stage and job.
+        self._tasks = list()
+        self._in_flight = dict()
+        # Encryption details of data stored during this backup by checksum.
+        self._stored = dict()
+        # Chunks stored during this backup and chunks being uploaded, by
+        # checksum.
+        self._stored_chunks = dict()
+        self._chunks_in_flight = dict()
+        self._batch = list()
+        self._cpu_pool = multiprocessing.Pool(
+            self.jobs, _init_worker, (self.cloud, ))
+        # Pool replaces worker processes that die, but their tasks are lost.
+        self._workers = set(worker.pid for worker in self._cpu_pool._pool)
+        self._io_pool = multiprocessing.pool.ThreadPool(self.jobs)
+        # Chunks are encrypted in the I/O threads. Encryption pool and crypto
+        # engine client are created on first use, which must not happen
+        # concurrently.
+        self.cloud._encryption_pool()
+        if self.cloud.provider.encryption_method == "cryptoengine":
+            self.cloud._cryptoengine_client()
+        self._metadata_providers = ThreadProviders(
+            self.cloud.metadata_provider)
+        self._providers = ThreadProviders(self.cloud.provider)
+        try:
+            for filename, cloud_filename in files:
+                job = _Job(filename, cloud_filename)
+                error, cached = _run(self._cached_checksums, job)
+                if error or not cached:
+                    self._submit(self._cpu_pool, "checksum", job, _checksum,
+                                 (filename, cloud_filename))
+                else:
+                    # Unchanged file is not read again.
+                    job.cached = True
+                    self._pending += 1
+                    self._handle("checksum", job, (None, cached))
+                # Do not let the amount of queued work grow without limit.
+                while self._pending > 4 * self.jobs:
+                    self._handle(*self._next_event())
+            while self._pending or self._batch:
+                if not self._pending:
+                    self._submit_batch()
+                self._handle(*self._next_event())
+            self.cloud.flush_data()
+            self._cpu_pool.close()
+            self._io_pool.close()
+        finally:
+            self._cpu_pool.terminate()
+            self._io_pool.terminate()
+            self._cpu_pool.join()
+            self._io_pool.join()
+            self._metadata_providers.disconnect()
+            self._providers.disconnect()
+
+        if self.errors:
+            cloud_filename, error = self.errors[0]
+            raise DataError(
+                cloud_filename, "Backup failed for {0} file(s): {1}".format(
+                    len(self.errors), error))
+        return self.metadata
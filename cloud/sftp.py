@@ -2,23 +2,66 @@
 Handle connection to SFTP filesystem.
 """
 
+import collections
 import errno
 import os
 import paramiko
 import paramiko.pkey
 import time
 
-from cloud import Provider
+from cloud import Provider, RangeReader
+from lib import random_string
+from lib.stream import BufferReader
 
 
 class SftpError(Exception):
     pass
 
 
+class SftpWriter(object):
+    """
+    Writable stream to SFTP file. Write requests are pipelined, so they do
+    not wait for the server to acknowledge each write.
+    """
+    def __init__(self, connection, path):
+        self.connection = connection
+        self.path = path
+        self.fp = self.connection.file(path, "wb")
+        self.fp.set_pipelined(True)
+
+    def write(self, data):
+        self.fp.write(data)
+
+    def close(self):
+        """
+        Close the file.
+        """
+        self.fp.close()
+
+    def abort(self):
+        """
+        Close and remove the file.
+        """
+        self.fp.close()
+        self.connection.remove(self.path)
+
+
 class Sftp(Provider):
     """
     Class for SFTP filesystem provider.
     """
+    # Files larger than one range are downloaded in ranges using concurrent
+    # connections.
+    range_size = 8 * 2**20
+    download_jobs = 4
+    # Number of files read at a time when listing data.
+    list_window = 16
+    # Modification times are listed with one second resolution, so a file
+    # modified less than this many seconds before it was listed may still
+    # be rewritten with the same size and modification time. Modification
+    # times are compared with the clock of the server.
+    modified_window = 2
+
     def _create_bucket(self, bucket_name):
         """
         Create bucket, if it does not exist.
@@ -60,6 +103,17 @@ class Sftp(Provider):
         self.identity_file = self.config.config.get("sftp", "identity_file")
         self.remote_directory = self.config.config.get(
             "sftp", "remote_directory")
+        if self.config.config.has_option("sftp", "range_size"):
+            self.range_size = self.config.config.getint(
+                "sftp", "range_size")
+        if self.config.config.has_option("sftp", "download_jobs"):
+            self.download_jobs = self.config.config.getint(
+                "sftp", "download_jobs")
+        if self.config.config.has_option("sftp", "list_window"):
+            self.list_window = self.config.config.getint(
+                "sftp", "list_window")
+            if self.list_window < 1:
+                raise ValueError("List window must be at least 1")
         self.encryption_method = encryption_method
         self.connection = None
 
@@ -94,14 +148,20 @@ class Sftp(Provider):
             return
         self.connection.close()
         self.transport.close()
+        self.connection = None
 
     def store(self, key, data):
         """
-        Store data to SFTP filesystem.
+        Store data to SFTP filesystem. Data can be a string or a bytearray,
+        and it is written in blocks without copying all of it.
         """
         assert(self.connection is not None)
         data_file = self.connection.file(self.bucket + "/" + key, "w")
-        data_file.write(data)
+        reader = BufferReader(data)
+        block = reader.read(2**20)
+        while block:
+            data_file.write(block)
+            block = reader.read(2**20)
         data_file.close()
 
     def store_from_filename(self, key, filename):
@@ -111,6 +171,13 @@ class Sftp(Provider):
         assert(self.connection is not None)
         self.connection.put(filename, self.bucket + "/" + key)
 
+    def open_writer(self, key):
+        """
+        Open writable stream to SFTP filesystem.
+        """
+        assert(self.connection is not None)
+        return SftpWriter(self.connection, self.bucket + "/" + key)
+
     def retrieve(self, key):
         """
         Retrieve data from SFTP filesystem.
@@ -121,12 +188,49 @@ class Sftp(Provider):
         data_file.close()
         return data
 
+    def retrieve_range(self, key, offset, length):
+        """
+        Retrieve part of data from SFTP filesystem.
+        """
+        assert(self.connection is not None)
+        data_file = self.connection.file(self.bucket + "/" + key)
+        try:
+            # Read requests of the range are pipelined.
+            data = "".join(data_file.readv([(offset, length)]))
+        finally:
+            data_file.close()
+        return data
+
     def retrieve_to_filename(self, key, filename):
         """
-        Retrieve data from SFTP filesystem.
+        Retrieve data from SFTP filesystem. Large files are retrieved in
+        ranges using concurrent connections.
+        """
+        assert(self.connection is not None)
+        path = self.bucket + "/" + key
+        size = self.connection.stat(path).st_size
+        if size > self.range_size:
+            RangeReader(self, key, size, self.range_size,
+                        self.download_jobs).copy_to_filename(filename)
+        else:
+            self.connection.get(path, filename)
+
+    def open_reader(self, key):
+        """
+        Open readable stream from SFTP filesystem. Large files are retrieved
+        in ranges using concurrent connections. Smaller files are
+        prefetched, so read requests are sent without waiting for earlier
+        ones to finish.
         """
         assert(self.connection is not None)
-        self.connection.get(self.bucket + "/" + key, filename)
+        path = self.bucket + "/" + key
+        size = self.connection.stat(path).st_size
+        if size > self.range_size:
+            return RangeReader(
+                self, key, size, self.range_size, self.download_jobs)
+        data_file = self.connection.file(path, "rb")
+        data_file.prefetch()
+        return data_file
 
     def delete(self, key):
         """
@@ -135,17 +239,59 @@ class Sftp(Provider):
         assert(self.connection is not None)
         self.connection.remove(self.bucket + "/" + key)
 
+    def _read_listed(self, key, data_file):
+        try:
+            return key, data_file.read()
+        finally:
+            data_file.close()
+
+    def iterate_data(self):
+        """
+        Iterate over data in SFTP filesystem. Yield tuples of key and data.
+        Up to `list_window` files are open at a time, and read requests of
+        all of them are pipelined, so reading a file does not wait for the
+        round trips of the earlier files.
+        """
+        assert(self.connection is not None)
+        opened = collections.deque()
+        try:
+            for key in self.connection.listdir_attr(self.bucket):
+                data_file = self.connection.file(
+                    self.bucket + "/" + key.filename, "rb")
+                if key.st_size:
+                    # The size is known from the listing, so prefetching
+                    # does not need to look it up. Passing it needs
+                    # paramiko 1.16.0 or later.
+                    data_file.prefetch(key.st_size)
+                opened.append((key.filename, data_file))
+                if len(opened) >= self.list_window:
+                    yield self._read_listed(*opened.popleft())
+            while opened:
+                yield self._read_listed(*opened.popleft())
+        finally:
+            for _, data_file in opened:
+                data_file.close()
+
     def list(self):
         """
         List data in SFTP filesystem. Return dictionary of keys with data.
         """
-        assert(self.connection is not None)
-        keys = dict()
-        for key in self.connection.listdir(self.bucket):
-            data_file = self.connection.file(self.bucket + "/" + key)
-            keys[key] = data_file.read()
-            data_file.close()
-        return keys
+        return dict(self.iterate_data())
+
+    def _server_time(self):
+        """
+        Return the current time of the server as the modification time of a
+        probe file written next to the bucket directory. The local clock
+        may differ from the clock of the server.
+        """
+        probe = os.path.join(
+            os.path.dirname(self.bucket) or ".",
+            ".gpgcloud-time-" + random_string(16, "0123456789abcdef"))
+        self.connection.open(probe, "wb").close()
+        try:
+            return self.connection.stat(probe).st_mtime
+        finally:
+            self.connection.remove(probe)
 
     def list_keys(self):
         """
@@ -153,10 +299,16 @@ class Sftp(Provider):
         """
         assert(self.connection is not None)
         keys = dict()
-        for key in self.connection.listdir_attr(self.bucket):
+        # Server time is read before listing, so that files modified during
+        # the listing are modified recently.
+        listed_time = self._server_time()
+        listed_keys = self.connection.listdir_attr(self.bucket)
+        for key in listed_keys:
             keys[key.filename] = key.__dict__
             keys[key.filename]["name"] = key.filename
             keys[key.filename]["size"] = key.st_size
             keys[key.filename]["last_modified"] = time.strftime(
                 '%Y-%m-%d %H:%M:%S', time.localtime(key.st_mtime))
+            keys[key.filename]["modified_recently"] = \
+                key.st_mtime + self.modified_window > listed_time
         return keys
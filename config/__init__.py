@@ -14,6 +14,19 @@ file. Example configuration file:
     [amazon-s3]
     access_key = ACCESSKEY
     secret_access_key = SECRETACCESSKEY
+    # Optional: S3 compatible service used instead of Amazon S3.
+    host = 127.0.0.1
+    port = 9000
+    is_secure = false
+    # Optional: multipart upload part size in bytes (at least 5 MB), number
+    # of parts uploaded concurrently, and directory of upload journals.
+    part_size = 8388608
+    upload_jobs = 4
+    journal_directory = ~/.gpgcloud/uploads
+    # Optional: objects larger than range_size bytes are downloaded in
+    # ranges using download_jobs concurrent requests.
+    range_size = 8388608
+    download_jobs = 4
 
     [sftp]
     host = localhost
@@ -21,15 +34,81 @@ file. Example configuration file:
     username = tkl
     identity_file = /home/tkl/.ssh/testkey
     remote_directory = /home/tkl/GPGCloud/backup
+    # Optional: files larger than range_size bytes are downloaded in ranges
+    # using download_jobs concurrent connections.
+    range_size = 8388608
+    download_jobs = 4
+    # Optional: when listing data, read up to list_window files at a time
+    # with pipelined read requests.
+    list_window = 16
 
     [metadata]
     bucket = METADATABUCKET
+    # Optional: store metadata records packed into segments instead of
+    # one cloud object per file. Segments are never rewritten, so many
+    # clients can back up concurrently. When there are more than
+    # max_segments segments, they are compacted into new segments, and the
+    # replaced segments are deleted segment_grace_period seconds later. The
+    # grace period must be longer than a sync takes and than the clock
+    # differences of the clients.
+    layout = segment
+    segment_size = 1000
+    max_segments = 16
+    segment_grace_period = 3600
 
     [data]
     bucket = DATABUCKET
+    # Optional: collect files smaller than pack_threshold bytes into pack
+    # objects of about pack_size bytes.
+    pack_threshold = 65536
+    pack_size = 8388608
+    # Optional: store files larger than chunk_size bytes in content-defined
+    # chunks of chunk_size bytes on average. Must be a power of two.
+    chunk_size = 1048576
+    # Optional: compress data before symmetric or cryptoengine encryption
+    # using zlib, bz2 or lzma, or auto to use zlib for compressible data.
+    compression = auto
+    compression_level = 6
+    # Optional: encrypt data with symmetric encryption into seekable
+    # containers of separately encrypted blocks of block_size bytes, at
+    # most 67108864, so that byte ranges of files can be restored without
+    # retrieving the whole file.
+    format = seekable
+    block_size = 1048576
+    # Optional: directory where files uploaded with resumable uploads are
+    # encrypted, so that an interrupted backup resumes their uploads. It
+    # needs free space for the encrypted copies of the files being uploaded.
+    # Their encryption keys are encrypted with GPG. The compact command
+    # removes files spooled more than spool_max_age seconds ago.
+    spool_directory = ~/.gpgcloud/spool
+    spool_max_age = 604800
+    # Optional: number of processes encrypting and decrypting blocks with
+    # multicore encryption method, and searching chunk boundaries of files
+    # larger than 4 MB (default: number of CPUs).
+    encryption_jobs = 4
 
     [cryptoengine]
-    api_url = https://127.0.0.1/api/v1
+    # API version 2 streams raw data, version 1 passes BASE64 encoded data
+    # in form parameters and JSON. Requests are balanced over a comma
+    # separated list of servers using the same API version.
+    api_url = https://127.0.0.1/api/v2
+    # Optional: number of persistent connections to each crypto engine
+    # server, request timeout in seconds, and number of retries of failed
+    # requests.
+    connections = 4
+    timeout = 60
+    retries = 3
+    # Optional: stop using a server after max_failures consecutive failed
+    # requests, or if it is slow_factor times slower than the fastest
+    # server, and check its health again after eject_time seconds.
+    max_failures = 3
+    eject_time = 30
+    slow_factor = 4
+    # Optional: encrypt files smaller than batch_threshold bytes in batches
+    # of batch_size files per request in parallel backup and when they are
+    # packed, and decrypt them in batches when restoring many files.
+    batch_threshold = 65536
+    batch_size = 32
 
 """
 
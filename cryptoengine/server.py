@@ -1,12 +1,40 @@
 """
 Main server application for crypto engine.
+
+API version 1 takes BASE64 encoded data in form parameters and returns it
+BASE64 encoded in JSON. API version 2 takes and returns raw data as
+`application/octet-stream`, and checksums are passed in headers. Batch
+resources of API version 2 encrypt or decrypt many data items in one
+request, packed into a stream of records with `lib.batch`.
+
+Data is passed to celery workers by reference. The web server writes the
+data to a file in the spool directory and passes the file name to the task,
+and the task writes its result to another spool file. Only file names and
+checksums go through the message broker and the result backend, so the web
+server and the celery workers must run on the same host.
+
+Data smaller than `INLINE_THRESHOLD` bytes is encrypted and decrypted in
+the request handler, as queueing a task would take longer than the task
+itself. Data larger than `PARALLEL_THRESHOLD` bytes is encrypted into a
+seekable container in the request handler, and its blocks are encrypted
+on a pool of `PARALLEL_JOBS` processes. Large data that can not be
+processed on the pool, such as BASE64 encoded data, goes to celery workers.
+
+Both API versions have a `health` resource, which clients use to check
+that an ejected server can be used again.
 """
 
 import base64
-from celery import Celery
-from flask import Flask
+import multiprocessing
+import os
+import tempfile
+from celery import Celery, group
+from flask import Flask, jsonify, request, Response
 from flask.ext.restful import abort, Api, reqparse, Resource
-from lib import checksum_data, encryption
+from lib import encryption
+from lib.batch import read_records, write_record
+from lib.stream import Base64Reader, Base64Writer, ChecksumReader, \
+    ChecksumWriter, PeekReader
 from StringIO import StringIO
 
 
@@ -28,7 +56,12 @@ def make_celery(flask_app):
 
 app = Flask(__name__)
 app.config.update(CELERY_BROKER_URL='redis://localhost:6379',
-                  CELERY_RESULT_BACKEND='redis://localhost:6379')
+                  CELERY_RESULT_BACKEND='redis://localhost:6379',
+                  SPOOL_DIRECTORY=tempfile.gettempdir(),
+                  INLINE_THRESHOLD=2**16,
+                  PARALLEL_THRESHOLD=2**24,
+                  PARALLEL_JOBS=multiprocessing.cpu_count(),
+                  BLOCK_SIZE=2**20)
 
 celery = make_celery(app)
 
@@ -37,28 +70,130 @@ api = Api(app)
 parser = reqparse.RequestParser()
 parser.add_argument('data', type=str)
 parser.add_argument('key', type=str)
+parser.add_argument('format', type=str, default="base64")
+
+
+def _spool_file():
+    """
+    Create file in the spool directory for passing data to a celery task.
+    The caller must remove the file.
+    """
+    return tempfile.NamedTemporaryFile(
+        prefix="cryptoengine-", dir=app.config["SPOOL_DIRECTORY"],
+        delete=False)
+
+
+def _remove(*filenames):
+    for filename in filenames:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+# Process pool for large data, created when it is first needed, so that
+# each web server worker process has its own pool.
+_pool = None
+
+
+def _parallel_pool():
+    global _pool
+    if _pool is None:
+        _pool = encryption.encryption_pool(app.config["PARALLEL_JOBS"])
+    return _pool
+
+
+def _run_task(task, size, *args, **kwargs):
+    """
+    Run task for data of given size and return its result. Small data is
+    processed in the calling process, large data on the process pool, and
+    other data by celery workers. Large data is also processed by celery
+    workers if `parallel=False` is given, as the task can not use the pool
+    for it.
+    """
+    if size <= app.config["INLINE_THRESHOLD"]:
+        return task(*args)
+    if size >= app.config["PARALLEL_THRESHOLD"] and \
+            app.config["PARALLEL_JOBS"] > 1 and kwargs.get("parallel", True):
+        return task(*args, pool=_parallel_pool())
+    res = task.delay(*args)
+    res.wait()
+    return res.get()
 
 
 @celery.task()
-def encrypt_data(base64_data, encryption_key):
-    """
-    Encrypt data with the given encryption key.
-    """
-    data = base64.decodestring(base64_data)
-    plaintext_fp = StringIO(data)
-    encrypted_fp = StringIO()
-    checksum, _= encryption.encrypt(
-        plaintext_fp, encrypted_fp, encryption_key)
-    encrypted_fp.seek(0)
-    encrypted_data = encrypted_fp.read()
-    # Encrypted data is BASE64 encoded string. Checksum for the encrypted
-    # data is always calculated over BASE64 encoded data which is stored
-    # into the cloud.
-    base64_encrypted_data = base64.encodestring(encrypted_data)
-    encrypted_checksum = checksum_data(base64_encrypted_data)
+def encrypt_file(plaintext_file, encrypted_file, encryption_key,
+                 data_format="binary", pool=None):
+    """
+    Encrypt file with the given encryption key and write the encrypted data
+    into another file as it is stored into the cloud. Return checksums for
+    the data and the encrypted data.
+
+    With `binary` data format, the encrypted data is stored into the cloud
+    as raw bytes starting with a header, and the checksum for the encrypted
+    data is calculated over them. With `base64` data format, the stored
+    data is the BASE64 encoded encrypted data. If process pool is given,
+    data in `binary` format is encrypted into a seekable container instead,
+    and its blocks are encrypted on the pool.
+    """
+    with open(plaintext_file, "rb") as plaintext_fp, \
+            open(encrypted_file, "wb") as encrypted_fp:
+        checksum_fp = ChecksumWriter(encrypted_fp)
+        if data_format == "binary" and pool is not None:
+            checksum, _ = encryption.encrypt_seekable(
+                plaintext_fp, checksum_fp, encryption_key,
+                app.config["BLOCK_SIZE"], pool=pool,
+                window=2 * app.config["PARALLEL_JOBS"])
+            return {"checksum": checksum,
+                    "encrypted_checksum": checksum_fp.hexdigest(), }
+        if data_format == "binary":
+            checksum_fp.write(encryption.BINARY_MAGIC)
+            output_fp = checksum_fp
+        else:
+            output_fp = Base64Writer(checksum_fp)
+        checksum, _ = encryption.encrypt(
+            plaintext_fp, output_fp, encryption_key)
+        if data_format != "binary":
+            output_fp.flush()
     return {"checksum": checksum,
-            "encrypted_data": base64_encrypted_data,
-            "encrypted_checksum": encrypted_checksum, }
+            "encrypted_checksum": checksum_fp.hexdigest(), }
+
+
+@celery.task()
+def decrypt_file(encrypted_file, plaintext_file, encryption_key,
+                 data_format=None, pool=None):
+    """
+    Decrypt file with the given encryption key and write the data into
+    another file. Return checksums for the encrypted data and the data.
+
+    Encrypted data is read as it is stored into the cloud, either raw bytes
+    starting with a header, a seekable container or BASE64 encoded data.
+    The format is detected from the header, unless `base64` data format is
+    given. Checksum for the encrypted data is calculated over the stored
+    data. If process pool is given, blocks of seekable container are
+    decrypted on the pool.
+    """
+    with open(encrypted_file, "rb") as stored_fp, \
+            open(plaintext_file, "wb") as plaintext_fp:
+        checksum_fp = ChecksumReader(stored_fp)
+        encrypted_fp = PeekReader(checksum_fp)
+        header = encrypted_fp.peek(len(encryption.SEEKABLE_MAGIC))
+        if data_format == "base64":
+            encrypted_fp = Base64Reader(encrypted_fp)
+        elif encryption.is_seekable(header):
+            _, checksum = encryption.decrypt_seekable(
+                encrypted_fp, plaintext_fp, encryption_key, pool=pool,
+                window=2 * app.config["PARALLEL_JOBS"])
+            return {"encrypted_checksum": checksum_fp.hexdigest(),
+                    "checksum": checksum, }
+        elif encryption.is_binary(header):
+            encrypted_fp.read(len(encryption.BINARY_MAGIC))
+        else:
+            encrypted_fp = Base64Reader(encrypted_fp)
+        _, checksum = encryption.decrypt(
+            encrypted_fp, plaintext_fp, encryption_key)
+    return {"encrypted_checksum": checksum_fp.hexdigest(),
+            "checksum": checksum, }
 
 
 class Encrypt(Resource):
@@ -73,40 +208,41 @@ class Encrypt(Resource):
             abort(409, message="No encryption key")
         if not base64_data:
             abort(409, message="No data")
+        data_format = args.get('format', "base64")
+        if data_format not in ["base64", "binary", ]:
+            abort(409, message="Unknown data format")
+        plaintext_fp = _spool_file()
+        encrypted_fp = _spool_file()
         try:
-            res = encrypt_data.delay(base64_data, encryption_key)
-            res.wait()
-            return res.get(), 201
+            data = base64.decodestring(base64_data)
+            plaintext_fp.write(data)
+            plaintext_fp.close()
+            encrypted_fp.close()
+            # Only binary data is encrypted on the process pool.
+            result = _run_task(encrypt_file, len(data), plaintext_fp.name,
+                               encrypted_fp.name, encryption_key,
+                               data_format,
+                               parallel=data_format == "binary")
+            encrypted_data = open(encrypted_fp.name, "rb").read()
         except Exception as e:
             abort(409, message="Encryption failed: {0}".format(str(e)))
-
-
-@celery.task()
-def decrypt_data(base64_encrypted_data, encryption_key):
-    """
-    Decrypt encrypted data with the given encryption key.
-
-    Encrypted data is BASE64 encoded string. Checksum for the encrypted
-    data is always calculated over BASE64 encoded data which is stored
-    into the cloud. Return decrypted data as BASE64 encoded string.
-    """
-    encrypted_checksum = checksum_data(base64_encrypted_data)
-    encrypted_data = base64.decodestring(base64_encrypted_data)
-    encrypted_fp = StringIO(encrypted_data)
-    plaintext_fp = StringIO()
-    _, checksum = encryption.decrypt(
-        encrypted_fp, plaintext_fp, encryption_key)
-    plaintext_fp.seek(0)
-    data = plaintext_fp.read()
-    base64_data = base64.encodestring(data)
-    return {"encrypted_checksum": encrypted_checksum,
-            "data": base64_data,
-            "checksum": checksum, }
+        finally:
+            _remove(plaintext_fp.name, encrypted_fp.name)
+        # Encrypted data is returned as BASE64 encoded string.
+        if data_format == "binary":
+            encrypted_data = base64.encodestring(encrypted_data)
+        result["encrypted_data"] = encrypted_data
+        return result, 201
 
 
 class Decrypt(Resource):
     """
     API for decrypting data.
+
+    Raw binary data and seekable containers are sent as BASE64 encoded
+    string of the data stored into the cloud. Older data is stored BASE64
+    encoded, and it is sent as it is stored. Decrypted data is returned as
+    BASE64 encoded string.
     """
     def post(self):
         args = parser.parse_args()
@@ -116,12 +252,32 @@ class Decrypt(Resource):
         base64_encrypted_data = args.get('data', None)
         if not base64_encrypted_data:
             abort(409, message="No encrypted data")
+        encrypted_fp = _spool_file()
+        plaintext_fp = _spool_file()
         try:
-            res = decrypt_data.delay(base64_encrypted_data, encryption_key)
-            res.wait()
-            return res.get(), 201
+            encrypted_data = base64.decodestring(base64_encrypted_data)
+            # Task is chosen by the size of the decoded data, and only
+            # seekable containers are decrypted on the process pool.
+            size = len(encrypted_data)
+            parallel = encryption.is_seekable(encrypted_data)
+            data_format = None
+            if not encryption.is_binary(encrypted_data) and not parallel:
+                # Older data is decoded only once, when it is decrypted.
+                encrypted_data = base64_encrypted_data
+                data_format = "base64"
+            encrypted_fp.write(encrypted_data)
+            encrypted_fp.close()
+            plaintext_fp.close()
+            result = _run_task(decrypt_file, size, encrypted_fp.name,
+                               plaintext_fp.name, encryption_key,
+                               data_format, parallel=parallel)
+            data = open(plaintext_fp.name, "rb").read()
         except Exception as e:
             abort(409, message="Decryption failed: {0}".format(str(e)))
+        finally:
+            _remove(encrypted_fp.name, plaintext_fp.name)
+        result["data"] = base64.encodestring(data)
+        return result, 201
 
 
 API_URL = '/api/v1'
@@ -130,5 +286,214 @@ api.add_resource(Encrypt, API_URL + '/encrypt')
 api.add_resource(Decrypt, API_URL + '/decrypt')
 
 
+API_V2_URL = '/api/v2'
+
+
+def _error(message):
+    response = jsonify(message=message)
+    response.status_code = 409
+    return response
+
+
+def _input_stream():
+    """
+    Return stream of request body. Body sent with chunked transfer encoding
+    has no content length, and it is read from the WSGI input stream, which
+    is terminated by the server.
+    """
+    if request.content_length is None:
+        return request.environ["wsgi.input"]
+    return request.stream
+
+
+def _spool_request():
+    """
+    Write request body to a spool file. Return the file name.
+    """
+    input_fp = _input_stream()
+    with _spool_file() as spool_fp:
+        try:
+            while True:
+                data = input_fp.read(2**16)
+                if not data:
+                    break
+                spool_fp.write(data)
+        except:
+            _remove(spool_fp.name)
+            raise
+    return spool_fp.name
+
+
+def _stream_response(filename, headers, block_size=2**16):
+    """
+    Return response that streams the contents of given spool file and
+    removes it.
+    """
+    def generate():
+        try:
+            with open(filename, "rb") as fp:
+                while True:
+                    data = fp.read(block_size)
+                    if not data:
+                        break
+                    yield data
+        finally:
+            _remove(filename)
+    return Response(generate(), 200, headers=headers,
+                    mimetype="application/octet-stream")
+
+
+def _run_stream_task(task, encryption_key):
+    """
+    Run task for request body spooled to a file. Return tuple of result
+    file name and task result.
+    """
+    input_file = _spool_request()
+    output_fp = _spool_file()
+    output_fp.close()
+    try:
+        return output_fp.name, _run_task(
+            task, os.path.getsize(input_file), input_file, output_fp.name,
+            encryption_key)
+    except:
+        _remove(output_fp.name)
+        raise
+    finally:
+        _remove(input_file)
+
+
+@app.route(API_V2_URL + '/encrypt', methods=['POST', ])
+def encrypt_stream():
+    """
+    Encrypt request body with the encryption key given in `X-Encryption-Key`
+    header. Response body is the encrypted data in binary format, as it is
+    stored into the cloud. Checksums for the data and the encrypted data are
+    returned in `X-Checksum` and `X-Encrypted-Checksum` headers.
+
+    Request body is spooled to a file before it is encrypted, and encrypted
+    data is spooled to a file, so that the checksums are known before the
+    response is sent.
+    """
+    encryption_key = request.headers.get("X-Encryption-Key")
+    if not encryption_key:
+        return _error("No encryption key")
+    try:
+        encrypted_file, result = _run_stream_task(
+            encrypt_file, encryption_key)
+    except Exception as e:
+        return _error("Encryption failed: {0}".format(str(e)))
+    return _stream_response(
+        encrypted_file,
+        {"X-Checksum": result["checksum"],
+         "X-Encrypted-Checksum": result["encrypted_checksum"], })
+
+
+@app.route(API_V2_URL + '/decrypt', methods=['POST', ])
+def decrypt_stream():
+    """
+    Decrypt request body with the encryption key given in `X-Encryption-Key`
+    header. Request body is the encrypted data as it is stored into the
+    cloud, either raw bytes starting with a header or BASE64 encoded data.
+    Response body is the decrypted data. Checksums for the encrypted data
+    and the data are returned in `X-Encrypted-Checksum` and `X-Checksum`
+    headers.
+    """
+    encryption_key = request.headers.get("X-Encryption-Key")
+    if not encryption_key:
+        return _error("No encryption key")
+    try:
+        plaintext_file, result = _run_stream_task(
+            decrypt_file, encryption_key)
+    except Exception as e:
+        return _error("Decryption failed: {0}".format(str(e)))
+    return _stream_response(
+        plaintext_file,
+        {"X-Encrypted-Checksum": result["encrypted_checksum"],
+         "X-Checksum": result["checksum"], })
+
+
+def _run_batch(task, checksum_fields):
+    """
+    Run task for each record of encryption key and data in request body
+    as one group of celery tasks. Small batches are processed in the
+    request handler. Return response that streams records of the two
+    checksums named in `checksum_fields` and the result data, in the order
+    of the request.
+    """
+    filenames = list()
+    arguments = list()
+    size = 0
+    try:
+        for encryption_key, data in read_records(_input_stream()):
+            with _spool_file() as input_fp:
+                filenames.append(input_fp.name)
+                input_fp.write(data)
+            with _spool_file() as output_fp:
+                filenames.append(output_fp.name)
+            arguments.append((input_fp.name, output_fp.name, encryption_key))
+            size += len(data)
+        if size <= app.config["INLINE_THRESHOLD"]:
+            results = [task(*args) for args in arguments]
+        else:
+            results = group(
+                task.s(*args) for args in arguments).apply_async().get()
+    except:
+        _remove(*filenames)
+        raise
+
+    def generate():
+        try:
+            for result, output_file in zip(results, filenames[1::2]):
+                record_fp = StringIO()
+                write_record(record_fp, result[checksum_fields[0]],
+                             result[checksum_fields[1]],
+                             open(output_file, "rb").read())
+                yield record_fp.getvalue()
+        finally:
+            _remove(*filenames)
+    return Response(generate(), 200, mimetype="application/octet-stream")
+
+
+@app.route(API_V2_URL + '/batch/encrypt', methods=['POST', ])
+def encrypt_batch():
+    """
+    Encrypt many data items. Request body is a stream of records of
+    encryption key and data. Response body is a stream of records of
+    checksum for the data, checksum for the encrypted data and the
+    encrypted data in binary format.
+    """
+    try:
+        return _run_batch(encrypt_file, ("checksum", "encrypted_checksum"))
+    except Exception as e:
+        return _error("Encryption failed: {0}".format(str(e)))
+
+
+@app.route(API_V2_URL + '/batch/decrypt', methods=['POST', ])
+def decrypt_batch():
+    """
+    Decrypt many data items. Request body is a stream of records of
+    encryption key and encrypted data as it is stored into the cloud.
+    Response body is a stream of records of checksum for the encrypted
+    data, checksum for the data and the decrypted data.
+    """
+    try:
+        return _run_batch(decrypt_file, ("encrypted_checksum", "checksum"))
+    except Exception as e:
+        return _error("Decryption failed: {0}".format(str(e)))
+
+
+@app.route(API_URL + '/health', methods=['GET', ])
+@app.route(API_V2_URL + '/health', methods=['GET', ])
+def health():
+    """
+    Health check used by clients to decide whether to send requests to
+    this server. The server is healthy if it can write to the spool
+    directory.
+    """
+    if not os.access(app.config["SPOOL_DIRECTORY"], os.W_OK):
+        return jsonify(status="spool directory is not writable"), 503
+    return jsonify(status="ok")
+
+
 if __name__ == "__main__":
     app.run(port=8000, debug=True)
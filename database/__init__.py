@@ -3,6 +3,7 @@ Handle metadata database.
 """
 
 import dataset
+from dataset.persistence.util import guess_type
 
 
 class MetaDataDB(object):
@@ -15,6 +16,9 @@ class MetaDataDB(object):
         self._database = dataset.connect(
             self.config.config.get("general", "database"))
         self._metadata = self._database["metadata"]
+        self._sync = self._database["sync"]
+        self._chunks = self._database["chunks"]
+        self._stat_cache = self._database["stat_cache"]
 
     def drop(self, provider=None):
         """
@@ -22,15 +26,46 @@ class MetaDataDB(object):
         """
         if provider is not None:
             self._metadata.delete(provider=provider)
+            self._sync.delete(provider=provider)
+            self._chunks.delete(provider=provider)
         else:
             self._metadata.drop()
             self._metadata = self._database["metadata"]
+            self._sync.drop()
+            self._sync = self._database["sync"]
+            self._chunks.drop()
+            self._chunks = self._database["chunks"]
+
+    def _split_chunks(self, metadata):
+        """
+        Split metadata to the metadata row and the rows of the chunk list.
+        Only the number of chunks is stored in the metadata table.
+        """
+        if "chunks" not in metadata:
+            return metadata, list()
+        metadata = dict(metadata)
+        chunks = metadata.pop("chunks")
+        metadata["chunked"] = len(chunks)
+        chunk_rows = list()
+        for position, chunk in enumerate(chunks):
+            chunk = dict(chunk)
+            chunk.update(provider=metadata["provider"], key=metadata["key"],
+                         position=position)
+            chunk_rows.append(chunk)
+        return metadata, chunk_rows
 
     def update(self, metadata):
         """
         Update database with new or existing metadata.
         """
+        metadata, chunk_rows = self._split_chunks(metadata)
         self._metadata.upsert(metadata, ["name", "key"])
+        if chunk_rows:
+            self._chunks.delete(provider=metadata["provider"],
+                                key=metadata["key"])
+            for chunk in chunk_rows:
+                self._chunks.insert(chunk)
+            self._chunks.create_index(["provider", "checksum"])
 
     def delete(self, key, provider=None):
         """
@@ -38,8 +73,23 @@ class MetaDataDB(object):
         """
         if provider is not None:
             self._metadata.delete(provider=provider, key=key)
+            self._chunks.delete(provider=provider, key=key)
         else:
             self._metadata.delete(key=key)
+            self._chunks.delete(key=key)
+
+    def chunks(self, provider, key):
+        """
+        Return the list of chunks of given metadata key in order.
+        """
+        return list(self._chunks.find(
+            provider=provider, key=key, order_by="position"))
+
+    def find_chunk(self, provider, checksum):
+        """
+        Find stored chunk with given checksum.
+        """
+        return self._chunks.find_one(provider=provider, checksum=checksum)
 
     def list(self, provider=None):
         """
@@ -60,3 +110,113 @@ class MetaDataDB(object):
         Find metadata in database.
         """
         return self._metadata.find_one(**filter)
+
+    def sync_versions(self, provider):
+        """
+        Return dictionary of metadata keys and the versions of the cloud
+        metadata objects they were last synced from.
+        """
+        return dict((s["key"], s["version"])
+                    for s in self._sync.find(provider=provider))
+
+    def sync_version(self, provider, key):
+        """
+        Return the version of the cloud metadata object the metadata key
+        was last synced from, or None.
+        """
+        sync = self._sync.find_one(provider=provider, key=key)
+        if sync:
+            return sync["version"]
+        return None
+
+    def cached_checksums(self, cloud_path, stat_info):
+        """
+        Return tuple of metadata key and data checksum calculated earlier
+        for the file with given stat information, or None if the file has
+        changed since.
+        """
+        cached = self._stat_cache.find_one(
+            dev=stat_info.st_dev, inode=stat_info.st_ino,
+            cloud_path=cloud_path)
+        if not cached or cached["size"] != stat_info.st_size or \
+                cached["mtime"] != stat_info.st_mtime or \
+                cached["ctime"] != stat_info.st_ctime:
+            return None
+        return cached["key"], cached["checksum"]
+
+    def update_cached_checksums(self, cloud_path, stat_info, key, checksum):
+        """
+        Store metadata key and data checksum calculated for the file with
+        given stat information.
+        """
+        self._stat_cache.upsert(
+            dict(dev=stat_info.st_dev, inode=stat_info.st_ino,
+                 cloud_path=cloud_path, size=stat_info.st_size,
+                 mtime=stat_info.st_mtime, ctime=stat_info.st_ctime,
+                 key=key, checksum=checksum),
+            ["dev", "inode", "cloud_path"])
+
+    def update_sync_version(self, provider, key, version):
+        """
+        Store the version of the cloud metadata object synced to database.
+        """
+        self._sync.upsert(dict(provider=provider, key=key, version=version),
+                          ["provider", "key"])
+
+    def delete_sync_version(self, provider, key):
+        """
+        Forget the synced version of the cloud metadata object.
+        """
+        self._sync.delete(provider=provider, key=key)
+
+    def _prepare_table(self, table, rows, keys):
+        """
+        Create missing columns and the index used by upsert. Schema can not
+        be modified inside a transaction.
+        """
+        for row in rows:
+            for column, value in row.items():
+                if column not in table.columns:
+                    table.create_column(column, guess_type(value))
+        table.create_index(keys)
+
+    def update_synced(self, provider, synced):
+        """
+        Update database with metadata synced from cloud and store the
+        synced versions. `synced` is a list of tuples of metadata and
+        version. Version None is not stored. All updates are done in one
+        transaction.
+        """
+        if not synced:
+            return
+        versions = [dict(provider=provider, key=metadata["key"],
+                         version=version) for metadata, version in synced
+                    if version is not None]
+        rows = [self._split_chunks(metadata) for metadata, _ in synced]
+        chunk_rows = [chunk for _, chunks in rows for chunk in chunks]
+        self._prepare_table(
+            self._metadata, [metadata for metadata, _ in rows],
+            ["name", "key"])
+        self._prepare_table(self._sync, versions, ["provider", "key"])
+        if chunk_rows:
+            self._prepare_table(self._chunks, chunk_rows, ["provider", "key"])
+            self._chunks.create_index(["provider", "checksum"])
+        # dataset fails to end transactions in threads that have not
+        # changed the database schema, as its thread state is missing.
+        if not hasattr(self._database.local, "must_release"):
+            self._database.local.must_release = False
+        self._database.begin()
+        try:
+            for metadata, chunks in rows:
+                self._metadata.upsert(metadata, ["name", "key"])
+                if chunks:
+                    self._chunks.delete(provider=provider,
+                                        key=metadata["key"])
+                    for chunk in chunks:
+                        self._chunks.insert(chunk)
+            for version in versions:
+                self._sync.upsert(version, ["provider", "key"])
+        except:
+            self._database.rollback()
+            raise
+        self._database.commit()
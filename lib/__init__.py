@@ -44,3 +44,34 @@ def checksum_file(filename, extra_data=None, block_size=2**20):
     """
     return checksum_stream(
         file(filename), extra_data=extra_data, block_size=block_size)
+
+
+def checksums_data(data, extra_data):
+    """
+    Calculate SHA-256 checksums for given data both with and without extra
+    data appended to it, without copying the data. Return tuple of checksum
+    with extra data and checksum without extra data.
+    """
+    sha256 = hashlib.sha256(data)
+    sha256_extra = sha256.copy()
+    sha256_extra.update(extra_data)
+    return sha256_extra.hexdigest(), sha256.hexdigest()
+
+
+def checksums_file(filename, extra_data, block_size=2**20):
+    """
+    Calculate SHA-256 checksums for given file both with and without extra
+    data appended to it. The file is read only once. Return tuple of
+    checksum with extra data and checksum without extra data.
+    """
+    sha256 = hashlib.sha256()
+    f = file(filename)
+    while True:
+        data = f.read(block_size)
+        if not data:
+            break
+        sha256.update(data)
+    f.close()
+    sha256_extra = sha256.copy()
+    sha256_extra.update(extra_data)
+    return sha256_extra.hexdigest(), sha256.hexdigest()
@@ -0,0 +1,44 @@
+"""
+Pack many data items into one stream for batch requests.
+
+A stream is a sequence of records. Each record starts with the number of
+its fields and the length of each field, followed by the fields.
+"""
+
+import struct
+
+
+_COUNT = struct.Struct(">B")
+_LENGTH = struct.Struct(">I")
+
+
+def _read_exactly(fp, size):
+    data = fp.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated batch record")
+    return data
+
+
+def write_record(fp, *fields):
+    """
+    Write record of given string fields to stream.
+    """
+    fp.write(_COUNT.pack(len(fields)) + "".join(
+        _LENGTH.pack(len(field)) for field in fields))
+    for field in fields:
+        fp.write(field)
+
+
+def read_records(fp):
+    """
+    Read records from stream until the end of the stream. Yield tuples of
+    record fields.
+    """
+    while True:
+        data = fp.read(_COUNT.size)
+        if not data:
+            return
+        count, = _COUNT.unpack(data)
+        lengths = [_LENGTH.unpack(_read_exactly(fp, _LENGTH.size))[0]
+                   for _ in range(count)]
+        yield tuple(_read_exactly(fp, length) for length in lengths)
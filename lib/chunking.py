@@ -0,0 +1,247 @@
+"""
+Split data streams into content-defined chunks.
+
+Chunk boundaries are found with a rolling gear hash over the data, so they
+depend only on the data near them. Inserting or removing data changes only
+the chunks around the change, and the rest of the chunks stay the same.
+
+The hash is 32 bits and shifted by one bit for each byte, so it depends only
+on the last 32 bytes. Chunk boundary candidates of large data can therefore
+be searched in segments concurrently on a process pool, and the chunks are
+the same as when the data is chunked in one process.
+"""
+
+import collections
+import hashlib
+
+
+# Random values for each byte, derived from SHA-256 so that chunk
+# boundaries never change between versions.
+GEAR = [int(hashlib.sha256(chr(i)).hexdigest()[:8], 16) for i in range(256)]
+# Number of bytes the hash depends on.
+WINDOW_SIZE = 32
+# Size of the segments whose chunk boundary candidates are searched
+# concurrently.
+SEGMENT_SIZE = 2**22
+
+
+def _mask(average_size):
+    """
+    Return hash mask of chunk boundaries. Use the high bits of the hash,
+    they depend on most of the window.
+    """
+    bits = average_size.bit_length() - 1
+    return ((1 << bits) - 1) << (32 - bits)
+
+
+def _find_cut(data, start, end, mask):
+    """
+    Return the position after the first byte of data between start and end
+    where the hash calculated from start matches the mask, or None.
+    """
+    h = 0
+    position = start
+    for byte in bytearray(data[start:end]):
+        h = ((h << 1) + GEAR[byte]) & 0xffffffff
+        position += 1
+        if not h & mask:
+            return position
+    return None
+
+
+def _cut_point(data, min_size, max_size, mask):
+    """
+    Return the length of the first chunk of given data.
+    """
+    if len(data) <= min_size:
+        return len(data)
+    position = _find_cut(data, min_size, max_size, mask)
+    if position is None:
+        return min(len(data), max_size)
+    return position
+
+
+def _find_candidates(data, offset, mask):
+    """
+    Return the stream positions after each byte of data where the hash of
+    the whole window matches the mask. Data starts at stream position
+    `offset`, and the first `WINDOW_SIZE - 1` bytes only fill the window.
+    """
+    candidates = list()
+    h = 0
+    position = offset
+    for byte in bytearray(data):
+        h = ((h << 1) + GEAR[byte]) & 0xffffffff
+        position += 1
+        if not h & mask and position - offset >= WINDOW_SIZE:
+            candidates.append(position)
+    return candidates
+
+
+def _candidate_cut_point(data, offset, candidates, min_size, max_size,
+                         mask):
+    """
+    Return the length of the first chunk of data at stream position
+    `offset` like `_cut_point()`, using the sorted chunk boundary
+    candidates of the data. Candidates before the returned cut point are
+    removed.
+    """
+    if len(data) <= min_size:
+        return len(data)
+    end = min(len(data), max_size)
+    # The hash after the first bytes depends on fewer bytes than the whole
+    # window, so they are not candidates.
+    position = _find_cut(data, min_size,
+                         min(end, min_size + WINDOW_SIZE - 1), mask)
+    if position is None:
+        position = end
+        while candidates and candidates[0] - offset <= end:
+            candidate = candidates.popleft() - offset
+            if candidate >= min_size + WINDOW_SIZE:
+                position = candidate
+                break
+    while candidates and candidates[0] - offset <= position:
+        candidates.popleft()
+    return position
+
+
+def _segments(f, mask, pool=None, window=16, candidates=()):
+    """
+    Read data stream in segments of `SEGMENT_SIZE` bytes, and yield tuples
+    of each segment and the chunk boundary candidates in it. Candidates of
+    the segments are taken from list of earlier searched candidates, or
+    searched on process pool, at most `window` segments concurrently.
+    """
+    pending = collections.deque()
+    index = 0
+    offset = 0
+    context = ""
+    while True:
+        data = f.read(SEGMENT_SIZE)
+        if not data:
+            break
+        if index < len(candidates):
+            found = candidates[index]
+        else:
+            args = (context + data, offset - len(context), mask)
+            found = pool.apply_async(_find_candidates, args) if pool else \
+                _find_candidates(*args)
+        pending.append((data, found))
+        index += 1
+        offset += len(data)
+        context = (context + data)[-(WINDOW_SIZE - 1):]
+        if len(pending) >= window:
+            data, found = pending.popleft()
+            yield data, found if isinstance(found, list) else found.get()
+    while pending:
+        data, found = pending.popleft()
+        yield data, found if isinstance(found, list) else found.get()
+
+
+def segment_candidates(filename, index, average_size):
+    """
+    Return the chunk boundary candidates in the segment of given file at
+    given index. Candidates of all segments of a large file can be searched
+    concurrently, and passed to `chunk_stream()`.
+    """
+    offset = index * SEGMENT_SIZE
+    context = min(offset, WINDOW_SIZE - 1)
+    f = file(filename, "rb")
+    try:
+        f.seek(offset - context)
+        data = f.read(SEGMENT_SIZE + context)
+    finally:
+        f.close()
+    return _find_candidates(data, offset - context, _mask(average_size))
+
+
+def segment_count(size):
+    """
+    Return the number of segments in data of given size.
+    """
+    return (size + SEGMENT_SIZE - 1) // SEGMENT_SIZE
+
+
+def check_chunk_size(average_size):
+    """
+    Raise `ValueError` if average chunk size is not a power of two of at
+    least 64 bytes.
+    """
+    if average_size < 64 or average_size & (average_size - 1):
+        raise ValueError("Average chunk size must be a power of two")
+
+
+def chunk_stream(f, average_size=2**20, pool=None, window=16,
+                 candidates=None):
+    """
+    Split data read from opened data stream into chunks. Average chunk
+    size must be a power of two. Chunks are at least a quarter and at most
+    four times the average size. If process pool is given, chunk boundary
+    candidates are searched concurrently in segments of data, at most
+    `window` segments at a time. Candidates of the segments can also be
+    given as a list from `segment_candidates()`.
+    """
+    check_chunk_size(average_size)
+    mask = _mask(average_size)
+    min_size = average_size // 4
+    max_size = average_size * 4
+    if pool is not None or candidates is not None:
+        chunks = _chunk_segments(
+            _segments(f, mask, pool, window, candidates or ()),
+            min_size, max_size, mask)
+    else:
+        chunks = _chunk_data(f, min_size, max_size, mask)
+    for data in chunks:
+        yield data
+
+
+def _chunk_data(f, min_size, max_size, mask):
+    """
+    Split data read from opened data stream into chunks.
+    """
+    data = ""
+    eof = False
+    while True:
+        while not eof and len(data) < max_size:
+            block = f.read(max_size)
+            if not block:
+                eof = True
+            data += block
+        if not data:
+            return
+        position = _cut_point(data, min_size, max_size, mask)
+        yield data[:position]
+        data = data[position:]
+
+
+def _chunk_segments(segments, min_size, max_size, mask):
+    """
+    Split data segments into chunks using their chunk boundary candidates.
+    """
+    data = ""
+    offset = 0
+    candidates = collections.deque()
+    eof = False
+    while True:
+        while not eof and len(data) < max_size:
+            try:
+                segment, found = next(segments)
+            except StopIteration:
+                eof = True
+                break
+            data += segment
+            candidates.extend(found)
+        if not data:
+            return
+        position = _candidate_cut_point(
+            data, offset, candidates, min_size, max_size, mask)
+        yield data[:position]
+        data = data[position:]
+        offset += position
+
+
+def chunk_file(filename, average_size=2**20):
+    """
+    Split given file into chunks.
+    """
+    return chunk_stream(file(filename, "rb"), average_size=average_size)
@@ -0,0 +1,131 @@
+"""
+Compress data before it is encrypted, and decompress it after decryption.
+
+Supported compression methods are `zlib`, `bz2` and `lzma`. LZMA needs the
+`backports.lzma` package on Python 2.
+"""
+
+import bz2
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+COMPRESSION_METHODS = ["zlib", "bz2", "lzma", ]
+
+# Size of the sample used to decide whether data is worth compressing.
+SAMPLE_SIZE = 2**16
+
+
+def check_method(method):
+    """
+    Raise `ValueError` if compression method is not available.
+    """
+    if method not in COMPRESSION_METHODS:
+        raise ValueError("Unknown compression method: {0}".format(method))
+    if method == "lzma" and lzma is None:
+        raise ValueError("LZMA compression needs backports.lzma package")
+
+
+def _compressor(method, level):
+    check_method(method)
+    if method == "zlib":
+        return zlib.compressobj(level)
+    elif method == "bz2":
+        return bz2.BZ2Compressor(max(level, 1))
+    return lzma.LZMACompressor(preset=level)
+
+
+def _decompressor(method):
+    check_method(method)
+    if method == "zlib":
+        return zlib.decompressobj()
+    elif method == "bz2":
+        return bz2.BZ2Decompressor()
+    return lzma.LZMADecompressor()
+
+
+def is_compressible(sample, ratio=0.9):
+    """
+    Return True if the sample compresses to less than `ratio` of its size
+    with fast compression. Already compressed and random data does not.
+    """
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) < ratio * len(sample)
+
+
+def compress(data, method, level=6):
+    """
+    Compress data using given compression method.
+    """
+    compressor = _compressor(method, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, method):
+    """
+    Decompress data compressed using given compression method. Data can
+    be a string or a bytearray.
+    """
+    decompressor = DecompressWriter(None, method)
+    return decompressor.decompress(buffer(data)) + decompressor.finish()
+
+
+class CompressReader(object):
+    """
+    Read data from the underlying stream and return it compressed.
+    """
+    def __init__(self, fp, method, level=6, block_size=2**20):
+        self.fp = fp
+        self.compressor = _compressor(method, level)
+        self.block_size = block_size
+        self.buffer = ""
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            data = self.fp.read(self.block_size)
+            if data:
+                self.buffer += self.compressor.compress(data)
+            else:
+                self.buffer += self.compressor.flush()
+                self.eof = True
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.fp.close()
+
+
+class DecompressWriter(object):
+    """
+    Decompress data written and write it to the underlying stream.
+    `flush()` must be called after all data is written.
+    """
+    def __init__(self, fp, method):
+        self.fp = fp
+        self.method = method
+        self.decompressor = _decompressor(method)
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+    def finish(self):
+        if self.method == "zlib":
+            return self.decompressor.flush()
+        return ""
+
+    def write(self, data):
+        self.fp.write(self.decompress(data))
+
+    def flush(self):
+        self.fp.write(self.finish())
@@ -1,10 +1,59 @@
 """
 Functions for data encryption and decryption through a stream.
+
+Data can also be encrypted into a seekable container. It consists of
+independently encrypted and authenticated blocks and an encrypted block
+index, so that any part of the data can be decrypted without reading the
+data before it. The blocks can be encrypted and decrypted concurrently on a
+process pool.
 """
+import collections
+import hashlib
+import hmac
+import json
+import multiprocessing
+import struct
+
 from Crypto.Cipher import AES
 from Crypto.Hash import SHA256
+from Crypto.Util import Counter
 from Crypto import Random
 
+from lib.compression import compress, decompress
+
+
+# Data is encrypted and decrypted in reads of this size.
+MIN_READ_SIZE = 2**14
+MAX_READ_SIZE = 2**20
+# Encrypted data is stored as raw bytes starting with this header. Data
+# stored before it is BASE64 encoded, and BASE64 encoded data can not start
+# with the header.
+BINARY_MAGIC = "\x89GCBIN1\n"
+# The seekable container starts with a header and ends with a trailer. The
+# magic string can not appear at the start of BASE64 encoded data.
+SEEKABLE_MAGIC = "\x89GCSEEK\n"
+# Magic string, salt and compression method.
+_HEADER = struct.Struct(">8s16s8s")
+# Offset of the index record, salt and magic string.
+_TRAILER = struct.Struct(">Q16s8s")
+# Record type, ciphertext length and nonce. The record header and the
+# ciphertext are followed by HMAC-SHA256 tag.
+_RECORD = struct.Struct(">cI8s")
+_TAG_SIZE = 32
+_BLOCK = "B"
+_INDEX = "I"
+# Record number used for the index record in the authentication tag.
+_INDEX_NUMBER = 2**64 - 1
+# Largest block size of seekable container.
+MAX_BLOCK_SIZE = 2**26
+
+
+class ContainerError(Exception):
+    """
+    Exception raised for corrupted or tampered seekable container.
+    """
+    pass
+
 
 def generate_random_password(random_bytes=32):
     """
@@ -25,7 +74,32 @@ def derive_key_and_iv(password, salt, key_length, iv_length):
     return d[:key_length], d[key_length:key_length + iv_length]
 
 
-def encrypt(in_file, out_file, password, key_length=32, read_blocks=1024):
+def _read_sizes(read_blocks, block_size):
+    """
+    Yield read sizes for stream encryption and decryption. Unless the
+    number of blocks read at a time is given, reads start at 16 KiB and
+    grow up to 1 MiB, so that short data does not need large buffers and
+    long data is processed with few large reads.
+    """
+    if read_blocks is not None:
+        while True:
+            yield read_blocks * block_size
+    read_size = MIN_READ_SIZE
+    while True:
+        yield read_size
+        read_size = min(2 * read_size, MAX_READ_SIZE)
+
+
+def _buffer_read_size(size):
+    """
+    Return read size for encrypting or decrypting buffer of given size in
+    memory.
+    """
+    read_size = min(max(size // 64, MIN_READ_SIZE), MAX_READ_SIZE)
+    return read_size - read_size % AES.block_size
+
+
+def encrypt(in_file, out_file, password, key_length=32, read_blocks=None):
     """
     Encrypt data stream using password as the seed to encryption key.
     Calculate checksums for both the plaintext data and the ciphertext data
@@ -39,9 +113,10 @@ def encrypt(in_file, out_file, password, key_length=32, read_blocks=1024):
     cipher = AES.new(key, AES.MODE_CBC, iv)
     out_file.write(salt)
     ciphertext_checksum.update(salt)
+    read_sizes = _read_sizes(read_blocks, block_size)
     finished = False
     while not finished:
-        chunk = in_file.read(read_blocks * block_size)
+        chunk = in_file.read(next(read_sizes))
         plaintext_checksum.update(chunk)
         if len(chunk) == 0 or len(chunk) % block_size != 0:
             padding_length = ((block_size - len(chunk) % block_size) or
@@ -55,7 +130,7 @@ def encrypt(in_file, out_file, password, key_length=32, read_blocks=1024):
     return plaintext_checksum.hexdigest(), ciphertext_checksum.hexdigest()
 
 
-def decrypt(in_file, out_file, password, key_length=32, read_blocks=1024):
+def decrypt(in_file, out_file, password, key_length=32, read_blocks=None):
     """
     Decrypt data stream using password as the seed to decryption key.
     Calculate checksums for both the ciphertext data and the plaintext data
@@ -68,10 +143,11 @@ def decrypt(in_file, out_file, password, key_length=32, read_blocks=1024):
     ciphertext_checksum.update(salt)
     key, iv = derive_key_and_iv(str(password), salt, key_length, block_size)
     cipher = AES.new(key, AES.MODE_CBC, iv)
+    read_sizes = _read_sizes(read_blocks, block_size)
     next_chunk = ""
     finished = False
     while not finished:
-        encrypted_chunk = in_file.read(read_blocks * block_size)
+        encrypted_chunk = in_file.read(next(read_sizes))
         ciphertext_checksum.update(encrypted_chunk)
         chunk, next_chunk = next_chunk, cipher.decrypt(encrypted_chunk)
         if len(next_chunk) == 0:
@@ -84,6 +160,373 @@ def decrypt(in_file, out_file, password, key_length=32, read_blocks=1024):
     return ciphertext_checksum.hexdigest(), plaintext_checksum.hexdigest()
 
 
+def encrypt_buffer(data, password, header="", key_length=32):
+    """
+    Encrypt data in memory using password as the seed to encryption key.
+    The output is the same as with `encrypt()`, preceded by given header.
+    It is written to a bytearray allocated once for the whole output, and
+    data is read through a memoryview, so only one read at a time is
+    copied. Return tuple of plaintext checksum, ciphertext checksum and
+    encrypted data.
+    """
+    block_size = AES.block_size
+    salt = Random.new().read(block_size)
+    key, iv = derive_key_and_iv(str(password), salt, key_length, block_size)
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    view = memoryview(data)
+    # The data is always padded with 1 to 16 bytes.
+    full_size = len(data) - len(data) % block_size
+    encrypted_data = bytearray(
+        len(header) + block_size + full_size + block_size)
+    encrypted_data[:len(header)] = header
+    position = len(header)
+    encrypted_data[position:position + block_size] = salt
+    position += block_size
+    read_size = _buffer_read_size(len(data))
+    for offset in xrange(0, full_size, read_size):
+        chunk = cipher.encrypt(
+            view[offset:min(offset + read_size, full_size)].tobytes())
+        encrypted_data[position:position + len(chunk)] = chunk
+        position += len(chunk)
+    padding_length = block_size - len(data) % block_size
+    encrypted_data[position:] = cipher.encrypt(
+        view[full_size:].tobytes() + padding_length * chr(padding_length))
+    plaintext_checksum = hashlib.sha256(view).hexdigest()
+    ciphertext_checksum = hashlib.sha256(
+        memoryview(encrypted_data)[len(header):]).hexdigest()
+    return plaintext_checksum, ciphertext_checksum, encrypted_data
+
+
+def decrypt_buffer(encrypted_data, password, offset=0, key_length=32):
+    """
+    Decrypt data encrypted with `encrypt()` in memory using password as the
+    seed to decryption key. Encrypted data starts at given offset. The
+    output is written to a bytearray allocated once for the whole output.
+    Return tuple of ciphertext checksum, plaintext checksum and decrypted
+    data.
+    """
+    block_size = AES.block_size
+    view = memoryview(encrypted_data)[offset:]
+    if len(view) < 2 * block_size or len(view) % block_size:
+        raise ValueError("Invalid encrypted data length")
+    salt = view[:block_size].tobytes()
+    key, iv = derive_key_and_iv(str(password), salt, key_length, block_size)
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    data = bytearray(len(view) - block_size)
+    read_size = _buffer_read_size(len(data))
+    for position in xrange(0, len(data), read_size):
+        chunk = cipher.decrypt(view[block_size + position:block_size +
+                                    position + read_size].tobytes())
+        data[position:position + len(chunk)] = chunk
+    # Remove the padding without copying the data.
+    padding_length = data[-1]
+    if not 1 <= padding_length <= block_size:
+        raise ValueError("Invalid padding")
+    del data[-padding_length:]
+    ciphertext_checksum = hashlib.sha256(view).hexdigest()
+    plaintext_checksum = hashlib.sha256(data).hexdigest()
+    return ciphertext_checksum, plaintext_checksum, data
+
+
+def _derive_keys(password, salt, key_length):
+    """
+    Get encryption key and authentication key from the given password and
+    salt.
+    """
+    return derive_key_and_iv(str(password), salt, key_length, 32)
+
+
+def _seal(keys, record_type, number, data):
+    """
+    Encrypt and authenticate one record of seekable container.
+    """
+    encryption_key, authentication_key = keys
+    nonce = Random.new().read(8)
+    cipher = AES.new(encryption_key, AES.MODE_CTR,
+                     counter=Counter.new(64, prefix=nonce))
+    ciphertext = cipher.encrypt(data)
+    header = _RECORD.pack(record_type, len(ciphertext), nonce)
+    tag = hmac.new(authentication_key, struct.pack(">Q", number) + header +
+                   ciphertext, hashlib.sha256).digest()
+    return header + ciphertext + tag
+
+
+def _open(keys, record_type, number, record):
+    """
+    Authenticate and decrypt one record of seekable container.
+    """
+    encryption_key, authentication_key = keys
+    if len(record) < _RECORD.size + _TAG_SIZE:
+        raise ContainerError("Truncated record {0}".format(number))
+    header = record[:_RECORD.size]
+    found_type, length, nonce = _RECORD.unpack(header)
+    ciphertext = record[_RECORD.size:-_TAG_SIZE]
+    tag = hmac.new(authentication_key, struct.pack(">Q", number) + header +
+                   ciphertext, hashlib.sha256).digest()
+    if found_type != record_type or length != len(ciphertext) or \
+            not hmac.compare_digest(tag, record[-_TAG_SIZE:]):
+        raise ContainerError("Authentication failed for record {0}".format(
+            number))
+    cipher = AES.new(encryption_key, AES.MODE_CTR,
+                     counter=Counter.new(64, prefix=nonce))
+    return cipher.decrypt(ciphertext)
+
+
+def _max_record_length(record_type, blocks):
+    """
+    Return the largest possible ciphertext length of a record, when
+    `blocks` block records precede it. The length in the record header is
+    only authenticated after the whole record has been read, so it must be
+    bounded before reading the record.
+    """
+    if record_type == _BLOCK:
+        # Compression may expand incompressible blocks slightly.
+        return MAX_BLOCK_SIZE + MAX_BLOCK_SIZE // 64 + 1024
+    # The index has the total size, compression method and the record and
+    # plaintext length of each block.
+    return 256 + 32 * blocks
+
+
+def _read_exactly(in_file, size):
+    data = in_file.read(size)
+    while len(data) < size:
+        more = in_file.read(size - len(data))
+        if not more:
+            raise ContainerError("Truncated container")
+        data += more
+    return data
+
+
+def _seal_block(args):
+    """
+    Compress and encrypt one block. This may be run in a worker process.
+    Return tuple of the record and the plaintext length.
+    """
+    keys, number, data, compression, compression_level = args
+    length = len(data)
+    if compression:
+        data = compress(data, compression, compression_level)
+    return _seal(keys, _BLOCK, number, data), length
+
+
+def _open_block(args):
+    """
+    Decrypt and decompress one block. This may be run in a worker process.
+    Return tuple of the record length and the plaintext.
+    """
+    keys, number, record, compression = args
+    data = _open(keys, _BLOCK, number, record)
+    if compression:
+        data = decompress(data, compression)
+    return len(record), data
+
+
+def _map_blocks(function, items, pool=None, window=16):
+    """
+    Yield results of function for each item in order. With a process pool,
+    at most `window` items are processed concurrently.
+    """
+    if pool is None:
+        for item in items:
+            yield function(item)
+        return
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(function, (item, )))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def encryption_pool(jobs=None):
+    """
+    Create process pool for encrypting and decrypting blocks of seekable
+    containers. The random number generator is initialized again in each
+    worker process.
+    """
+    return multiprocessing.Pool(jobs, Random.atfork)
+
+
+def is_binary(data):
+    """
+    Return True if data starts with the header of raw binary encrypted
+    data.
+    """
+    return data[:len(BINARY_MAGIC)] == BINARY_MAGIC
+
+
+def is_seekable(data):
+    """
+    Return True if data starts with the header of seekable container.
+    """
+    return data[:len(SEEKABLE_MAGIC)] == SEEKABLE_MAGIC
+
+
+def encrypt_seekable(in_file, out_file, password, block_size=2**20,
+                     compression=None, compression_level=6, key_length=32,
+                     pool=None, window=16):
+    """
+    Encrypt data stream into seekable container using password as the seed
+    to encryption and authentication keys. Each block of `block_size`
+    bytes is compressed, if compression method is given, and encrypted
+    separately. If process pool is given, at most `window` blocks are
+    encrypted concurrently. Calculate checksums for both the plaintext data
+    and the ciphertext data during the encryption.
+    """
+    if not 0 < block_size <= MAX_BLOCK_SIZE:
+        raise ValueError("Block size must be between 1 and {0}".format(
+            MAX_BLOCK_SIZE))
+    plaintext_checksum = SHA256.new()
+    ciphertext_checksum = SHA256.new()
+    salt = Random.new().read(16)
+    keys = _derive_keys(password, salt, key_length)
+
+    def write(data):
+        out_file.write(data)
+        ciphertext_checksum.update(data)
+
+    def read_blocks():
+        number = 0
+        while True:
+            data = in_file.read(block_size)
+            if not data:
+                return
+            plaintext_checksum.update(data)
+            yield keys, number, data, compression, compression_level
+            number += 1
+
+    write(_HEADER.pack(SEEKABLE_MAGIC, salt, compression or ""))
+    offset = _HEADER.size
+    blocks = list()
+    for record, length in _map_blocks(
+            _seal_block, read_blocks(), pool, window):
+        write(record)
+        blocks.append([len(record), length])
+        offset += len(record)
+    index = json.dumps(dict(size=sum(length for _, length in blocks),
+                            compression=compression, blocks=blocks))
+    write(_seal(keys, _INDEX, _INDEX_NUMBER, index))
+    write(_TRAILER.pack(offset, salt, SEEKABLE_MAGIC))
+
+    return plaintext_checksum.hexdigest(), ciphertext_checksum.hexdigest()
+
+
+def decrypt_seekable(in_file, out_file, password, key_length=32, pool=None,
+                     window=16):
+    """
+    Decrypt data stream encrypted into seekable container using password as
+    the seed to decryption and authentication keys. If process pool is
+    given, at most `window` blocks are decrypted concurrently. Calculate
+    checksums for both the ciphertext data and the plaintext data during
+    the decryption.
+    """
+    ciphertext_checksum = SHA256.new()
+    plaintext_checksum = SHA256.new()
+
+    def read(size):
+        data = _read_exactly(in_file, size)
+        ciphertext_checksum.update(data)
+        return data
+
+    magic, salt, compression = _HEADER.unpack(read(_HEADER.size))
+    if magic != SEEKABLE_MAGIC:
+        raise ContainerError("Not a seekable container")
+    compression = compression.rstrip("\0") or None
+    keys = _derive_keys(password, salt, key_length)
+    # The last record read is the index.
+    records = list()
+
+    def read_blocks():
+        number = 0
+        while True:
+            header = read(_RECORD.size)
+            record_type, length, _ = _RECORD.unpack(header)
+            if length > _max_record_length(record_type, number):
+                raise ContainerError("Invalid length of record {0}".format(
+                    number))
+            records[:] = [header + read(length + _TAG_SIZE)]
+            if record_type != _BLOCK:
+                return
+            yield keys, number, records[0], compression
+            number += 1
+
+    blocks = list()
+    for record_length, data in _map_blocks(
+            _open_block, read_blocks(), pool, window):
+        blocks.append([record_length, len(data)])
+        out_file.write(data)
+        plaintext_checksum.update(data)
+    index = json.loads(_open(keys, _INDEX, _INDEX_NUMBER, records[0]))
+    if index["blocks"] != blocks or index["compression"] != compression:
+        raise ContainerError("Blocks do not match the block index")
+    read(_TRAILER.size)
+
+    return ciphertext_checksum.hexdigest(), plaintext_checksum.hexdigest()
+
+
+def decrypt_range(read_range, encrypted_size, password, offset, length,
+                  key_length=32):
+    """
+    Decrypt `length` bytes starting at `offset` from data encrypted into
+    seekable container. `read_range(offset, length)` is called to read
+    parts of the container, and only the index and the blocks containing
+    the range are read. Return decrypted data, or None if the data is not
+    a seekable container.
+    """
+    def read(range_offset, range_length):
+        data = read_range(range_offset, range_length)
+        if data is None or len(data) != range_length:
+            raise ContainerError("Truncated container")
+        return data
+
+    if encrypted_size < _HEADER.size + _TRAILER.size:
+        return None
+    # Read the trailer and most likely the whole index at once.
+    tail_offset = max(0, encrypted_size - _TRAILER.size - 2**16)
+    tail = read(tail_offset, encrypted_size - tail_offset)
+    index_offset, salt, magic = _TRAILER.unpack(tail[-_TRAILER.size:])
+    if magic != SEEKABLE_MAGIC:
+        return None
+    index_end = encrypted_size - _TRAILER.size
+    if index_offset < tail_offset:
+        tail = read(index_offset, index_end - index_offset)
+    else:
+        tail = tail[index_offset - tail_offset:index_end - tail_offset]
+    keys = _derive_keys(password, salt, key_length)
+    index = json.loads(_open(keys, _INDEX, _INDEX_NUMBER, tail))
+
+    # Find the blocks containing the range.
+    end = min(offset + length, index["size"])
+    selected = list()
+    record_offset = _HEADER.size
+    data_offset = 0
+    for number, (record_length, data_length) in enumerate(index["blocks"]):
+        if data_offset >= end:
+            break
+        if data_offset + data_length > offset:
+            selected.append((number, record_offset, record_length,
+                             data_offset))
+        record_offset += record_length
+        data_offset += data_length
+    if not selected:
+        return ""
+
+    # Read the blocks with one request and decrypt them.
+    first_offset = selected[0][1]
+    _, last_offset, last_length, _ = selected[-1]
+    records = read(first_offset, last_offset + last_length - first_offset)
+    blocks = list()
+    for number, record_offset, record_length, data_offset in selected:
+        record_offset -= first_offset
+        data = _open(keys, _BLOCK, number,
+                     records[record_offset:record_offset + record_length])
+        if index["compression"]:
+            data = decompress(data, index["compression"])
+        blocks.append(data[max(0, offset - data_offset):end - data_offset])
+    return "".join(blocks)
+
+
 if __name__ == "__main__":
     # Small test program with string buffers.
     from StringIO import StringIO
@@ -0,0 +1,202 @@
+"""
+File-like wrappers for passing data through the encryption pipeline
+without intermediate copies on disk.
+"""
+
+import base64
+import binascii
+import hashlib
+
+
+class ChecksumWriter(object):
+    """
+    Write data to the underlying stream. Calculate SHA-256 checksum and the
+    size of data written.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        self.fp.write(data)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+class Base64Writer(object):
+    """
+    Encode data written to BASE64 and write it to the underlying stream.
+    The output is identical to `base64.encode()`. `flush()` must be called
+    after all data is written.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.buffer = ""
+
+    def write(self, data):
+        data = self.buffer + data
+        length = len(data) - len(data) % base64.MAXBINSIZE
+        if length:
+            self.fp.write(base64.encodestring(data[:length]))
+        self.buffer = data[length:]
+
+    def flush(self):
+        if self.buffer:
+            self.fp.write(base64.encodestring(self.buffer))
+            self.buffer = ""
+
+
+class ChecksumReader(object):
+    """
+    Read data from the underlying stream. Calculate SHA-256 checksum and the
+    size of data read.
+    """
+    def __init__(self, fp, block_size=2**20):
+        self.fp = fp
+        self.block_size = block_size
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            chunks = list()
+            while True:
+                data = self.read(self.block_size)
+                if not data:
+                    break
+                chunks.append(data)
+            return "".join(chunks)
+        data = self.fp.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def close(self):
+        self.fp.close()
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+class Base64Reader(object):
+    """
+    Read BASE64 encoded data from the underlying stream and return it
+    decoded. Reads return the requested amount of data until the end of
+    the stream is reached.
+    """
+    def __init__(self, fp, block_size=2**16):
+        self.fp = fp
+        self.block_size = block_size
+        self.encoded = ""
+        self.decoded = ""
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.decoded) < size):
+            data = self.fp.read(self.block_size)
+            if data:
+                # Only decode complete groups of four characters.
+                data = self.encoded + "".join(data.split())
+                length = len(data) - len(data) % 4
+                data, self.encoded = data[:length], data[length:]
+            else:
+                data, self.encoded = self.encoded, ""
+                self.eof = True
+            self.decoded += binascii.a2b_base64(data)
+        if size < 0:
+            size = len(self.decoded)
+        data, self.decoded = self.decoded[:size], self.decoded[size:]
+        return data
+
+
+class PeekReader(object):
+    """
+    Read data from the underlying stream. Data at the start of the stream
+    can be inspected with `peek()` before it is read.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.buffer = ""
+
+    def peek(self, size):
+        while len(self.buffer) < size:
+            data = self.fp.read(size - len(self.buffer))
+            if not data:
+                break
+            self.buffer += data
+        return self.buffer[:size]
+
+    def read(self, size=-1):
+        if not self.buffer:
+            return self.fp.read(size)
+        if size < 0:
+            data, self.buffer = self.buffer + self.fp.read(), ""
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class BufferReader(object):
+    """
+    Read data from a string or bytearray without copying it. Only the data
+    returned by each read is copied.
+    """
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.position = 0
+
+    def read(self, size=-1):
+        end = len(self.view)
+        if size >= 0:
+            end = min(end, self.position + size)
+        data = self.view[self.position:end].tobytes()
+        self.position = max(self.position, end)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += len(self.view)
+        self.position = max(0, offset)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        pass
+
+
+class BufferWriter(object):
+    """
+    Collect data written to a bytearray. Unlike with `StringIO`, the data
+    is not copied again when it is taken out of the stream.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer.extend(data)
+
+
+class RangeWriter(object):
+    """
+    Write only the `length` bytes starting at `offset` of the data written
+    to the underlying stream. Other data is discarded.
+    """
+    def __init__(self, fp, offset, length):
+        self.fp = fp
+        self.start = offset
+        self.end = offset + length
+        self.position = 0
+
+    def write(self, data):
+        start = max(0, self.start - self.position)
+        stop = min(len(data), self.end - self.position)
+        if start < stop:
+            self.fp.write(data[start:stop])
+        self.position += len(data)
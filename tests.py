@@ -2,13 +2,45 @@
 Unit tests for `GPGCloud` project.
 """
 
+import base64
+import BaseHTTPServer
+import errno
+import json
+import multiprocessing.pool
 import os
+import paramiko
+import shutil
+import socket
+import SocketServer
+import sys
 import tempfile
+import threading
+import time
 import unittest
-from cloud import Cloud, amazon, sftp
+import urlparse
+from StringIO import StringIO
+from cloud import Cloud, DataError, Provider, RangeReader, amazon, sftp
+from cloud.asynchronous import AsyncCloud
+from cloud.engine import CryptoEngineClient, CryptoEngineError
+from cloud import parallel
+from cloud.parallel import ParallelBackup
 from config import Config, ConfigError
 from database import MetaDataDB
-from lib import random_string, checksum_file, checksum_data
+from GPGBackup import backup_directory
+from lib import random_string, checksum_file, checksum_data, \
+    checksums_data, checksums_file
+from lib.batch import read_records, write_record
+from lib import chunking
+from lib.chunking import GEAR, chunk_stream, segment_candidates, \
+    segment_count
+from lib.encryption import ContainerError, decrypt, decrypt_buffer, \
+    decrypt_range, decrypt_seekable, encrypt, encrypt_buffer, \
+    encrypt_seekable, encryption_pool, generate_random_password, \
+    is_binary, is_seekable
+from lib.compression import CompressReader, DecompressWriter, compress, \
+    decompress, is_compressible
+from lib.stream import Base64Reader, Base64Writer, BufferReader, \
+    BufferWriter, ChecksumReader, ChecksumWriter
 
 
 class TestUtils(unittest.TestCase):
@@ -38,6 +70,252 @@ class TestUtils(unittest.TestCase):
         data = file("LICENSE").read()
         self.assertEqual(checksum_data(data), checksum)
         self.assertEqual(checksum_file("LICENSE"), checksum)
+        self.assertEqual(checksums_file("LICENSE", "extra"),
+                         (checksum_data(data + "extra"), checksum))
+        self.assertEqual(checksums_data(data, "extra"),
+                         (checksum_data(data + "extra"), checksum))
+
+    def test_utils_stream_writers(self):
+        """
+        Test stream writers used in the encryption pipeline.
+        """
+        data = file("testdata/big_file.txt").read()
+        base64_fp = StringIO()
+        checksum_fp = ChecksumWriter(base64_fp)
+        writer = Base64Writer(checksum_fp)
+        for i in range(0, len(data), 1000):
+            writer.write(data[i:i + 1000])
+        writer.flush()
+        self.assertEqual(base64_fp.getvalue(), base64.encodestring(data))
+        self.assertEqual(checksum_fp.size, len(base64_fp.getvalue()))
+        self.assertEqual(checksum_fp.hexdigest(),
+                         checksum_data(base64_fp.getvalue()))
+
+    def test_utils_stream_readers(self):
+        """
+        Test stream readers used in the decryption pipeline.
+        """
+        data = file("testdata/big_file.txt").read()
+        base64_data = base64.encodestring(data)
+        checksum_fp = ChecksumReader(StringIO(base64_data))
+        reader = Base64Reader(checksum_fp)
+        chunks = list()
+        while True:
+            chunk = reader.read(1000)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.assertTrue(all(len(chunk) == 1000 for chunk in chunks[:-1]))
+        self.assertEqual("".join(chunks), data)
+        self.assertEqual(checksum_fp.size, len(base64_data))
+        self.assertEqual(checksum_fp.hexdigest(), checksum_data(base64_data))
+        reader = BufferReader(bytearray(data))
+        self.assertEqual(reader.read(1000), data[:1000])
+        self.assertEqual(reader.tell(), 1000)
+        reader.seek(-1000, 2)
+        self.assertEqual(reader.read(), data[-1000:])
+        self.assertEqual(reader.read(1000), "")
+        reader.seek(0)
+        writer = BufferWriter()
+        writer.write(reader.read())
+        self.assertEqual(str(writer.buffer), data)
+
+    def test_utils_buffer_encryption(self):
+        """
+        Test encrypting and decrypting data in memory buffers.
+        """
+        data = file("testdata/big_file.txt").read()
+        password = generate_random_password()
+        for size in [0, 15, 16, 17, len(data)]:
+            checksums = encrypt_buffer(data[:size], password, header="HEAD")
+            self.assertTrue(checksums[2].startswith("HEAD"))
+            self.assertEqual(checksums[1], checksum_data(checksums[2][4:]))
+            plaintext_fp = StringIO()
+            self.assertEqual(
+                decrypt(StringIO(str(checksums[2][4:])), plaintext_fp,
+                        password), checksums[1::-1])
+            self.assertEqual(plaintext_fp.getvalue(), data[:size])
+            encrypted_fp = StringIO()
+            encrypt(StringIO(data[:size]), encrypted_fp, password)
+            result = decrypt_buffer("HEAD" + encrypted_fp.getvalue(),
+                                    password, offset=4)
+            self.assertEqual(str(result[2]), data[:size])
+            self.assertEqual(result[1], checksum_data(data[:size]))
+
+    def test_utils_chunking(self):
+        """
+        Test content-defined chunking.
+        """
+        data = file("testdata/random_data.bin").read()
+        chunks = list(chunk_stream(StringIO(data), 2**16))
+        self.assertEqual("".join(chunks), data)
+        self.assertTrue(all(2**14 <= len(chunk) <= 2**18
+                            for chunk in chunks[:-1]))
+        # Inserted data changes only the chunks around it.
+        new_data = data[:100000] + "inserted data" + data[100000:]
+        new_chunks = list(chunk_stream(StringIO(new_data), 2**16))
+        self.assertEqual("".join(new_chunks), new_data)
+        self.assertTrue(len(set(chunks) - set(new_chunks)) <= 2)
+        self.assertRaises(ValueError, list, chunk_stream(StringIO(data), 1000))
+        # Chunk boundary candidates searched in segments concurrently give
+        # the same chunks.
+        segment_size = chunking.SEGMENT_SIZE
+        chunking.SEGMENT_SIZE = 2**15
+        pool = multiprocessing.Pool(2)
+        try:
+            self.assertEqual(chunks, list(chunk_stream(
+                StringIO(data), 2**16, pool=pool, window=2)))
+            candidates = [
+                segment_candidates("testdata/random_data.bin", index, 2**16)
+                for index in range(segment_count(len(data)))]
+            self.assertEqual(chunks, list(chunk_stream(
+                StringIO(data), 2**16, candidates=candidates)))
+            self.assertEqual(new_chunks, list(chunk_stream(
+                StringIO(new_data), 2**16, pool=pool)))
+        finally:
+            chunking.SEGMENT_SIZE = segment_size
+            pool.terminate()
+            pool.join()
+        # Chunks end where the rolling gear hash after the minimum size has
+        # no bits of the mask set.
+        data = data[:2**16] + "\x00" * 2**12 + "abc" * 2**12 + data[:2**16]
+        mask = ((1 << 8) - 1) << 24
+        position = 0
+        for chunk in chunk_stream(StringIO(data), 2**8):
+            h = 0
+            end = position + 2**6
+            while end < min(position + 2**10, len(data)):
+                h = ((h << 1) + GEAR[ord(data[end])]) & 0xffffffff
+                end += 1
+                if not h & mask:
+                    break
+            end = min(end, len(data))
+            self.assertEqual(len(chunk), end - position)
+            position = end
+        self.assertEqual(position, len(data))
+
+    def test_utils_compression(self):
+        """
+        Test compression functions and streams.
+        """
+        data = file("testdata/big_file.txt").read()
+        self.assertTrue(is_compressible(data[:2**16]))
+        self.assertFalse(is_compressible(
+            file("testdata/random_data.bin").read(2**16)))
+        for method in ["zlib", "bz2", ]:
+            compressed_data = compress(data, method)
+            self.assertTrue(len(compressed_data) < len(data))
+            self.assertEqual(data, decompress(compressed_data, method))
+            reader = CompressReader(StringIO(data), method, block_size=1000)
+            chunks = list()
+            while True:
+                chunk = reader.read(100)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            self.assertEqual(data, decompress("".join(chunks), method))
+            plaintext_fp = StringIO()
+            writer = DecompressWriter(plaintext_fp, method)
+            for i in range(0, len(compressed_data), 100):
+                writer.write(compressed_data[i:i + 100])
+            writer.flush()
+            self.assertEqual(data, plaintext_fp.getvalue())
+        self.assertRaises(ValueError, compress, data, "unknown")
+
+    def test_utils_seekable_encryption(self):
+        """
+        Test seekable container encryption and ranged decryption.
+        """
+        data = file("testdata/big_file.txt").read()
+        password = generate_random_password()
+        for compression in [None, "zlib", ]:
+            encrypted_fp = StringIO()
+            plaintext_checksum, ciphertext_checksum = encrypt_seekable(
+                StringIO(data), encrypted_fp, password, block_size=10000,
+                compression=compression)
+            encrypted_data = encrypted_fp.getvalue()
+            self.assertTrue(is_seekable(encrypted_data))
+            self.assertEqual(plaintext_checksum, checksum_data(data))
+            self.assertEqual(ciphertext_checksum,
+                             checksum_data(encrypted_data))
+            plaintext_fp = StringIO()
+            self.assertEqual(
+                decrypt_seekable(StringIO(encrypted_data), plaintext_fp,
+                                 password),
+                (ciphertext_checksum, plaintext_checksum))
+            self.assertEqual(data, plaintext_fp.getvalue())
+            reads = list()
+
+            def read_range(offset, length):
+                reads.append(length)
+                return encrypted_data[offset:offset + length]
+
+            for offset, length in ((0, 10), (9990, 20), (123456, 54321),
+                                   (len(data) - 5, 100), (len(data), 10)):
+                reads = list()
+                self.assertEqual(
+                    data[offset:offset + length],
+                    decrypt_range(read_range, len(encrypted_data), password,
+                                  offset, length))
+                self.assertTrue(sum(reads) < 2**16 + 2 * 54321)
+            # Tampered blocks are detected.
+            tampered_data = encrypted_data[:100] + chr(
+                ord(encrypted_data[100]) ^ 1) + encrypted_data[101:]
+            self.assertRaises(
+                ContainerError, decrypt_range,
+                lambda offset, length: tampered_data[offset:offset + length],
+                len(tampered_data), password, 0, 10)
+            self.assertRaises(
+                ContainerError, decrypt_seekable,
+                StringIO(encrypted_data[:-100]), StringIO(), password)
+            # Tampered record length is rejected before the record is read.
+            # The length follows the 32 byte header and the record type.
+            tampered_fp = StringIO(encrypted_data[:33] + "\xff" * 4 +
+                                   encrypted_data[37:])
+            reads = list()
+
+            def read(size):
+                reads.append(size)
+                return StringIO.read(tampered_fp, size)
+
+            tampered_fp.read = read
+            self.assertRaises(ContainerError, decrypt_seekable, tampered_fp,
+                              StringIO(), password)
+            self.assertTrue(max(reads) < 2**27)
+        self.assertRaises(ValueError, encrypt_seekable, StringIO(data),
+                          StringIO(), password, block_size=2**27)
+        self.assertFalse(is_seekable(base64.encodestring(data)))
+        self.assertEqual(None, decrypt_range(
+            lambda offset, length: data[offset:offset + length], len(data),
+            password, 0, 10))
+
+    def test_utils_multicore_encryption(self):
+        """
+        Test encrypting and decrypting seekable container on process pool.
+        """
+        data = file("testdata/big_file.txt").read()
+        password = generate_random_password()
+        pool = encryption_pool(2)
+        try:
+            encrypted_fp = StringIO()
+            checksums = encrypt_seekable(
+                StringIO(data), encrypted_fp, password, block_size=10000,
+                compression="zlib", pool=pool, window=4)
+            plaintext_fp = StringIO()
+            self.assertEqual(
+                decrypt_seekable(StringIO(encrypted_fp.getvalue()),
+                                 plaintext_fp, password),
+                checksums[::-1])
+            self.assertEqual(data, plaintext_fp.getvalue())
+            plaintext_fp = StringIO()
+            self.assertEqual(
+                decrypt_seekable(StringIO(encrypted_fp.getvalue()),
+                                 plaintext_fp, password, pool=pool, window=4),
+                checksums[::-1])
+            self.assertEqual(data, plaintext_fp.getvalue())
+        finally:
+            pool.terminate()
+            pool.join()
 
 
 class TestConfig(unittest.TestCase):
@@ -172,6 +450,28 @@ class TestAmazonS3(unittest.TestCase):
         metadata_provider.disconnect()
         provider.disconnect()
 
+    def test_amazon_s3_list(self):
+        """
+        Test listing keys and data with prefix and marker.
+        """
+        config = Config()
+        provider = amazon.S3(
+            config, config.config.get("data", "bucket")).connect()
+        for key in ["a-1", "a-2", "a-3", "b-1"]:
+            provider.store(key, "Data " + key)
+        self.assertEqual(provider.list(prefix="a-", marker="a-1"),
+                         {"a-2": "Data a-2", "a-3": "Data a-3"})
+        key_infos = provider.list_keys(prefix="a-")
+        self.assertEqual(sorted(key_infos), ["a-1", "a-2", "a-3"])
+        k = provider.bucket.lookup("a-1")
+        for field in ["name", "size", "etag", "last_modified"]:
+            self.assertEqual(key_infos["a-1"][field], getattr(k, field))
+        self.assertEqual(sorted(provider.list_keys(marker="a-3")), ["b-1"])
+        for key in ["a-1", "a-2", "a-3", "b-1"]:
+            provider.delete(key)
+        self.assertEqual(provider.list(prefix="a-"), dict())
+        provider.disconnect()
+
     def test_amazon_s3_store_filename(self):
         """
         Test storing files to Amazons S3, both to metadata and data buckets.
@@ -194,6 +494,182 @@ class TestAmazonS3(unittest.TestCase):
         metadata_provider.disconnect()
         provider.disconnect()
 
+    def test_amazon_s3_resume_upload(self):
+        """
+        Test resuming interrupted multipart upload to Amazon S3.
+        """
+        config = Config()
+        journal_directory = tempfile.mkdtemp()
+        config.config.set("amazon-s3", "part_size", str(5 * 2**20))
+        config.config.set("amazon-s3", "journal_directory", journal_directory)
+        data_bucket = config.config.get("data", "bucket")
+        provider = amazon.S3(config, data_bucket).connect()
+        data = file("testdata/random_data.bin").read() * 12
+        t = tempfile.NamedTemporaryFile()
+        t.write(data)
+        t.flush()
+        key = checksum_data(data)
+        upload_part = provider._upload_part
+        uploaded = list()
+
+        def interrupted_upload_part(*args):
+            if args[4] == 3:
+                raise IOError("Connection lost")
+            uploaded.append(args[4])
+            return upload_part(*args)
+
+        def counting_upload_part(*args):
+            uploaded.append(args[4])
+            return upload_part(*args)
+
+        provider.upload_jobs = 1
+        provider._upload_part = interrupted_upload_part
+        self.assertRaises(IOError, provider.store_from_filename, key, t.name)
+        self.assertEqual([1, 2], uploaded)
+        self.assertEqual(1, len(os.listdir(journal_directory)))
+        uploaded = list()
+        provider.upload_jobs = 4
+        provider._upload_part = counting_upload_part
+        provider.store_from_filename(key, t.name)
+        self.assertEqual([3], uploaded)
+        self.assertEqual(0, len(os.listdir(journal_directory)))
+        self.assertEqual(data, provider.retrieve(key))
+        provider.delete(key)
+        provider.disconnect()
+        shutil.rmtree(journal_directory)
+
+    def test_amazon_s3_writer(self):
+        """
+        Test writing data to Amazon S3 in parts uploaded concurrently.
+        """
+        config = Config()
+        config.config.set("amazon-s3", "part_size", str(5 * 2**20))
+        config.config.set("amazon-s3", "upload_jobs", "3")
+        data_bucket = config.config.get("data", "bucket")
+        provider = amazon.S3(config, data_bucket).connect()
+        data = file("testdata/random_data.bin").read() * 12
+        key = checksum_data(data)
+        upload_part = provider._upload_part
+        uploaded = list()
+
+        def counting_upload_part(*args):
+            uploaded.append(args[4])
+            return upload_part(*args)
+
+        provider._upload_part = counting_upload_part
+        writer = provider.open_writer(key)
+        for offset in range(0, len(data), 65536):
+            writer.write(data[offset:offset + 65536])
+        writer.close()
+        self.assertEqual([1, 2, 3], sorted(uploaded))
+        self.assertEqual(data, provider.retrieve(key))
+        provider.delete(key)
+        provider.disconnect()
+
+    def test_amazon_s3_resume_backup(self):
+        """
+        Test resuming interrupted backup of large files to Amazon S3 using
+        the encrypted data spooled by the interrupted backup.
+        """
+        config = Config()
+        journal_directory = tempfile.mkdtemp()
+        spool_directory = tempfile.mkdtemp()
+        config.config.set("amazon-s3", "part_size", str(5 * 2**20))
+        config.config.set("amazon-s3", "upload_jobs", "1")
+        config.config.set("amazon-s3", "journal_directory", journal_directory)
+        config.config.set("data", "spool_directory", spool_directory)
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, "symmetric").connect()
+        database = MetaDataDB(config)
+        database.drop()
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        data1 = file("testdata/random_data.bin").read() * 12
+        data2 = file("testdata/random_data.bin").read() * 6
+        t1 = tempfile.NamedTemporaryFile()
+        t1.write(data1)
+        t1.flush()
+        t2 = tempfile.NamedTemporaryFile()
+        t2.write(data2)
+        t2.flush()
+        # Parts are uploaded by providers of worker threads, so the upload
+        # is interrupted for all providers.
+        upload_part = amazon.S3._upload_part
+        uploaded = list()
+
+        def interrupted_upload_part(self, *args):
+            if args[4] == interrupted_part:
+                raise IOError("Connection lost")
+            uploaded.append(args[4])
+            return upload_part(self, *args)
+
+        amazon.S3._upload_part = interrupted_upload_part
+        try:
+            interrupted_part = 3
+            self.assertRaises(DataError, ParallelBackup(cloud, jobs=2).backup,
+                              [(t1.name, "testdata/data1.bin")])
+            self.assertEqual([1, 2], uploaded)
+            self.assertEqual(1, len(os.listdir(journal_directory)))
+            self.assertEqual(2, len(os.listdir(spool_directory)))
+            interrupted_part = 2
+            self.assertRaises(IOError, cloud.store_from_filename, t2.name,
+                              "testdata/data2.bin")
+            self.assertEqual(2, len(os.listdir(journal_directory)))
+            self.assertEqual(4, len(os.listdir(spool_directory)))
+
+            # The next backup uploads only the missing parts.
+            uploaded = list()
+            interrupted_part = None
+            config.config.set("amazon-s3", "upload_jobs", "4")
+            metadata1, = ParallelBackup(cloud, jobs=2).backup(
+                [(t1.name, "testdata/data1.bin")])
+            self.assertEqual([3], uploaded)
+            uploaded = list()
+            metadata2 = cloud.store_from_filename(
+                t2.name, "testdata/data2.bin")
+            self.assertEqual([2], uploaded)
+        finally:
+            amazon.S3._upload_part = upload_part
+        self.assertEqual(0, len(os.listdir(journal_directory)))
+        self.assertEqual(0, len(os.listdir(spool_directory)))
+        self.assertEqual(data1, cloud.retrieve(metadata1))
+        self.assertEqual(data2, cloud.retrieve(metadata2))
+        cloud.delete(metadata1)
+        cloud.delete(metadata2)
+        cloud.disconnect()
+        shutil.rmtree(journal_directory)
+        shutil.rmtree(spool_directory)
+
+    def test_amazon_s3_ranged_download(self):
+        """
+        Test retrieving large data from Amazon S3 in concurrent ranges.
+        """
+        config = Config()
+        config.config.set("amazon-s3", "range_size", str(2**16))
+        config.config.set("amazon-s3", "download_jobs", "3")
+        data_bucket = config.config.get("data", "bucket")
+        provider = amazon.S3(config, data_bucket).connect()
+        data = file("testdata/random_data.bin").read()
+        key = checksum_data(data)
+        provider.store(key, data)
+        reader = provider.open_reader(key)
+        self.assertTrue(isinstance(reader, RangeReader))
+        blocks = list()
+        while True:
+            block = reader.read(10000)
+            if not block:
+                break
+            blocks.append(block)
+        reader.close()
+        self.assertEqual(data, "".join(blocks))
+        t = tempfile.NamedTemporaryFile()
+        provider.retrieve_to_filename(key, t.name)
+        self.assertEqual(data, file(t.name).read())
+        self.assertEqual(None, provider.retrieve_range("missing", 0, 10))
+        provider.delete(key)
+        provider.disconnect()
+
     def test_amazon_s3_delete_all_keys(self):
         """
         Test deleting all Amazons S3 keys, both from metadata and
@@ -211,6 +687,112 @@ class TestAmazonS3(unittest.TestCase):
         metadata_provider.disconnect()
         provider.disconnect()
 
+class _SftpChannel(object):
+    """
+    Channel of an SFTP session over a local socket, without SSH.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+
+    def get_name(self):
+        return "sftp"
+
+    def get_transport(self):
+        return self
+
+    def get_log_channel(self):
+        return "paramiko.test"
+
+    def get_hexdump(self):
+        return False
+
+    def settimeout(self, timeout):
+        pass
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def close(self):
+        self.sock.close()
+
+
+class _SftpHandle(paramiko.SFTPHandle):
+    def __init__(self, flags, server):
+        paramiko.SFTPHandle.__init__(self, flags)
+        self.server = server
+
+    def stat(self):
+        self.server.stats += 1
+        return paramiko.SFTPAttributes.from_stat(
+            os.fstat(self.readfile.fileno()))
+
+    def close(self):
+        self.server.open_files -= 1
+        paramiko.SFTPHandle.close(self)
+
+
+class _SftpServer(paramiko.SFTPServerInterface):
+    """
+    SFTP server of local files, which can be read, created and removed.
+    Counts the files open at a time and the stat requests of open files.
+    """
+    def __init__(self, server, state):
+        paramiko.SFTPServerInterface.__init__(self, server)
+        self.state = state
+
+    def list_folder(self, path):
+        return [paramiko.SFTPAttributes.from_stat(
+            os.stat(os.path.join(path, filename)), filename)
+            for filename in os.listdir(path)]
+
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(path))
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        handle = _SftpHandle(flags, self.state)
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            handle.writefile = handle.readfile = open(path, "wb")
+        else:
+            handle.readfile = open(path, "rb")
+        self.state.open_files += 1
+        self.state.max_open_files = max(self.state.max_open_files,
+                                        self.state.open_files)
+        return handle
+
+    def remove(self, path):
+        os.remove(path)
+        return paramiko.SFTP_OK
+
+
+def _sftp_session():
+    """
+    Start SFTP server of local files in a thread. Return client connected
+    to it and the server state.
+    """
+    state = _SftpState()
+    client_sock, server_sock = socket.socketpair()
+    server_channel = _SftpChannel(server_sock)
+    server = paramiko.SFTPServer(server_channel, "sftp", None, _SftpServer,
+                                 state)
+    thread = threading.Thread(target=server.start_subsystem,
+                              args=("sftp", None, server_channel))
+    thread.daemon = True
+    thread.start()
+    return paramiko.SFTPClient(_SftpChannel(client_sock)), state
+
+
+class _SftpState(object):
+    def __init__(self):
+        self.open_files = 0
+        self.max_open_files = 0
+        self.stats = 0
+
+
 class TestSftp(unittest.TestCase):
     """
     Test cases for SFTP filesystem.
@@ -276,6 +858,122 @@ class TestSftp(unittest.TestCase):
         metadata_provider.disconnect()
         provider.disconnect()
 
+    def test_sftp_ranged_download(self):
+        """
+        Test retrieving large file from SFTP filesystem in concurrent
+        ranges.
+        """
+        config = Config()
+        config.config.set("sftp", "range_size", str(2**16))
+        config.config.set("sftp", "download_jobs", "3")
+        data_bucket = config.config.get("data", "bucket")
+        provider = sftp.Sftp(config, data_bucket).connect()
+        data = file("testdata/random_data.bin").read()
+        key = checksum_data(data)
+        provider.store(key, data)
+        reader = provider.open_reader(key)
+        self.assertTrue(isinstance(reader, RangeReader))
+        self.assertEqual(data, reader.read())
+        reader.close()
+        t = tempfile.NamedTemporaryFile()
+        provider.retrieve_to_filename(key, t.name)
+        self.assertEqual(data, file(t.name).read())
+        provider.delete(key)
+        provider.disconnect()
+
+    def test_sftp_iterate_data(self):
+        """
+        Test listing data through an in-process SFTP server. Files are
+        read in the order of the listing, at most `list_window` of them are
+        open at a time, and their sizes come from the listing.
+        """
+        config = Config()
+        config.config.set("sftp", "list_window", "3")
+        provider = sftp.Sftp(config, config.config.get("data", "bucket"))
+        provider.connection, state = _sftp_session()
+        provider.bucket = tempfile.mkdtemp()
+        datas = dict()
+        for i in range(8):
+            data = os.urandom(i * 20000)
+            datas["key{0}".format(i)] = data
+            file(os.path.join(provider.bucket, "key{0}".format(i)),
+                 "wb").write(data)
+        prefetch = paramiko.SFTPFile.prefetch
+        sizes = list()
+
+        def counting_prefetch(data_file, file_size=None):
+            sizes.append(file_size)
+            return prefetch(data_file, file_size)
+
+        paramiko.SFTPFile.prefetch = counting_prefetch
+        try:
+            keys = [attributes.filename for attributes in
+                    provider.connection.listdir_attr(provider.bucket)]
+            items = list(provider.iterate_data())
+            self.assertEqual(keys, [key for key, _ in items])
+            self.assertEqual(datas, dict(items))
+            self.assertEqual(datas, provider.list())
+            self.assertEqual(3, state.max_open_files)
+            self.assertEqual(0, state.open_files)
+            # Empty files are not prefetched.
+            self.assertEqual(sorted(2 * [len(data) for data in datas.values()
+                                         if data]),
+                             sorted(sizes))
+            self.assertEqual(0, state.stats)
+            # Files left open are closed when iteration stops.
+            iterator = provider.iterate_data()
+            next(iterator)
+            self.assertEqual(2, state.open_files)
+            iterator.close()
+            self.assertEqual(0, state.open_files)
+        finally:
+            paramiko.SFTPFile.prefetch = prefetch
+            provider.connection.close()
+            shutil.rmtree(provider.bucket)
+
+    def test_sftp_list_keys_rewritten(self):
+        """
+        Test that a metadata object that may still be rewritten with the
+        same size within the same second has no sync version, and that
+        objects modified earlier do. Modification times are compared with
+        the clock of the server.
+        """
+        config = Config()
+        provider = sftp.Sftp(config, config.config.get("metadata", "bucket"))
+        provider.connection, state = _sftp_session()
+        provider.bucket = tempfile.mkdtemp()
+        cloud = Cloud(config, provider, provider, MetaDataDB(config))
+        filename = os.path.join(provider.bucket, "key")
+        try:
+            file(filename, "wb").write("Metadata 1")
+            mtime = int(time.time())
+            os.utime(filename, (mtime, mtime))
+            key_info = provider.list_keys()["key"]
+            self.assertTrue(key_info["modified_recently"])
+            self.assertEqual(None, cloud._metadata_version(key_info))
+            # Local clock ahead of the server does not hide recent changes.
+            local_time = sftp.time.time
+            sftp.time.time = lambda: local_time() + 3600
+            try:
+                key_info = provider.list_keys()["key"]
+            finally:
+                sftp.time.time = local_time
+            self.assertTrue(key_info["modified_recently"])
+            self.assertEqual(None, cloud._metadata_version(key_info))
+            self.assertEqual(["key"], os.listdir(provider.bucket))
+            self.assertFalse(any(
+                name.startswith(".gpgcloud-time-")
+                for name in os.listdir(os.path.dirname(provider.bucket))))
+            os.utime(filename, (mtime - 10, mtime - 10))
+            key_info = provider.list_keys()["key"]
+            self.assertFalse(key_info["modified_recently"])
+            self.assertEqual(cloud._metadata_version(key_info),
+                             cloud._metadata_version(
+                                 provider.list_keys()["key"]))
+        finally:
+            provider.connection.close()
+            shutil.rmtree(provider.bucket)
+
     def test_sftp_delete_all_keys(self):
         """
         Test deleting all filesystem keys, both from metadata and
@@ -294,6 +992,508 @@ class TestSftp(unittest.TestCase):
         provider.disconnect()
 
 
+class _CryptoEngineHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Crypto engine API that returns data as it is. Requests fail with status
+    503 while the server has failures left, and health checks fail while
+    the server is not healthy. Connections are closed after each response
+    without telling the client while the server drops connections.
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def handle_one_request(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+        if self.server.drop_connections:
+            self.close_connection = 1
+
+    def _read_chunked(self):
+        chunks = list()
+        while True:
+            size = int(self.rfile.readline(), 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+            if not size:
+                return "".join(chunks)
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        body = '{"status": "ok"}'
+        self.send_response(200 if self.server.healthy else 503)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if "/v2/batch/" in self.path:
+            return self._batch()
+        if "/v2/" in self.path:
+            return self._stream()
+        params = urlparse.parse_qs(
+            self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(self.path)
+        if self.server.failures:
+            self.server.failures -= 1
+            body, status = "", 503
+        elif self.path.endswith("/encrypt"):
+            body = '{{"encrypted_data": "{0}", "encrypted_checksum": ' \
+                   '"checksum"}}'.format(params["data"][0].replace("\n", ""))
+            status = 201
+        else:
+            body = '{{"data": "{0}", "checksum": "checksum"}}'.format(
+                params["data"][0].replace("\n", ""))
+            status = 200
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self):
+        data = self._read_chunked()
+        self.server.requests.append(self.path)
+        if self.headers["X-Encryption-Key"] != "key":
+            return self.send_error(409)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("X-Checksum", checksum_data(data))
+        self.send_header("X-Encrypted-Checksum", checksum_data(data))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _batch(self):
+        body = StringIO(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(self.path)
+        response_fp = StringIO()
+        for key, data in read_records(body):
+            write_record(response_fp, checksum_data(data),
+                         checksum_data(data), data)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(response_fp.getvalue())))
+        self.end_headers()
+        self.wfile.write(response_fp.getvalue())
+
+    def log_message(self, *args):
+        pass
+
+
+class TestCryptoEngineClient(unittest.TestCase):
+    """
+    Test cases for crypto engine API client.
+    """
+    def _start_server(self):
+        server = SocketServer.ThreadingTCPServer(
+            ("127.0.0.1", 0), _CryptoEngineHandler)
+        server.daemon_threads = True
+        server.connections = 0
+        server.requests = list()
+        server.failures = 0
+        server.healthy = True
+        server.drop_connections = False
+        threading.Thread(target=server.serve_forever).start()
+        self.servers.append(server)
+        return server, "http://127.0.0.1:{0}/api/v1".format(
+            server.server_address[1])
+
+    def setUp(self):
+        self.servers = list()
+        self.server, self.api_url = self._start_server()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_cryptoengine_client_keep_alive(self):
+        """
+        Test that requests are sent over persistent connections.
+        """
+        client = CryptoEngineClient(self.api_url, connections=2)
+        data = file("testdata/data1.txt").read()
+        for i in range(10):
+            result = client.encrypt(data, "key")
+            self.assertEqual(result["encrypted_data"], data)
+            result = client.decrypt(base64.encodestring(data), "key")
+            self.assertEqual(result["data"], data)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.requests,
+                         ["/api/v1/encrypt", "/api/v1/decrypt"] * 10)
+        pool = multiprocessing.pool.ThreadPool(4)
+        results = pool.map(lambda i: client.encrypt(data, "key"), range(20))
+        pool.close()
+        pool.join()
+        self.assertTrue(all(
+            result["encrypted_data"] == data for result in results))
+        self.assertTrue(self.server.connections <= 2)
+        client.close()
+
+    def test_cryptoengine_client_retries(self):
+        """
+        Test retrying failed requests.
+        """
+        client = CryptoEngineClient(self.api_url, retries=2, retry_delay=0)
+        self.server.failures = 2
+        self.assertEqual(client.encrypt("data", "key")["encrypted_data"],
+                         "data")
+        self.server.failures = 3
+        self.assertRaises(CryptoEngineError, client.encrypt, "data", "key")
+        self.server.failures = 0
+        # Idle connection closed by the server is opened again.
+        client.endpoints[0]._idle.queue[0].sock.close()
+        self.assertEqual(client.decrypt("ZGF0YQ==", "key")["data"], "data")
+        client.close()
+        client = CryptoEngineClient("http://127.0.0.1:1/api/v1", retries=1,
+                                    retry_delay=0)
+        self.assertRaises(CryptoEngineError, client.encrypt, "data", "key")
+
+    def test_cryptoengine_client_streaming(self):
+        """
+        Test streaming raw data with API version 2.
+        """
+        client = CryptoEngineClient(self.api_url[:-1] + "2")
+        self.assertTrue(client.streaming)
+        data = file("testdata/big_file.txt").read()
+        checksum = checksum_data(data)
+        encrypted_fp = StringIO()
+        self.assertEqual(
+            client.encrypt_file(file("testdata/big_file.txt", "rb"),
+                                encrypted_fp, "key"), (checksum, checksum))
+        self.assertEqual(encrypted_fp.getvalue(), data)
+        result = client.decrypt(data, "key")
+        self.assertEqual(str(result["data"]), data)
+        self.assertEqual(result["checksum"], checksum)
+        self.assertEqual(str(client.encrypt("", "key")["encrypted_data"]), "")
+        self.assertRaises(CryptoEngineError, client.decrypt, data, "wrong")
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.requests, [
+            "/api/v2/encrypt", "/api/v2/decrypt", "/api/v2/encrypt",
+            "/api/v2/decrypt"])
+        client.close()
+
+    def test_cryptoengine_client_dropped_connections(self):
+        """
+        Test streaming data that can not be rewound to a server that closes
+        idle connections. Such data is sent on a new connection.
+        """
+        client = CryptoEngineClient(self.api_url[:-1] + "2", retries=0)
+        self.server.drop_connections = True
+        data = file("testdata/data1.txt").read()
+        for i in range(3):
+            encrypted_fp = StringIO()
+            self.assertEqual(
+                client.encrypt_file(ChecksumReader(StringIO(data)),
+                                    encrypted_fp, "key"),
+                (checksum_data(data), checksum_data(data)))
+            self.assertEqual(encrypted_fp.getvalue(), data)
+        self.assertEqual(self.server.connections, 3)
+        client.close()
+
+    def test_cryptoengine_client_batch(self):
+        """
+        Test encrypting and decrypting many data items in one request.
+        """
+        items = [(file(filename).read(), "key") for filename in [
+            "testdata/data1.txt", "testdata/data2.txt"]]
+        for api_url in [self.api_url, self.api_url[:-1] + "2"]:
+            client = CryptoEngineClient(api_url)
+            results = client.encrypt_batch(items)
+            self.assertEqual(
+                [str(result["encrypted_data"]) for result in results],
+                [data for data, _ in items])
+            if client.streaming:
+                results = client.decrypt_batch(items)
+            else:
+                results = client.decrypt_batch(
+                    [(base64.encodestring(data), key) for data, key in items])
+            self.assertEqual([str(result["data"]) for result in results],
+                             [data for data, _ in items])
+            client.close()
+        self.assertEqual(self.server.requests[-2:], [
+            "/api/v2/batch/encrypt", "/api/v2/batch/decrypt"])
+        self.assertEqual(len(self.server.requests), 6)
+
+    def test_cryptoengine_client_balancing(self):
+        """
+        Test balancing requests over many servers, and taking failing and
+        slow servers out of use.
+        """
+        server, api_url = self._start_server()
+        client = CryptoEngineClient([self.api_url, api_url], retry_delay=0,
+                                    max_failures=2, eject_time=0.5)
+        self.assertRaises(ValueError, CryptoEngineClient,
+                          [self.api_url, api_url[:-1] + "2"])
+        pool = multiprocessing.pool.ThreadPool(4)
+        results = pool.map(lambda i: client.encrypt("data", "key"), range(20))
+        self.assertTrue(all(
+            result["encrypted_data"] == "data" for result in results))
+        self.assertTrue(self.server.requests)
+        self.assertTrue(server.requests)
+        self.assertEqual(len(self.server.requests) + len(server.requests),
+                         20)
+        # Failed requests are retried on the other server, and the failing
+        # server is ejected.
+        server.failures = 1000
+        server.healthy = False
+        for i in range(10):
+            self.assertEqual(client.encrypt("data", "key")["encrypted_data"],
+                             "data")
+        self.assertTrue(client.endpoints[1].ejected)
+        requests = len(server.requests)
+        for i in range(10):
+            client.encrypt("data", "key")
+        self.assertEqual(len(server.requests), requests)
+        # Failed health check keeps the server ejected. Health checks do
+        # not delay requests.
+        time.sleep(0.5)
+        client.encrypt("data", "key")
+        while client.endpoints[1].checking:
+            time.sleep(0.01)
+        self.assertEqual(server.requests[requests:], ["/api/v1/health"])
+        self.assertTrue(client.endpoints[1].ejected)
+        # Healthy server is used again.
+        server.failures = 0
+        server.healthy = True
+        time.sleep(1.0)
+        client.encrypt("data", "key")
+        while client.endpoints[1].checking:
+            time.sleep(0.01)
+        self.assertFalse(client.endpoints[1].ejected)
+        pool.map(lambda i: client.encrypt("data", "key"), range(20))
+        pool.close()
+        pool.join()
+        self.assertFalse(client.endpoints[1].ejected)
+        self.assertEqual(server.requests[requests + 1], "/api/v1/health")
+        self.assertTrue(len(server.requests) > requests + 2)
+        # Much slower server is ejected. Latencies of the real requests
+        # are forgotten first.
+        for endpoint in client.endpoints:
+            endpoint.latency = None
+            endpoint.samples = 0
+        for i in range(5):
+            for endpoint, elapsed in zip(client.endpoints, [0.01, 1.0]):
+                endpoint.outstanding += 1
+                client._finish(endpoint, False, elapsed)
+        self.assertFalse(client.endpoints[0].ejected)
+        self.assertTrue(client.endpoints[1].ejected)
+        client.close()
+
+
+class TestCryptoEngineServer(unittest.TestCase):
+    """
+    Test cases for crypto engine server. Celery tasks are run in the
+    calling process.
+    """
+    def setUp(self):
+        from cryptoengine import server
+        self.server = server
+        server.app.config["TESTING"] = True
+        server.celery.conf.CELERY_ALWAYS_EAGER = True
+        self.client = server.app.test_client()
+
+    def _encrypt_v1(self, data, encryption_key, data_format):
+        response = self.client.post(
+            "/api/v1/encrypt",
+            data={"data": base64.encodestring(data), "key": encryption_key,
+                  "format": data_format})
+        self.assertEqual(201, response.status_code)
+        # Encrypted data is BASE64 encoded ASCII text.
+        return str(json.loads(response.data)["encrypted_data"])
+
+    def _decrypt_v1(self, data, encryption_key):
+        response = self.client.post(
+            "/api/v1/decrypt", data={"data": data, "key": encryption_key})
+        self.assertEqual(201, response.status_code)
+        result = json.loads(response.data)
+        return base64.decodestring(result["data"]), result["checksum"]
+
+    def test_cryptoengine_server_decrypt_v1(self):
+        """
+        Test decrypting older BASE64 encoded data, raw binary data and
+        seekable containers with API version 1. Older data is sent as it is
+        stored, other data BASE64 encoded.
+        """
+        data = file("testdata/random_data.bin").read()
+        encryption_key = generate_random_password()
+        stored_data = self._encrypt_v1(data, encryption_key, "base64")
+        self.assertFalse(is_binary(base64.decodestring(stored_data)))
+        self.assertEqual((data, checksum_data(data)),
+                         self._decrypt_v1(stored_data, encryption_key))
+        stored_data = base64.decodestring(
+            self._encrypt_v1(data, encryption_key, "binary"))
+        self.assertTrue(is_binary(stored_data))
+        self.assertEqual(
+            (data, checksum_data(data)),
+            self._decrypt_v1(base64.encodestring(stored_data),
+                             encryption_key))
+        encrypted_fp = StringIO()
+        encrypt_seekable(StringIO(data), encrypted_fp, encryption_key,
+                         block_size=2**16)
+        self.assertEqual(
+            (data, checksum_data(data)),
+            self._decrypt_v1(base64.encodestring(encrypted_fp.getvalue()),
+                             encryption_key))
+
+    def test_cryptoengine_server_run_task(self):
+        """
+        Test that small data is processed in the request handler, data of
+        at least 16 MiB on the process pool, and other data by celery
+        workers.
+        """
+        calls = list()
+
+        class Result(object):
+            def wait(self):
+                pass
+
+            def get(self):
+                return "celery"
+
+        def task(*args, **kwargs):
+            calls.append((args, kwargs))
+            return "parallel" if "pool" in kwargs else "inline"
+
+        def delay(*args):
+            calls.append((args, dict()))
+            return Result()
+
+        task.delay = delay
+        parallel_pool = self.server._parallel_pool
+        parallel_jobs = self.server.app.config["PARALLEL_JOBS"]
+        self.assertEqual(2**16, self.server.app.config["INLINE_THRESHOLD"])
+        self.assertEqual(2**24, self.server.app.config["PARALLEL_THRESHOLD"])
+        self.server._parallel_pool = lambda: "pool"
+        try:
+            self.server.app.config["PARALLEL_JOBS"] = 4
+            for size, expected in [(0, "inline"), (2**16, "inline"),
+                                   (2**16 + 1, "celery"),
+                                   (2**24 - 1, "celery"),
+                                   (2**24, "parallel"),
+                                   (2**30, "parallel")]:
+                self.assertEqual(expected, self.server._run_task(
+                    task, size, "input", "output", "key"))
+                self.assertEqual(("input", "output", "key"), calls[-1][0])
+            self.assertEqual(dict(pool="pool"), calls[-1][1])
+            # Data the task can not process on the pool is not processed
+            # in the request handler.
+            self.assertEqual("celery", self.server._run_task(
+                task, 2**24, "input", "output", "key", parallel=False))
+            self.assertEqual(dict(), calls[-1][1])
+            # A single process is not worth a pool.
+            self.server.app.config["PARALLEL_JOBS"] = 1
+            self.assertEqual("celery", self.server._run_task(
+                task, 2**24, "input", "output", "key"))
+        finally:
+            self.server._parallel_pool = parallel_pool
+            self.server.app.config["PARALLEL_JOBS"] = parallel_jobs
+
+    def test_cryptoengine_server_parallel(self):
+        """
+        Test that large data is encrypted into a seekable container on the
+        process pool, and that the container is decrypted with both API
+        versions.
+        """
+        data = file("testdata/random_data.bin").read()
+        encryption_key = generate_random_password()
+        config = dict(self.server.app.config)
+        self.server.app.config.update(INLINE_THRESHOLD=2**10,
+                                      PARALLEL_THRESHOLD=2**16,
+                                      PARALLEL_JOBS=2, BLOCK_SIZE=2**16)
+        try:
+            response = self.client.post(
+                "/api/v2/encrypt", data=data,
+                headers={"X-Encryption-Key": encryption_key})
+            self.assertEqual(200, response.status_code)
+            stored_data = response.data
+            self.assertTrue(is_seekable(stored_data))
+            self.assertEqual(checksum_data(data),
+                             response.headers["X-Checksum"])
+            self.assertEqual(checksum_data(stored_data),
+                             response.headers["X-Encrypted-Checksum"])
+            response = self.client.post(
+                "/api/v2/decrypt", data=stored_data,
+                headers={"X-Encryption-Key": encryption_key})
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(data, response.data)
+            self.assertEqual(checksum_data(data),
+                             response.headers["X-Checksum"])
+            self.assertEqual(checksum_data(stored_data),
+                             response.headers["X-Encrypted-Checksum"])
+            self.assertEqual(
+                (data, checksum_data(data)),
+                self._decrypt_v1(base64.encodestring(stored_data),
+                                 encryption_key))
+            # API version 1 also encrypts binary data on the pool.
+            stored_data = base64.decodestring(
+                self._encrypt_v1(data, encryption_key, "binary"))
+            self.assertTrue(is_seekable(stored_data))
+            self.assertEqual(
+                (data, checksum_data(data)),
+                self._decrypt_v1(base64.encodestring(stored_data),
+                                 encryption_key))
+            # Large BASE64 encoded data is processed by celery workers.
+            stored_data = self._encrypt_v1(data, encryption_key, "base64")
+            self.assertFalse(is_binary(base64.decodestring(stored_data)))
+            self.assertEqual((data, checksum_data(data)),
+                             self._decrypt_v1(stored_data, encryption_key))
+        finally:
+            self.server.app.config.update(config)
+            if self.server._pool is not None:
+                self.server._pool.terminate()
+                self.server._pool.join()
+                self.server._pool = None
+
+
+class _MemoryProvider(Provider):
+    """
+    Cloud provider storing data in memory, shared by all instances of the
+    same bucket. Every store gives the key a new etag, so keys are never
+    listed as modified recently.
+    """
+    _buckets = dict()
+    _lock = threading.Lock()
+
+    def __init__(self, config, bucket_name, encryption_method="gpg"):
+        Provider.__init__(self, config, bucket_name, encryption_method)
+        with self._lock:
+            self.data = self._buckets.setdefault(bucket_name, dict())
+
+    @property
+    def __name__(self):
+        return "memory-bucket:" + self.bucket_name
+
+    def store(self, key, data):
+        with self._lock:
+            self.data[key] = (str(data), random_string(16))
+
+    def store_from_filename(self, key, filename):
+        self.store(key, file(filename, "rb").read())
+
+    def connect(self):
+        return self
+
+    def retrieve(self, key):
+        with self._lock:
+            if key not in self.data:
+                raise IOError(errno.ENOENT, "No such key", key)
+            return self.data[key][0]
+
+    def retrieve_to_filename(self, key, filename):
+        file(filename, "wb").write(self.retrieve(key))
+
+    def delete(self, key):
+        with self._lock:
+            self.data.pop(key, None)
+
+    def list_keys(self):
+        with self._lock:
+            return dict((key, dict(name=key, size=len(data), etag=etag,
+                                   last_modified=None))
+                        for key, (data, etag) in self.data.items())
+
+
 class TestCloud(unittest.TestCase):
     """
     Test cases for cloud access, data is encrypted and decrypted.
@@ -428,36 +1628,1305 @@ class TestCloud(unittest.TestCase):
         self._test_cloud_store_filename(config, metadata_provider, provider)
 
 
-class TestCloudGpgEncryption(TestCloud):
+    def _test_cloud_parallel_backup(self, config, metadata_provider,
+                                    provider):
+        """
+        Store files concurrently as encrypted data to cloud.
+        """
+        database = MetaDataDB(config)
+        database.drop()
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        files = [("testdata/data1.txt", "testdata/data1.txt"),
+                 ("testdata/data2.txt", "testdata/data2.txt"),
+                 ("testdata/data2.txt", "testdata/data3.txt"),
+                 ("testdata/data2.txt", "testdata/data4.txt"),
+                 ("testdata/big_file.txt", "testdata/big_file.txt"),
+                 ("testdata/random_data.bin", "testdata/random_data.bin")]
+        # Identical files finishing at different times must share the same
+        # encrypted data.
+        files += [("testdata/data1.txt", "testdata/copy{0}.txt".format(i))
+                  for i in range(64)]
+        metadata_list = ParallelBackup(cloud, jobs=4).backup(files)
+        self.assertEqual(len(files), len(metadata_list))
+        self.assertEqual(len(set(
+            metadata["encryption_key"] for metadata in metadata_list
+            if metadata["path"].startswith("testdata/copy"))), 1)
+        self.assertEqual(len(files), len(cloud.list()))
+        for filename, cloud_filename in files:
+            metadata = cloud.find_one(path=cloud_filename)
+            self.assertEqual(checksum_file(filename), metadata["checksum"])
+            cloud.retrieve_to_filename(metadata, "testdata/new_data")
+            self.assertEqual(file(filename).read(),
+                             file("testdata/new_data").read())
+        for metadata in metadata_list:
+            cloud.delete(metadata)
+        # Backup fails instead of waiting forever for a task lost with its
+        # worker process.
+        checksum_worker = parallel._checksum_worker
 
-    def test_cloud_amazon_s3_store_data(self):
-        self._test_cloud_amazon_s3_store_data(encryption_method="gpg")
+        def dying_checksum_worker(filename, cloud_filename):
+            if filename == "testdata/data2.txt":
+                os._exit(1)
+            return checksum_worker(filename, cloud_filename)
 
-    def test_cloud_sftp_store_data(self):
-        self._test_cloud_sftp_store_data(encryption_method="gpg")
+        parallel._checksum_worker = dying_checksum_worker
+        cloud.rehash = True
+        try:
+            backup = ParallelBackup(cloud, jobs=2)
+            backup.poll_interval = 0.1
+            self.assertRaises(DataError, backup.backup, files[:2])
+        finally:
+            parallel._checksum_worker = checksum_worker
+            cloud.rehash = False
+        for metadata in cloud.list():
+            cloud.delete(metadata)
+        cloud.disconnect()
+        os.remove("testdata/new_data")
 
-    def test_cloud_amazon_s3_store_filename(self):
-        self._test_cloud_amazon_s3_store_filename(encryption_method="gpg")
+    def _test_cloud_amazon_s3_parallel_backup(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_parallel_backup(config, metadata_provider, provider)
 
-    def test_cloud_sftp_store_filename(self):
-        self._test_cloud_sftp_store_filename(encryption_method="gpg")
+    def _test_cloud_sftp_parallel_backup(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_parallel_backup(config, metadata_provider, provider)
 
+    def _test_cloud_async(self, config, metadata_provider, provider):
+        """
+        Store, retrieve and delete files concurrently without blocking.
+        """
+        database = MetaDataDB(config)
+        database.drop()
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        async_cloud = AsyncCloud(cloud, jobs=4)
+        files = ["testdata/data1.txt", "testdata/data2.txt",
+                 "testdata/big_file.txt", "testdata/random_data.bin"]
+        results = [async_cloud.store_from_filename(filename)
+                   for filename in files]
+        data = file("testdata/data2.txt").read()
+        results += [async_cloud.store(data, "testdata/data{0}.txt".format(i))
+                    for i in range(3, 7)]
+        metadata_list = [result.get() for result in results]
+        self.assertEqual(len(set(metadata["checksum"]
+                                 for metadata in metadata_list)), 4)
+        self.assertEqual(len(cloud.list()), 8)
+        results = [async_cloud.retrieve_to_filename(
+            metadata, "testdata/new_data{0}".format(i))
+            for i, metadata in enumerate(metadata_list)]
+        for result in results:
+            result.get()
+        for i, filename in enumerate(files + ["testdata/data2.txt"] * 4):
+            self.assertEqual(file(filename).read(),
+                             file("testdata/new_data{0}".format(i)).read())
+            os.remove("testdata/new_data{0}".format(i))
+        # Stores are not blocked while sync retrieves metadata.
+        database.drop()
+        retrieve = metadata_provider.__class__.retrieve
+        retrieving = threading.Event()
+        release = threading.Event()
 
-class TestCloudSymmetricEncryption(TestCloud):
+        def blocking_retrieve(self, key):
+            retrieving.set()
+            release.wait(10)
+            return retrieve(self, key)
 
-    def test_cloud_amazon_s3_store_data(self):
-        self._test_cloud_amazon_s3_store_data(encryption_method="symmetric")
+        metadata_provider.__class__.retrieve = blocking_retrieve
+        try:
+            sync_result = async_cloud.sync()
+            self.assertTrue(retrieving.wait(10))
+            metadata_list.append(async_cloud.store(
+                "New data\n", "testdata/new_data.txt").get(10))
+            release.set()
+            sync_result.get()
+        finally:
+            metadata_provider.__class__.retrieve = retrieve
+            release.set()
+        self.assertEqual(len(cloud.list()), 9)
+        for result in [async_cloud.delete(metadata)
+                       for metadata in metadata_list]:
+            result.get()
+        self.assertEqual(len(cloud.list()), 0)
+        async_cloud.close()
+        cloud.disconnect()
 
-    def test_cloud_sftp_store_data(self):
-        self._test_cloud_sftp_store_data(encryption_method="symmetric")
+    def _test_cloud_amazon_s3_async(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_async(config, metadata_provider, provider)
 
-    def test_cloud_amazon_s3_store_filename(self):
-        self._test_cloud_amazon_s3_store_filename(
-            encryption_method="symmetric")
+    def _test_cloud_sftp_async(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_async(config, metadata_provider, provider)
 
-    def test_cloud_sftp_store_filename(self):
+    def _test_cloud_memory_async(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = _MemoryProvider(config, metadata_bucket).connect()
+        provider = _MemoryProvider(
+            config, data_bucket, encryption_method).connect()
+        self._test_cloud_async(config, metadata_provider, provider)
+
+    def _test_cloud_batched_files(self, config, metadata_provider,
+                                  provider):
+        """
+        Encrypt small files in crypto engine batches while packing them,
+        and decrypt them in batches when they are restored.
+        """
+        config.config.set("data", "pack_threshold", "65536")
+        config.config.set("cryptoengine", "batch_size", "4")
+        database = MetaDataDB(config)
+        database.drop()
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        client = cloud._cryptoengine_client()
+        encrypt_batch = client.encrypt_batch
+        decrypt_batch = client.decrypt_batch
+        batches = list()
+
+        def counting_encrypt_batch(items):
+            batches.append(("encrypt", len(items)))
+            return encrypt_batch(items)
+
+        def counting_decrypt_batch(items):
+            batches.append(("decrypt", len(items)))
+            return decrypt_batch(items)
+
+        client.encrypt_batch = counting_encrypt_batch
+        client.decrypt_batch = counting_decrypt_batch
+        datas = ["Data {0}\n".format(i) * 100 for i in range(6)]
+        datas.append(datas[0])
+        for i, data in enumerate(datas):
+            file("testdata/new_data{0}".format(i), "wb").write(data)
+        files = [("testdata/new_data{0}".format(i),
+                  "testdata/data{0}.txt".format(i))
+                 for i in range(len(datas))]
+        files.append(("testdata/data1.txt", None))
+        datas.append(file("testdata/data1.txt").read())
+        metadata_list = cloud.store_files(files)
+        # Metadata is complete when the files have been stored.
+        self.assertEqual([("encrypt", 4), ("encrypt", 3)], batches)
+        for metadata in metadata_list:
+            self.assertTrue(metadata["encryption_key"])
+            self.assertTrue(metadata["encrypted_checksum"])
+        self.assertEqual(metadata_list[0]["encryption_key"],
+                         metadata_list[6]["encryption_key"])
+        # Single data is not left waiting for a batch.
+        metadata = cloud.store("Single data\n", "testdata/single.txt")
+        self.assertTrue(metadata["encryption_key"])
+        self.assertEqual([("encrypt", 4), ("encrypt", 3)], batches)
+        cloud.delete(metadata)
+        cloud.flush_data()
+        self.assertEqual(len(cloud.list()), 8)
+        batches = list()
+        cloud.retrieve_files(
+            (metadata, "testdata/new_data{0}".format(i))
+            for i, metadata in enumerate(metadata_list))
+        self.assertEqual([("decrypt", 4), ("decrypt", 4)], batches)
+        for i, data in enumerate(datas):
+            self.assertEqual(data,
+                             file("testdata/new_data{0}".format(i)).read())
+            os.remove("testdata/new_data{0}".format(i))
+        for metadata in metadata_list:
+            cloud.delete(metadata)
+        cloud.disconnect()
+
+    def _test_cloud_amazon_s3_batched_files(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_batched_files(config, metadata_provider, provider)
+
+    def _test_cloud_sftp_batched_files(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_batched_files(config, metadata_provider, provider)
+
+    def _test_cloud_async_shared_data(self, config, metadata_provider,
+                                      provider):
+        """
+        Store packed, chunked and deduplicated data concurrently. Other
+        stores are not blocked while chunks are uploaded.
+        """
+        config.config.set("data", "pack_threshold", "4096")
+        config.config.set("data", "chunk_size", str(2**18))
+        database = MetaDataDB(config)
+        database.drop()
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        async_cloud = AsyncCloud(cloud, jobs=4)
+        # Data is uploaded by providers of the I/O threads.
+        store = provider.__class__.store
+        uploading = threading.Event()
+        release = threading.Event()
+
+        def blocking_store(self, key, data):
+            if not uploading.is_set():
+                uploading.set()
+                release.wait(10)
+            return store(self, key, data)
+
+        provider.__class__.store = blocking_store
+        try:
+            big_result = async_cloud.store_from_filename(
+                "testdata/big_file.txt")
+            self.assertTrue(uploading.wait(10))
+            copies = [result.get(10) for result in [
+                async_cloud.store_from_filename(
+                    "testdata/data1.txt", "testdata/copy{0}.txt".format(i))
+                for i in range(8)]]
+            release.set()
+            big_files = [big_result.get()]
+        finally:
+            provider.__class__.store = store
+            release.set()
+        big_files.append(async_cloud.store_from_filename(
+            "testdata/big_file.txt", "testdata/big_copy.txt").get())
+        self.assertTrue(copies[0]["pack"])
+        self.assertEqual(len(set(metadata["encryption_key"]
+                                 for metadata in copies)), 1)
+        self.assertEqual(big_files[0]["chunks"], big_files[1]["chunks"])
+        cloud.flush_data()
+        self.assertEqual(len(cloud.list()), 10)
+        for filename, metadata_list in (("testdata/data1.txt", copies),
+                                        ("testdata/big_file.txt",
+                                         big_files)):
+            for metadata in metadata_list:
+                async_cloud.retrieve_to_filename(
+                    metadata, "testdata/new_data").get()
+                self.assertEqual(file(filename).read(),
+                                 file("testdata/new_data").read())
+        for result in [async_cloud.delete(metadata)
+                       for metadata in copies + big_files]:
+            result.get()
+        self.assertEqual(len(cloud.list()), 0)
+        async_cloud.close()
+        cloud.disconnect()
+        os.remove("testdata/new_data")
+
+    def _test_cloud_amazon_s3_async_shared_data(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_async_shared_data(
+            config, metadata_provider, provider)
+
+    def _test_cloud_sftp_async_shared_data(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_async_shared_data(
+            config, metadata_provider, provider)
+
+    def _test_cloud_memory_async_shared_data(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = _MemoryProvider(config, metadata_bucket).connect()
+        provider = _MemoryProvider(
+            config, data_bucket, encryption_method).connect()
+        self._test_cloud_async_shared_data(
+            config, metadata_provider, provider)
+
+    def _test_cloud_retrieve_range_to_filename(self, config,
+                                               metadata_provider, provider):
+        """
+        Retrieve byte ranges of files to local files. Data that is not
+        stored in seekable containers is retrieved only once.
+        """
+        database = MetaDataDB(config)
+        database.drop()
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        data = file("testdata/big_file.txt").read()
+        metadata = cloud.store_from_filename(
+            "testdata/big_file.txt", "testdata/big_file.txt")
+        seekable = is_seekable(provider.retrieve(metadata["checksum"]))
+        open_reader = provider.open_reader
+        opened = list()
+
+        def counting_open_reader(key):
+            opened.append(key)
+            return open_reader(key)
+
+        provider.open_reader = counting_open_reader
+        for offset, length in ((0, None), (1000, 300000),
+                               (len(data) - 10, 100), (len(data), 10)):
+            opened = list()
+            cloud.retrieve_range_to_filename(
+                metadata, "testdata/new_data", offset, length,
+                block_size=2**16)
+            end = len(data) if length is None else offset + length
+            self.assertEqual(data[offset:end],
+                             file("testdata/new_data").read())
+            if not seekable and offset < len(data):
+                self.assertEqual([metadata["checksum"]], opened)
+        provider.open_reader = open_reader
+        cloud.delete(metadata)
+        cloud.disconnect()
+        os.remove("testdata/new_data")
+
+    def _test_cloud_amazon_s3_retrieve_range_to_filename(
+            self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_retrieve_range_to_filename(
+            config, metadata_provider, provider)
+
+    def _test_cloud_sftp_retrieve_range_to_filename(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_retrieve_range_to_filename(
+            config, metadata_provider, provider)
+
+    def _test_cloud_sync(self, config, metadata_provider, provider):
+        """
+        Sync metadata from cloud to database.
+        """
+        database = MetaDataDB(config)
+        database.drop()
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        metadata1 = cloud.store_from_filename(
+            "testdata/data1.txt", "testdata/data1.txt")
+        metadata2 = cloud.store_from_filename(
+            "testdata/data2.txt", "testdata/data2.txt")
+        database.drop()
+        cloud.sync()
+        self.assertEqual(2, len(cloud.list()))
+        self.assertEqual(metadata1["checksum"], cloud.find_one(
+            path="testdata/data1.txt")["checksum"])
+        # Metadata removed from cloud is removed from database.
+        metadata_provider.delete(metadata1["key"])
+        cloud.sync()
+        self.assertEqual(1, len(cloud.list()))
+        self.assertIsNone(cloud.find_one(path="testdata/data1.txt"))
+        cloud.sync(full=True, jobs=4)
+        self.assertEqual(1, len(cloud.list()))
+        cloud.delete(metadata2)
+        provider.delete(metadata1["checksum"])
+        cloud.disconnect()
+
+    def _test_cloud_amazon_s3_sync(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_sync(config, metadata_provider, provider)
+
+    def _test_cloud_sftp_sync(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_sync(config, metadata_provider, provider)
+
+    def _test_cloud_metadata_segments(self, config, metadata_provider,
+                                      provider):
+        """
+        Store metadata packed into metadata segments.
+        """
+        config.config.set("metadata", "layout", "segment")
+        config.config.set("metadata", "segment_size", "2")
+        config.config.set("metadata", "max_segments", "2")
+        config.config.set("metadata", "segment_grace_period", "0")
+        database = MetaDataDB(config)
+        database.drop()
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        metadata_list = [cloud.store_from_filename(filename, filename)
+                         for filename in ["testdata/data1.txt",
+                                          "testdata/data2.txt",
+                                          "testdata/big_file.txt"]]
+        cloud.delete(metadata_list[0])
+        cloud.disconnect()
+        self.assertEqual(2, len(cloud.list()))
+        cloud.connect()
+        for metadata in metadata_list:
+            self.assertNotIn(metadata["key"], metadata_provider.list_keys())
+        database.drop()
+        cloud.sync()
+        self.assertEqual(2, len(cloud.list()))
+        self.assertIsNone(cloud.find_one(path="testdata/data1.txt"))
+        cloud.compact_metadata()
+        self.assertEqual(1, len(cloud._segment_keys(
+            metadata_provider.list_keys())))
+        cloud.sync(full=True)
+        self.assertEqual(2, len(cloud.list()))
+        for metadata in metadata_list[1:]:
+            cloud.delete(metadata)
+        cloud.compact_metadata()
+        cloud.sync()
+        self.assertEqual(0, len(cloud.list()))
+        # Clients flushing and compacting segments concurrently keep the
+        # segments of each other, and replaced segments are kept for the
+        # grace period.
+        directory = tempfile.mkdtemp()
+        errors = list()
+
+        def backup(index):
+            try:
+                client_config = Config()
+                for option in ["layout", "segment_size", "max_segments"]:
+                    client_config.config.set(
+                        "metadata", option,
+                        config.config.get("metadata", option))
+                client_config.config.set(
+                    "general", "database", "sqlite:///{0}/{1}.db".format(
+                        directory, index))
+                client = Cloud(client_config, metadata_provider.clone(),
+                               provider.clone(),
+                               MetaDataDB(client_config)).connect()
+                for i in range(8):
+                    client.store("data {0}".format(i),
+                                 "testdata/client{0}/data{1}.txt".format(
+                                     index, i))
+                client.disconnect()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=backup, args=(index, ))
+                   for index in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        shutil.rmtree(directory)
+        self.assertEqual([], errors)
+        segment_keys = cloud._segment_keys(metadata_provider.list_keys())
+        self.assertTrue(len(segment_keys) > 2)
+        database.drop()
+        cloud.sync()
+        self.assertEqual(16, len(cloud.list()))
+        cloud.compact_metadata()
+        self.assertEqual(16 // cloud.segment_size, len(cloud._segment_keys(
+            metadata_provider.list_keys())))
+        cloud.sync()
+        self.assertEqual(16, len(cloud.list()))
+        for key in metadata_provider.list_keys():
+            metadata_provider.delete(key)
+        for key in provider.list_keys():
+            provider.delete(key)
+        cloud.disconnect()
+
+    def _test_cloud_amazon_s3_metadata_segments(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_metadata_segments(
+            config, metadata_provider, provider)
+
+    def _test_cloud_sftp_metadata_segments(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_metadata_segments(
+            config, metadata_provider, provider)
+
+    def _test_cloud_pack_files(self, config, metadata_provider, provider):
+        """
+        Store small files into pack objects.
+        """
+        config.config.set("data", "pack_threshold", "4096")
+        config.config.set("data", "pack_size", "2048")
+        database = MetaDataDB(config)
+        database.drop()
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        files = [("testdata/data1.txt", "testdata/data1.txt"),
+                 ("testdata/data2.txt", "testdata/data2.txt"),
+                 ("testdata/data2.txt", "testdata/data3.txt"),
+                 ("testdata/big_file.txt", "testdata/big_file.txt")]
+        metadata_list = [cloud.store_from_filename(filename, cloud_filename)
+                         for filename, cloud_filename in files]
+        metadata_list.append(cloud.store("small data", "testdata/data4.txt"))
+        cloud.flush_data()
+        self.assertIsNone(metadata_list[3].get("pack"))
+        self.assertEqual(metadata_list[1]["pack"], metadata_list[2]["pack"])
+        self.assertEqual(metadata_list[1]["pack_offset"],
+                         metadata_list[2]["pack_offset"])
+        for metadata in metadata_list[:3] + metadata_list[4:]:
+            self.assertTrue(metadata["pack"].startswith("pack-"))
+            self.assertNotIn(metadata["checksum"], provider.list_keys())
+        for filename, cloud_filename in files:
+            metadata = cloud.find_one(path=cloud_filename)
+            cloud.retrieve_to_filename(metadata, "testdata/new_data")
+            self.assertEqual(file(filename).read(),
+                             file("testdata/new_data").read())
+        self.assertEqual("small data", cloud.retrieve(
+            cloud.find_one(path="testdata/data4.txt")))
+        for metadata in metadata_list:
+            cloud.delete(metadata)
+        self.assertEqual(0, len(provider.list_keys()))
+        cloud.disconnect()
+        os.remove("testdata/new_data")
+
+    def _test_cloud_amazon_s3_pack_files(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_pack_files(config, metadata_provider, provider)
+
+    def _test_cloud_sftp_pack_files(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_pack_files(config, metadata_provider, provider)
+
+    def _test_cloud_chunked_files(self, config, metadata_provider, provider):
+        """
+        Store large files in content-defined chunks.
+        """
+        database = MetaDataDB(config)
+        database.drop()
+        # Invalid chunk size is found before anything is stored.
+        config.config.set("data", "chunk_size", "65000")
+        self.assertRaises(ConfigError, Cloud, config, metadata_provider,
+                          provider, database)
+        config.config.set("data", "chunk_size", "65536")
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        data = file("testdata/random_data.bin").read()
+        new_data = data[:500000] + "appended data" + data[500000:]
+        metadata1 = cloud.store_from_filename(
+            "testdata/random_data.bin", "testdata/random_data.bin")
+        chunk_keys = set(provider.list_keys())
+        metadata2 = cloud.store(new_data, "testdata/new_random_data.bin")
+        # Only the changed chunks are stored.
+        self.assertTrue(len(metadata2["chunks"]) > 2)
+        self.assertTrue(len(set(provider.list_keys()) - chunk_keys) <= 2)
+        self.assertEqual(new_data, cloud.retrieve(
+            cloud.find_one(path="testdata/new_random_data.bin")))
+        cloud.retrieve_to_filename(metadata1, "testdata/new_data")
+        self.assertEqual(data, file("testdata/new_data").read())
+        database.drop()
+        cloud.sync()
+        metadata = cloud.find_one(path="testdata/random_data.bin")
+        cloud.retrieve_to_filename(metadata, "testdata/new_data", jobs=1)
+        self.assertEqual(data, file("testdata/new_data").read())
+        # Chunks shared by files backed up in parallel are stored once.
+        new_data = data[:300000] + "parallel data" + data[300000:]
+        file("testdata/new_data", "wb").write(new_data)
+        file("testdata/new_data2", "wb").write(new_data + "appended data")
+        metadata_list = ParallelBackup(cloud, jobs=4).backup(
+            [("testdata/new_data", "testdata/new_data"),
+             ("testdata/new_data2", "testdata/new_data2"),
+             ("testdata/random_data.bin", "testdata/copy.bin")])
+        encryption_keys = dict()
+        for chunk in sum((parallel_metadata["chunks"]
+                          for parallel_metadata in metadata_list), []):
+            self.assertEqual(
+                encryption_keys.setdefault(
+                    chunk["checksum"], chunk["encryption_key"]),
+                chunk["encryption_key"])
+        for filename in ["testdata/new_data", "testdata/new_data2"]:
+            self.assertEqual(file(filename).read(), cloud.retrieve(
+                cloud.find_one(path=filename)))
+        for parallel_metadata in metadata_list:
+            cloud.delete(parallel_metadata)
+        # Chunk boundaries of files larger than one segment are searched on
+        # the process pool, and the chunks stay the same.
+        new_data = data[:200000] + "segmented data" + data[200000:]
+        file("testdata/new_data2", "wb").write(new_data)
+        segment_size = chunking.SEGMENT_SIZE
+        encryption_jobs = cloud.encryption_jobs
+        chunking.SEGMENT_SIZE = 2**17
+        cloud.encryption_jobs = 2
+        try:
+            metadata_list = ParallelBackup(cloud, jobs=4).backup(
+                [("testdata/new_data2", "testdata/new_data2")])
+            metadata_list.append(cloud.store(
+                new_data + "appended data", "testdata/new_data3"))
+        finally:
+            chunking.SEGMENT_SIZE = segment_size
+            cloud.encryption_jobs = encryption_jobs
+        for parallel_metadata, chunk_data in zip(
+                metadata_list, [new_data, new_data + "appended data"]):
+            self.assertEqual(
+                [checksum_data(chunk)
+                 for chunk in chunk_stream(StringIO(chunk_data), 2**16)],
+                [chunk["checksum"] for chunk in parallel_metadata["chunks"]])
+            self.assertEqual(chunk_data, cloud.retrieve(parallel_metadata))
+            cloud.delete(parallel_metadata)
+        os.remove("testdata/new_data2")
+        cloud.delete(metadata)
+        cloud.delete(cloud.find_one(path="testdata/new_random_data.bin"))
+        self.assertEqual(0, len(provider.list_keys()))
+        cloud.disconnect()
+        os.remove("testdata/new_data")
+
+    def _test_cloud_amazon_s3_chunked_files(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_chunked_files(config, metadata_provider, provider)
+
+    def _test_cloud_sftp_chunked_files(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_chunked_files(config, metadata_provider, provider)
+
+    def _test_cloud_compression(self, config, metadata_provider, provider):
+        """
+        Compress data before encryption.
+        """
+        config.config.set("data", "compression", "auto")
+        database = MetaDataDB(config)
+        database.drop()
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        metadata1 = cloud.store_from_filename(
+            "testdata/big_file.txt", "testdata/big_file.txt")
+        metadata2 = cloud.store_from_filename(
+            "testdata/random_data.bin", "testdata/random_data.bin")
+        data = file("testdata/data1.txt").read()
+        metadata3 = cloud.store(data, "testdata/data1.txt")
+        self.assertEqual("zlib", metadata1["compression"])
+        self.assertTrue(metadata1["encrypted_size"] < metadata1["size"])
+        self.assertNotIn("compression", metadata2)
+        self.assertEqual("zlib", metadata3["compression"])
+        for metadata in [metadata1, metadata2]:
+            cloud.retrieve_to_filename(metadata, "testdata/new_data")
+            self.assertEqual(file(metadata["path"]).read(),
+                             file("testdata/new_data").read())
+        self.assertEqual(data, cloud.retrieve(metadata3))
+        for metadata in [metadata1, metadata2, metadata3]:
+            cloud.delete(metadata)
+        cloud.disconnect()
+        os.remove("testdata/new_data")
+
+    def _test_cloud_amazon_s3_compression(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_compression(config, metadata_provider, provider)
+
+    def _test_cloud_sftp_compression(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_compression(config, metadata_provider, provider)
+
+    def _test_cloud_spool(self, config, metadata_provider, provider):
+        """
+        Keep spooled encrypted data readable only by the owner with its
+        encryption key encrypted, encrypt it again if it has changed, and
+        remove old spooled data.
+        """
+        spool_directory = tempfile.mkdtemp()
+        config.config.set("data", "spool_directory", spool_directory)
+        config.config.set("data", "spool_max_age", "3600")
+        database = MetaDataDB(config)
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        filename = "testdata/random_data.bin"
+        checksum = checksum_file(filename)
+        result = cloud._encrypt_to_spool(filename, checksum)
+        spool_files = [os.path.join(spool_directory, spool_file)
+                       for spool_file in os.listdir(spool_directory)]
+        self.assertEqual(2, len(spool_files))
+        for spool_file in spool_files:
+            self.assertEqual(0600, os.stat(spool_file).st_mode & 0777)
+            self.assertNotIn(result[1], file(spool_file).read())
+        # Interrupted backup is resumed with the same encrypted data.
+        self.assertEqual(result, cloud._encrypt_to_spool(filename, checksum))
+        # Changed encrypted data is encrypted again.
+        file(result[0], "ab").write("changed data")
+        new_result = cloud._encrypt_to_spool(filename, checksum)
+        self.assertNotEqual(result[1], new_result[1])
+        self.assertEqual(new_result[3], checksum_file(new_result[0]))
+        self.assertEqual(2, len(os.listdir(spool_directory)))
+        cloud.clean_spool()
+        self.assertEqual(2, len(os.listdir(spool_directory)))
+        old_time = time.time() - 7200
+        for spool_file in spool_files:
+            os.utime(spool_file, (old_time, old_time))
+        cloud.clean_spool()
+        self.assertEqual(0, len(os.listdir(spool_directory)))
+        cloud.disconnect()
+        shutil.rmtree(spool_directory)
+
+    def _test_cloud_amazon_s3_spool(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_spool(config, metadata_provider, provider)
+
+    def _test_cloud_sftp_spool(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_spool(config, metadata_provider, provider)
+
+    def _test_cloud_stat_cache(self, config, metadata_provider, provider):
+        """
+        Use cached checksums for unchanged files.
+        """
+        database = MetaDataDB(config)
+        database.drop()
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        filename = tempfile.mktemp(dir="testdata")
+        file(filename, "w").write(file("testdata/data1.txt").read())
+        metadata1 = cloud.store_from_filename(filename, "testdata/data1.txt")
+        stat_info = os.stat(filename)
+        self.assertEqual((metadata1["key"], metadata1["checksum"]),
+                         database.cached_checksums(
+                             "testdata/data1.txt", stat_info))
+        # Unchanged file is not read again.
+        cloud._checksum_file = None
+        metadata2 = cloud.store_from_filename(filename, "testdata/data1.txt")
+        self.assertEqual(metadata1["key"], metadata2["key"])
+        self.assertEqual(1, len(cloud.list()))
+        del cloud._checksum_file
+        file(filename, "a").write("changed data")
+        os.utime(filename, (stat_info.st_atime, stat_info.st_mtime))
+        self.assertIsNone(database.cached_checksums(
+            "testdata/data1.txt", os.stat(filename)))
+        metadata3 = cloud.store_from_filename(filename, "testdata/data1.txt")
+        self.assertNotEqual(metadata1["checksum"], metadata3["checksum"])
+        self.assertEqual(checksum_file(filename), metadata3["checksum"])
+        cloud.rehash = True
+        self.assertIsNone(cloud._cached_checksums(
+            "testdata/data1.txt", os.stat(filename)))
+        for metadata in [metadata1, metadata3]:
+            cloud.delete(metadata)
+        cloud.disconnect()
+        os.remove(filename)
+
+    def _test_cloud_backup_directory(self, config, metadata_provider,
+                                     provider):
+        """
+        Back up a directory again. Only changed files are read and stored,
+        and all files are read again with `--rehash`.
+        """
+        database = MetaDataDB(config)
+        database.drop()
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        directory = tempfile.mkdtemp(dir="testdata")
+        for i in range(3):
+            file(os.path.join(directory, "file{0}".format(i)),
+                 "w").write("data {0}\n".format(i) * 100)
+        cloud_checksum_file = cloud._checksum_file
+        hashed = list()
+
+        def counting_checksum_file(filename, cloud_filename):
+            hashed.append(filename)
+            return cloud_checksum_file(filename, cloud_filename)
+
+        cloud._checksum_file = counting_checksum_file
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            backup_directory(cloud, directory, "backup")
+            self.assertEqual(3, len(hashed))
+            self.assertEqual(3, len(cloud.list()))
+            # Unchanged files are not read again.
+            del hashed[:]
+            backup_directory(cloud, directory, "backup")
+            self.assertEqual([], hashed)
+            self.assertEqual(3, len(cloud.list()))
+            cloud.rehash = True
+            backup_directory(cloud, directory, "backup")
+            self.assertEqual(3, len(hashed))
+            self.assertEqual(3, len(cloud.list()))
+            cloud.rehash = False
+            # Changed file is stored again, and replaces its earlier
+            # version.
+            del hashed[:]
+            filename = os.path.join(directory, "file1")
+            cloud_filename = os.path.normpath("backup/" + filename)
+            old_metadata = cloud.find_one(path=cloud_filename)
+            time.sleep(0.01)
+            file(filename, "a").write("changed data")
+            backup_directory(cloud, directory, "backup")
+            self.assertEqual([filename], hashed)
+            self.assertEqual(3, len(cloud.list()))
+            self.assertEqual(checksum_file(filename), cloud.find_one(
+                path=cloud_filename)["checksum"])
+            self.assertIsNone(cloud.find_one(key=old_metadata["key"]))
+            backup_directory(cloud, directory, "backup", jobs=2)
+            self.assertEqual(3, len(cloud.list()))
+        finally:
+            sys.stdout = stdout
+            del cloud._checksum_file
+            for metadata in cloud.list():
+                cloud.delete(metadata)
+            cloud.disconnect()
+            shutil.rmtree(directory)
+
+    def _test_cloud_amazon_s3_backup_directory(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_backup_directory(config, metadata_provider,
+                                          provider)
+
+    def _test_cloud_sftp_backup_directory(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_backup_directory(config, metadata_provider,
+                                          provider)
+
+    def _test_cloud_amazon_s3_stat_cache(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_stat_cache(config, metadata_provider, provider)
+
+    def _test_cloud_sftp_stat_cache(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_stat_cache(config, metadata_provider, provider)
+
+    def _test_cloud_seekable_format(self, config, metadata_provider,
+                                    provider):
+        """
+        Retrieve byte ranges of data stored in seekable containers.
+        """
+        database = MetaDataDB(config)
+        database.drop()
+        stream_cloud = Cloud(
+            config, metadata_provider, provider, database).connect()
+        metadata1 = stream_cloud.store_from_filename(
+            "testdata/data2.txt", "testdata/data2.txt")
+        config.config.set("data", "format", "seekable")
+        config.config.set("data", "block_size", str(2**16))
+        config.config.set("data", "compression", "auto")
+        config.config.set("data", "chunk_size", str(2**18))
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        metadata2 = cloud.store_from_filename(
+            "testdata/big_file.txt", "testdata/big_file.txt")
+        metadata3 = cloud.store_from_filename(
+            "testdata/random_data.bin", "testdata/random_data.bin")
+        data = file("testdata/data1.txt").read()
+        metadata4 = cloud.store(data, "testdata/data1.txt")
+        # Blocks are compressed inside the seekable containers.
+        for chunk in metadata2["chunks"]:
+            self.assertEqual(None, chunk["compression"])
+            self.assertTrue(is_seekable(provider.retrieve(chunk["checksum"])))
+        self.assertTrue(metadata2["encrypted_size"] < metadata2["size"])
+        self.assertTrue(len(metadata3["chunks"]) > 1)
+        self.assertEqual(data, cloud.retrieve(metadata4))
+        for metadata in [metadata1, metadata2, metadata3, metadata4]:
+            cloud.retrieve_to_filename(metadata, "testdata/new_data")
+            data = file(metadata["path"]).read()
+            self.assertEqual(data, file("testdata/new_data").read())
+            for offset, length in ((0, 100), (500, 300000), (70000, 10),
+                                   (len(data) - 10, 100)):
+                self.assertEqual(data[offset:offset + length],
+                                 cloud.retrieve_range(
+                                     metadata, offset, length))
+        for metadata in [metadata1, metadata2, metadata3, metadata4]:
+            cloud.delete(metadata)
+        cloud.disconnect()
+        os.remove("testdata/new_data")
+
+    def _test_cloud_amazon_s3_seekable_format(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_seekable_format(config, metadata_provider, provider)
+
+    def _test_cloud_sftp_seekable_format(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_seekable_format(config, metadata_provider, provider)
+
+    def _test_cloud_multicore_encryption(self, config, metadata_provider,
+                                         provider):
+        """
+        Encrypt and decrypt blocks of data on process pool.
+        """
+        config.config.set("data", "block_size", str(2**16))
+        config.config.set("data", "encryption_jobs", "2")
+        database = MetaDataDB(config)
+        database.drop()
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        metadata1 = cloud.store_from_filename(
+            "testdata/big_file.txt", "testdata/big_file.txt")
+        data = file("testdata/random_data.bin").read()
+        metadata2 = cloud.store(data, "testdata/random_data.bin")
+        self.assertTrue(is_seekable(provider.retrieve(metadata1["checksum"])))
+        cloud.retrieve_to_filename(metadata1, "testdata/new_data")
+        self.assertEqual(file("testdata/big_file.txt").read(),
+                         file("testdata/new_data").read())
+        self.assertEqual(data, cloud.retrieve(metadata2))
+        self.assertEqual(data[100000:100100],
+                         cloud.retrieve_range(metadata2, 100000, 100))
+        for metadata in [metadata1, metadata2]:
+            cloud.delete(metadata)
+        cloud.disconnect()
+        os.remove("testdata/new_data")
+
+    def _test_cloud_amazon_s3_multicore_encryption(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_multicore_encryption(
+            config, metadata_provider, provider)
+
+    def _test_cloud_sftp_multicore_encryption(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_multicore_encryption(
+            config, metadata_provider, provider)
+
+
+    def _test_cloud_binary_format(self, config, metadata_provider, provider):
+        """
+        Store encrypted data as raw bytes, and read BASE64 encoded data
+        stored before the binary format.
+        """
+        database = MetaDataDB(config)
+        database.drop()
+        cloud = Cloud(config, metadata_provider, provider, database).connect()
+        data = file("testdata/data1.txt").read()
+        metadata1 = cloud.store(data, "testdata/data1.txt")
+        encrypted_data = provider.retrieve(metadata1["checksum"])
+        self.assertTrue(is_binary(encrypted_data))
+        self.assertEqual(metadata1["encrypted_size"], len(encrypted_data))
+        self.assertEqual(metadata1["encrypted_checksum"],
+                         checksum_data(encrypted_data))
+        self.assertTrue(metadata1["encrypted_size"] < len(data) + 64)
+        self.assertEqual(data, cloud.retrieve(metadata1))
+
+        # Data stored in BASE64 encoded format.
+        data = file("testdata/data2.txt").read()
+        encryption_key = generate_random_password()
+        encrypted_fp = StringIO()
+        encrypt(StringIO(data), encrypted_fp, encryption_key)
+        base64_data = base64.encodestring(encrypted_fp.getvalue())
+        checksum = checksum_data(data)
+        provider.store(checksum, base64_data)
+        metadata2 = cloud._create_metadata(
+            checksum_data(data + "testdata/data2.txt"),
+            filename="testdata/data2.txt", size=len(data),
+            stat_info=os.stat("testdata/data2.txt"), checksum=checksum,
+            encryption_key=encryption_key, encrypted_size=len(base64_data),
+            encrypted_checksum=checksum_data(base64_data))
+        cloud._commit_metadata(metadata2)
+        self.assertEqual(data, cloud.retrieve(metadata2))
+        cloud.retrieve_to_filename(metadata2, "testdata/new_data")
+        self.assertEqual(data, file("testdata/new_data").read())
+        for metadata in [metadata1, metadata2]:
+            cloud.delete(metadata)
+        cloud.disconnect()
+        os.remove("testdata/new_data")
+
+    def _test_cloud_amazon_s3_binary_format(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = amazon.S3(config, metadata_bucket).connect()
+        provider = amazon.S3(config, data_bucket, encryption_method).connect()
+        self._test_cloud_binary_format(config, metadata_provider, provider)
+
+    def _test_cloud_sftp_binary_format(self, encryption_method):
+        config = Config()
+        metadata_bucket = config.config.get("metadata", "bucket")
+        data_bucket = config.config.get("data", "bucket")
+        metadata_provider = sftp.Sftp(config, metadata_bucket).connect()
+        provider = sftp.Sftp(config, data_bucket, encryption_method).connect()
+        self._test_cloud_binary_format(config, metadata_provider, provider)
+
+
+class TestCloudGpgEncryption(TestCloud):
+
+    def test_cloud_amazon_s3_store_data(self):
+        self._test_cloud_amazon_s3_store_data(encryption_method="gpg")
+
+    def test_cloud_sftp_store_data(self):
+        self._test_cloud_sftp_store_data(encryption_method="gpg")
+
+    def test_cloud_amazon_s3_store_filename(self):
+        self._test_cloud_amazon_s3_store_filename(encryption_method="gpg")
+
+    def test_cloud_sftp_store_filename(self):
+        self._test_cloud_sftp_store_filename(encryption_method="gpg")
+
+    def test_cloud_amazon_s3_parallel_backup(self):
+        self._test_cloud_amazon_s3_parallel_backup(encryption_method="gpg")
+
+    def test_cloud_sftp_parallel_backup(self):
+        self._test_cloud_sftp_parallel_backup(encryption_method="gpg")
+
+    def test_cloud_amazon_s3_async(self):
+        self._test_cloud_amazon_s3_async(encryption_method="gpg")
+
+    def test_cloud_sftp_async(self):
+        self._test_cloud_sftp_async(encryption_method="gpg")
+
+    def test_cloud_memory_async(self):
+        self._test_cloud_memory_async(encryption_method="gpg")
+
+    def test_cloud_amazon_s3_async_shared_data(self):
+        self._test_cloud_amazon_s3_async_shared_data(
+            encryption_method="gpg")
+
+    def test_cloud_sftp_async_shared_data(self):
+        self._test_cloud_sftp_async_shared_data(encryption_method="gpg")
+
+    def test_cloud_memory_async_shared_data(self):
+        self._test_cloud_memory_async_shared_data(
+            encryption_method="gpg")
+
+    def test_cloud_amazon_s3_retrieve_range_to_filename(self):
+        self._test_cloud_amazon_s3_retrieve_range_to_filename(
+            encryption_method="gpg")
+
+    def test_cloud_sftp_retrieve_range_to_filename(self):
+        self._test_cloud_sftp_retrieve_range_to_filename(
+            encryption_method="gpg")
+
+    def test_cloud_amazon_s3_sync(self):
+        self._test_cloud_amazon_s3_sync(encryption_method="gpg")
+
+    def test_cloud_sftp_sync(self):
+        self._test_cloud_sftp_sync(encryption_method="gpg")
+
+    def test_cloud_amazon_s3_metadata_segments(self):
+        self._test_cloud_amazon_s3_metadata_segments(encryption_method="gpg")
+
+    def test_cloud_sftp_metadata_segments(self):
+        self._test_cloud_sftp_metadata_segments(encryption_method="gpg")
+
+    def test_cloud_amazon_s3_pack_files(self):
+        self._test_cloud_amazon_s3_pack_files(encryption_method="gpg")
+
+    def test_cloud_sftp_pack_files(self):
+        self._test_cloud_sftp_pack_files(encryption_method="gpg")
+
+    def test_cloud_amazon_s3_chunked_files(self):
+        self._test_cloud_amazon_s3_chunked_files(encryption_method="gpg")
+
+    def test_cloud_sftp_chunked_files(self):
+        self._test_cloud_sftp_chunked_files(encryption_method="gpg")
+
+    def test_cloud_amazon_s3_stat_cache(self):
+        self._test_cloud_amazon_s3_stat_cache(encryption_method="gpg")
+
+    def test_cloud_sftp_stat_cache(self):
+        self._test_cloud_sftp_stat_cache(encryption_method="gpg")
+
+    def test_cloud_amazon_s3_backup_directory(self):
+        self._test_cloud_amazon_s3_backup_directory(encryption_method="gpg")
+
+    def test_cloud_sftp_backup_directory(self):
+        self._test_cloud_sftp_backup_directory(encryption_method="gpg")
+
+
+class TestCloudSymmetricEncryption(TestCloud):
+
+    def test_cloud_amazon_s3_store_data(self):
+        self._test_cloud_amazon_s3_store_data(encryption_method="symmetric")
+
+    def test_cloud_sftp_store_data(self):
+        self._test_cloud_sftp_store_data(encryption_method="symmetric")
+
+    def test_cloud_amazon_s3_store_filename(self):
+        self._test_cloud_amazon_s3_store_filename(
+            encryption_method="symmetric")
+
+    def test_cloud_sftp_store_filename(self):
         self._test_cloud_sftp_store_filename(encryption_method="symmetric")
 
+    def test_cloud_amazon_s3_parallel_backup(self):
+        self._test_cloud_amazon_s3_parallel_backup(
+            encryption_method="symmetric")
+
+    def test_cloud_sftp_parallel_backup(self):
+        self._test_cloud_sftp_parallel_backup(encryption_method="symmetric")
+
+    def test_cloud_amazon_s3_async(self):
+        self._test_cloud_amazon_s3_async(encryption_method="symmetric")
+
+    def test_cloud_sftp_async(self):
+        self._test_cloud_sftp_async(encryption_method="symmetric")
+
+    def test_cloud_memory_async(self):
+        self._test_cloud_memory_async(encryption_method="symmetric")
+
+    def test_cloud_amazon_s3_async_shared_data(self):
+        self._test_cloud_amazon_s3_async_shared_data(
+            encryption_method="symmetric")
+
+    def test_cloud_sftp_async_shared_data(self):
+        self._test_cloud_sftp_async_shared_data(encryption_method="symmetric")
+
+    def test_cloud_memory_async_shared_data(self):
+        self._test_cloud_memory_async_shared_data(
+            encryption_method="symmetric")
+
+    def test_cloud_amazon_s3_retrieve_range_to_filename(self):
+        self._test_cloud_amazon_s3_retrieve_range_to_filename(
+            encryption_method="symmetric")
+
+    def test_cloud_sftp_retrieve_range_to_filename(self):
+        self._test_cloud_sftp_retrieve_range_to_filename(
+            encryption_method="symmetric")
+
+    def test_cloud_amazon_s3_pack_files(self):
+        self._test_cloud_amazon_s3_pack_files(encryption_method="symmetric")
+
+    def test_cloud_sftp_pack_files(self):
+        self._test_cloud_sftp_pack_files(encryption_method="symmetric")
+
+    def test_cloud_amazon_s3_chunked_files(self):
+        self._test_cloud_amazon_s3_chunked_files(encryption_method="symmetric")
+
+    def test_cloud_sftp_chunked_files(self):
+        self._test_cloud_sftp_chunked_files(encryption_method="symmetric")
+
+    def test_cloud_amazon_s3_compression(self):
+        self._test_cloud_amazon_s3_compression(encryption_method="symmetric")
+
+    def test_cloud_sftp_compression(self):
+        self._test_cloud_sftp_compression(encryption_method="symmetric")
+
+    def test_cloud_amazon_s3_spool(self):
+        self._test_cloud_amazon_s3_spool(encryption_method="symmetric")
+
+    def test_cloud_sftp_spool(self):
+        self._test_cloud_sftp_spool(encryption_method="symmetric")
+
+    def test_cloud_amazon_s3_seekable_format(self):
+        self._test_cloud_amazon_s3_seekable_format(
+            encryption_method="symmetric")
+
+    def test_cloud_sftp_seekable_format(self):
+        self._test_cloud_sftp_seekable_format(encryption_method="symmetric")
+
+    def test_cloud_amazon_s3_binary_format(self):
+        self._test_cloud_amazon_s3_binary_format(
+            encryption_method="symmetric")
+
+    def test_cloud_sftp_binary_format(self):
+        self._test_cloud_sftp_binary_format(encryption_method="symmetric")
+
+
+class TestCloudMulticoreEncryption(TestCloud):
+
+    def test_cloud_amazon_s3_store_data(self):
+        self._test_cloud_amazon_s3_store_data(encryption_method="multicore")
+
+    def test_cloud_sftp_store_data(self):
+        self._test_cloud_sftp_store_data(encryption_method="multicore")
+
+    def test_cloud_amazon_s3_store_filename(self):
+        self._test_cloud_amazon_s3_store_filename(
+            encryption_method="multicore")
+
+    def test_cloud_sftp_store_filename(self):
+        self._test_cloud_sftp_store_filename(encryption_method="multicore")
+
+    def test_cloud_amazon_s3_parallel_backup(self):
+        self._test_cloud_amazon_s3_parallel_backup(
+            encryption_method="multicore")
+
+    def test_cloud_sftp_parallel_backup(self):
+        self._test_cloud_sftp_parallel_backup(encryption_method="multicore")
+
+    def test_cloud_amazon_s3_async(self):
+        self._test_cloud_amazon_s3_async(encryption_method="multicore")
+
+    def test_cloud_sftp_async(self):
+        self._test_cloud_sftp_async(encryption_method="multicore")
+
+    def test_cloud_memory_async(self):
+        self._test_cloud_memory_async(encryption_method="multicore")
+
+    def test_cloud_amazon_s3_async_shared_data(self):
+        self._test_cloud_amazon_s3_async_shared_data(
+            encryption_method="multicore")
+
+    def test_cloud_sftp_async_shared_data(self):
+        self._test_cloud_sftp_async_shared_data(encryption_method="multicore")
+
+    def test_cloud_memory_async_shared_data(self):
+        self._test_cloud_memory_async_shared_data(
+            encryption_method="multicore")
+
+    def test_cloud_amazon_s3_retrieve_range_to_filename(self):
+        self._test_cloud_amazon_s3_retrieve_range_to_filename(
+            encryption_method="multicore")
+
+    def test_cloud_sftp_retrieve_range_to_filename(self):
+        self._test_cloud_sftp_retrieve_range_to_filename(
+            encryption_method="multicore")
+
+    def test_cloud_amazon_s3_multicore_encryption(self):
+        self._test_cloud_amazon_s3_multicore_encryption(
+            encryption_method="multicore")
+
+    def test_cloud_sftp_multicore_encryption(self):
+        self._test_cloud_sftp_multicore_encryption(
+            encryption_method="multicore")
+
+
 class TestCloudCryptoEngineEncryption(TestCloud):
 
     def test_cloud_amazon_s3_store_data(self):
@@ -473,6 +2942,57 @@ class TestCloudCryptoEngineEncryption(TestCloud):
     def test_cloud_sftp_store_filename(self):
         self._test_cloud_sftp_store_filename(encryption_method="cryptoengine")
 
+    def test_cloud_amazon_s3_binary_format(self):
+        self._test_cloud_amazon_s3_binary_format(
+            encryption_method="cryptoengine")
+
+    def test_cloud_sftp_binary_format(self):
+        self._test_cloud_sftp_binary_format(encryption_method="cryptoengine")
+
+    def test_cloud_amazon_s3_parallel_backup(self):
+        self._test_cloud_amazon_s3_parallel_backup(
+            encryption_method="cryptoengine")
+
+    def test_cloud_sftp_parallel_backup(self):
+        self._test_cloud_sftp_parallel_backup(
+            encryption_method="cryptoengine")
+
+    def test_cloud_amazon_s3_async(self):
+        self._test_cloud_amazon_s3_async(encryption_method="cryptoengine")
+
+    def test_cloud_sftp_async(self):
+        self._test_cloud_sftp_async(encryption_method="cryptoengine")
+
+    def test_cloud_memory_async(self):
+        self._test_cloud_memory_async(encryption_method="cryptoengine")
+
+    def test_cloud_amazon_s3_batched_files(self):
+        self._test_cloud_amazon_s3_batched_files(
+            encryption_method="cryptoengine")
+
+    def test_cloud_sftp_batched_files(self):
+        self._test_cloud_sftp_batched_files(encryption_method="cryptoengine")
+
+    def test_cloud_amazon_s3_async_shared_data(self):
+        self._test_cloud_amazon_s3_async_shared_data(
+            encryption_method="cryptoengine")
+
+    def test_cloud_sftp_async_shared_data(self):
+        self._test_cloud_sftp_async_shared_data(
+            encryption_method="cryptoengine")
+
+    def test_cloud_memory_async_shared_data(self):
+        self._test_cloud_memory_async_shared_data(
+            encryption_method="cryptoengine")
+
+    def test_cloud_amazon_s3_retrieve_range_to_filename(self):
+        self._test_cloud_amazon_s3_retrieve_range_to_filename(
+            encryption_method="cryptoengine")
+
+    def test_cloud_sftp_retrieve_range_to_filename(self):
+        self._test_cloud_sftp_retrieve_range_to_filename(
+            encryption_method="cryptoengine")
+
 
 if __name__ == "__main__":
     unittest.main()